@@ -1,7 +1,9 @@
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass, fields
 from enum import Enum
 from typing import List
 
+from halatrans.model.envelope_pb2 import Envelope, MessageKind
+
 
 class PROCESS_TEXT_STATUS(Enum):
     TEXTING = "TEXTING"
@@ -10,19 +12,39 @@ class PROCESS_TEXT_STATUS(Enum):
     ASSISTANT = "ASSISTANT"
 
 
-@dataclass
+@dataclass(slots=True)
 class BaseDataClass:
     def __iter__(self):
-        for attribute, value in asdict(self).items():
+        # shallow, asdict() deep copies every value on each iteration
+        for field in fields(self):
+            value = getattr(self, field.name)
             if isinstance(value, Enum):
-                yield (attribute, str(value))
+                yield (field.name, str(value))
             else:
-                yield (attribute, value)
+                yield (field.name, value)
+
 
+KIND_TEXT_STATUS = {
+    MessageKind.PARTIAL: PROCESS_TEXT_STATUS.TEXTING,
+    MessageKind.FULLTEXT: PROCESS_TEXT_STATUS.FULLTEXT,
+    MessageKind.TRANSLATING: PROCESS_TEXT_STATUS.OPENAI_CONVERT,
+    MessageKind.TRANSLATION: PROCESS_TEXT_STATUS.OPENAI_CONVERT,
+    MessageKind.ASSISTANT: PROCESS_TEXT_STATUS.ASSISTANT,
+}
 
-@dataclass
+
+@dataclass(slots=True)
 class MsgBubble(BaseDataClass):
     msgid: str
     status: PROCESS_TEXT_STATUS
     texts: List[str]
     translations: List[str] | None
+
+    @staticmethod
+    def from_envelope(envelope: Envelope) -> "MsgBubble":
+        return MsgBubble(
+            msgid=envelope.msgid,
+            status=KIND_TEXT_STATUS[envelope.kind],
+            texts=[envelope.text],
+            translations=[envelope.translation] if envelope.translation else None,
+        )
@@ -0,0 +1,216 @@
+"""
+Request latency of the legacy poll-and-sleep REQREP loop against the
+zmq.asyncio runtime, and throughput of two inputs with a blocking handler
+(e.g. a model call) in poll_messages against the runtime with an executor.
+
+    python -m halatrans.benchmark.async_runtime_benchmark --requests 50
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import zmq
+
+from halatrans.services.async_runtime import AsyncServiceRuntime
+from halatrans.services.base_service import RequestResponseService
+from halatrans.services.shutdown import ShutdownFlag, ShutdownFlagPool
+from halatrans.services.utils import (create_pub_socket, create_rep_socket,
+                                      create_sub_socket, poll_messages)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+HANDLER_SECONDS = 0.05
+
+
+# the flags of the services, which run in threads of this process
+FLAG_POOL = ShutdownFlagPool()
+
+
+class EchoService(RequestResponseService):
+    @staticmethod
+    def on_worker_process_response(
+        parameters: Dict[str, Any], topic: str, chunk: bytes
+    ) -> Optional[bytes]:
+        return chunk
+
+
+async def legacy_reqrep_loop(stop_flag: ShutdownFlag, addr: str):
+    # the REQREP worker loop before the asyncio runtime
+    ctx = zmq.Context()
+    rep_sock = create_rep_socket(ctx, addr)
+    poller = zmq.Poller()
+    poller.register(rep_sock, zmq.POLLIN)
+    while stop_flag.get() == 0:
+        socks = dict(poller.poll(1000))
+        if rep_sock in socks and socks[rep_sock] == zmq.POLLIN:
+            bytes_topic, chunk = rep_sock.recv_multipart()
+            response = EchoService.on_worker_process_response({}, "", chunk)
+            rep_sock.send_multipart([bytes_topic, response])
+        else:
+            await asyncio.sleep(0.2)
+    rep_sock.close()
+    ctx.term()
+
+
+async def runtime_reqrep_loop(stop_flag: ShutdownFlag, addr: str):
+    await RequestResponseService.__reqrep_worker_response_handler__(
+        stop_flag, EchoService, addr, {}
+    )
+
+
+def measure_reqrep(
+    server: Callable[[ShutdownFlag, str], Any],
+    addr: str,
+    requests: int,
+    max_gap: float,
+) -> List[float]:
+    stop_flag = FLAG_POOL.acquire()
+    thread = threading.Thread(target=lambda: asyncio.run(server(stop_flag, addr)))
+    thread.start()
+
+    ctx = zmq.Context()
+    req = ctx.socket(zmq.REQ)
+    req.connect(addr)
+    rng = random.Random(0)
+    latencies: List[float] = []
+    for _ in range(requests):
+        # requests arrive at random times, as from the web layer
+        time.sleep(rng.uniform(0.0, max_gap))
+        t1 = time.perf_counter()
+        req.send_multipart([b"topic", b"ping"])
+        req.recv_multipart()
+        latencies.append(time.perf_counter() - t1)
+
+    stop_flag.set(1)
+    thread.join()
+    req.close()
+    ctx.term()
+    return latencies
+
+
+def blocking_handler(sock: zmq.Socket, chunks: List[bytes]):
+    for _ in chunks:
+        time.sleep(HANDLER_SECONDS)
+
+
+def measure_poll_messages(addrs: List[str], messages: int) -> float:
+    stop_flag = FLAG_POOL.acquire()
+    ctx = zmq.Context()
+    subs = [create_sub_socket(ctx, addr, ["t"]) for addr in addrs]
+    handled = [0]
+
+    def handler(sock: zmq.Socket, chunks: List[bytes]):
+        blocking_handler(sock, chunks)
+        handled[0] += len(chunks)
+        if handled[0] >= messages * len(addrs):
+            stop_flag.set(1)
+
+    elapsed = publish_and_wait(
+        addrs,
+        messages,
+        lambda: poll_messages(subs, handler, lambda: stop_flag.get() != 0),
+    )
+    for sub in subs:
+        sub.close()
+    ctx.term()
+    return elapsed
+
+
+def measure_runtime(addrs: List[str], messages: int) -> float:
+    async def main():
+        stop_flag = FLAG_POOL.acquire()
+        runtime = AsyncServiceRuntime(stop_flag)
+        handled = [0]
+
+        async def handler(sock: zmq.Socket, chunks: List[bytes]):
+            await runtime.run_in_executor(blocking_handler, sock, chunks)
+            handled[0] += len(chunks)
+            if handled[0] >= messages * len(addrs):
+                runtime.stop()
+
+        for addr in addrs:
+            runtime.subscribe(create_sub_socket(runtime.ctx, addr, ["t"]), handler)
+        await runtime.run()
+        runtime.close()
+
+    return publish_and_wait(addrs, messages, lambda: asyncio.run(main()))
+
+
+def publish_and_wait(addrs: List[str], messages: int, consume: Callable[[], Any]):
+    ctx = zmq.Context()
+    pubs = [create_pub_socket(ctx, addr) for addr in addrs]
+
+    publish_start = [0.0]
+
+    def publish():
+        time.sleep(1.0)  # subscribers connect meanwhile
+        publish_start[0] = time.perf_counter()
+        for _ in range(messages):
+            for pub in pubs:
+                pub.send_multipart([b"t", b"x"])
+            time.sleep(HANDLER_SECONDS)
+
+    thread = threading.Thread(target=publish)
+    thread.start()
+    consume()
+    # from the first message until every message was handled
+    elapsed = time.perf_counter() - publish_start[0]
+    thread.join()
+    for pub in pubs:
+        pub.close()
+    ctx.term()
+    return elapsed
+
+
+def report_latency(name: str, latencies: List[float]):
+    ms = sorted(v * 1000 for v in latencies)
+    logger.info(
+        f"{name:<22}{statistics.mean(ms):>10.2f}{ms[len(ms) // 2]:>10.2f}"
+        f"{ms[int(len(ms) * 0.99) - 1]:>10.2f}{ms[-1]:>10.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--max-gap", type=float, default=2.0)
+    parser.add_argument("--messages", type=int, default=40)
+    args = parser.parse_args()
+
+    logger.info(
+        f"{'REQREP latency (ms)':<22}{'mean':>10}{'p50':>10}{'p99':>10}{'max':>10}"
+    )
+    report_latency(
+        "poll + sleep",
+        measure_reqrep(
+            legacy_reqrep_loop, "tcp://127.0.0.1:5591", args.requests, args.max_gap
+        ),
+    )
+    report_latency(
+        "zmq.asyncio runtime",
+        measure_reqrep(
+            runtime_reqrep_loop, "tcp://127.0.0.1:5592", args.requests, args.max_gap
+        ),
+    )
+
+    addrs = ["tcp://127.0.0.1:5593", "tcp://127.0.0.1:5594"]
+    expected = args.messages * HANDLER_SECONDS
+    logger.info(
+        f"2 inputs x {args.messages} msgs, {HANDLER_SECONDS * 1000:.0f} ms handler, "
+        f"arrival span {expected:.2f}s"
+    )
+    logger.info(
+        f"poll_messages        {measure_poll_messages(addrs, args.messages):.2f}s"
+    )
+    logger.info(f"zmq.asyncio runtime  {measure_runtime(addrs, args.messages):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Time and allocation of assembling the float32 audio of an utterance from
+its int16 PCM frames, by utterance length: concatenating the frames and
+converting the copy (the former WhisperService path) against converting
+every frame straight into the reused AudioBuffer of a worker. The
+allocation is the peak of tracemalloc while one utterance is assembled.
+
+    python -m halatrans.benchmark.audio_assembly_benchmark --seconds 1,5,15,30
+"""
+
+import argparse
+import logging
+import time
+import tracemalloc
+from typing import Callable, List
+
+import numpy as np
+
+from halatrans.services.audio_frame import (INT16_MAX_ABS_VALUE, AudioBuffer,
+                                            pcm_frame_view)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+BLOCK_SIZE = 8000  # samples per audio block, same as AudioStreamService
+
+
+def gen_frames(seconds: float) -> List[bytes]:
+    rng = np.random.default_rng(0)
+    count = max(int(seconds * SAMPLE_RATE / BLOCK_SIZE), 1)
+    return [
+        rng.integers(-3000, 3000, BLOCK_SIZE, dtype=np.int16).tobytes()
+        for _ in range(count)
+    ]
+
+
+def assemble_concat(frames: List[bytes]) -> np.ndarray:
+    pcm = np.concatenate([pcm_frame_view(frame) for frame in frames])
+    audio = pcm.astype(np.float32) / INT16_MAX_ABS_VALUE
+    # process_faster_whisper_transcribe concatenated the list of one again
+    return np.concatenate([audio])
+
+
+def measure(assemble: Callable[[List[bytes]], np.ndarray], frames: List[bytes]):
+    # warm-up, the buffer grows to the utterance once
+    assemble(frames)
+    tracemalloc.start()
+    assemble(frames)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rounds = max(int(2_000_000 / (len(frames) * BLOCK_SIZE)), 10)
+    start_ts = time.perf_counter()
+    for _ in range(rounds):
+        assemble(frames)
+    return (time.perf_counter() - start_ts) / rounds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", default="1,5,15,30")
+    args = parser.parse_args()
+
+    buffer = AudioBuffer()
+
+    def assemble_buffer(frames: List[bytes]) -> np.ndarray:
+        buffer.clear()
+        return buffer.append(frames)
+
+    logger.info(f"{'seconds':>8}  {'mode':<8}{'us':>10}{'alloc KB':>12}")
+    for seconds in [float(s) for s in args.seconds.split(",")]:
+        frames = gen_frames(seconds)
+        expected = assemble_concat(frames)
+        if not np.array_equal(assemble_buffer(frames), expected):
+            raise ValueError("AudioBuffer differs from the concatenated audio.")
+        for mode, assemble in [
+            ("concat", assemble_concat),
+            ("buffer", assemble_buffer),
+        ]:
+            elapsed, peak = measure(assemble, frames)
+            logger.info(
+                f"{seconds:>8.1f}  {mode:<8}{elapsed * 1e6:>10.1f}{peak / 1024:>12.1f}"
+            )
+    logger.info(f"AudioBuffer capacity {buffer.capacity}, grown {buffer.grow_count}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Compares the legacy base64-in-JSON "fulltext" payload with the binary
+multipart audio frames, per minute of 16 kHz int16 audio.
+
+    python -m halatrans.benchmark.audio_frame_benchmark --minutes 10
+"""
+
+import argparse
+import base64
+import json
+import logging
+import time
+from typing import Callable, List, Tuple
+
+import numpy as np
+import zmq
+
+from halatrans.services.audio_frame import (AudioFrameHeader,
+                                            decode_audio_frames,
+                                            encode_audio_frames,
+                                            pcm_frame_view)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+BLOCK_SIZE = 8000  # samples per audio block, same as AudioStreamService
+INT16_MAX_ABS_VALUE = 32768.0
+TOPIC = b"fulltext"
+
+
+def gen_utterances(minutes: float, blocks_per_utterance: int) -> List[List[bytes]]:
+    rng = np.random.default_rng(0)
+    total_blocks = int(minutes * 60 * SAMPLE_RATE / BLOCK_SIZE)
+    blocks = [
+        rng.integers(-3000, 3000, BLOCK_SIZE, dtype=np.int16).tobytes()
+        for _ in range(total_blocks)
+    ]
+    return [
+        blocks[i : i + blocks_per_utterance]
+        for i in range(0, total_blocks, blocks_per_utterance)
+    ]
+
+
+def legacy_send(sock: zmq.Socket, seq: int, chunks: List[bytes]) -> int:
+    item = {
+        "msgid": f"msgid-{seq}",
+        "status": "fulltext",
+        "chunks": [base64.b64encode(c).decode("utf-8") for c in chunks],
+    }
+    msg = [TOPIC, bytes(json.dumps(item), encoding="utf-8")]
+    sock.send_multipart(msg)
+    return sum(len(m) for m in msg)
+
+
+def legacy_recv(sock: zmq.Socket):
+    _, chunk = sock.recv_multipart()
+    item = json.loads(chunk)
+    frames = [
+        np.frombuffer(base64.b64decode(c), dtype=np.int16).astype(np.float32)
+        / INT16_MAX_ABS_VALUE
+        for c in item["chunks"]
+    ]
+    return np.concatenate(frames)
+
+
+def binary_send(sock: zmq.Socket, seq: int, chunks: List[bytes]) -> int:
+    header = AudioFrameHeader(
+        msgid=f"msgid-{seq}",
+        seq=seq,
+        sample_rate=SAMPLE_RATE,
+        capture_start_ts=0.0,
+        capture_end_ts=0.0,
+    )
+    msg = encode_audio_frames(TOPIC, header, chunks)
+    sock.send_multipart(msg, copy=False)
+    return sum(len(m) for m in msg)
+
+
+def binary_recv(sock: zmq.Socket):
+    frames = sock.recv_multipart(copy=False)
+    _, pcm_chunks = decode_audio_frames(frames[1:])
+    pcm = np.concatenate([pcm_frame_view(c) for c in pcm_chunks])
+    return pcm.astype(np.float32) / INT16_MAX_ABS_VALUE
+
+
+def run_format(
+    addr: str,
+    utterances: List[List[bytes]],
+    send_fn: Callable[[zmq.Socket, int, List[bytes]], int],
+    recv_fn: Callable[[zmq.Socket], np.ndarray],
+) -> Tuple[int, float, float]:
+    ctx = zmq.Context()
+    pull = ctx.socket(zmq.PULL)
+    pull.bind(addr)
+    push = ctx.socket(zmq.PUSH)
+    push.connect(addr)
+
+    bytes_moved = 0
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for seq, chunks in enumerate(utterances):
+        bytes_moved += send_fn(push, seq, chunks)
+        recv_fn(pull)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    push.close()
+    pull.close()
+    ctx.term()
+    return bytes_moved, cpu, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--minutes", type=float, default=10.0)
+    parser.add_argument("--utterance-seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    blocks_per_utterance = max(
+        1, int(args.utterance_seconds * SAMPLE_RATE / BLOCK_SIZE)
+    )
+    utterances = gen_utterances(args.minutes, blocks_per_utterance)
+
+    results = {
+        "json+base64": run_format(
+            "inproc://bench-legacy", utterances, legacy_send, legacy_recv
+        ),
+        "binary frames": run_format(
+            "inproc://bench-binary", utterances, binary_send, binary_recv
+        ),
+    }
+
+    logger.info(
+        f"{args.minutes} min of audio, {len(utterances)} utterances of {args.utterance_seconds}s"
+    )
+    logger.info(f"{'format':<16}{'bytes/min':>14}{'cpu ms/min':>14}{'wall ms/min':>14}")
+    for name, (bytes_moved, cpu, wall) in results.items():
+        logger.info(
+            f"{name:<16}{bytes_moved / args.minutes:>14.0f}"
+            f"{cpu * 1000 / args.minutes:>14.2f}{wall * 1000 / args.minutes:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
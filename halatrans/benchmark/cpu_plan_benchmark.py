@@ -0,0 +1,222 @@
+"""
+Throughput and latency of compute bound work queue services that all run at
+the same time, with and without the cpu plan of the service manager (thread
+budget and cpu affinity per worker process, see
+halatrans/services/cpu_planner.py). Every item is a few numpy matrix
+products, BLAS sizes its thread pool to all cores in every worker unless
+the plan limits it.
+
+    python -m halatrans.benchmark.cpu_plan_benchmark --services 4 --cpu-threads 2
+"""
+
+import argparse
+import logging
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List
+
+import numpy as np
+import zmq
+
+from halatrans.services.base_service import BaseService, ServiceConfig
+from halatrans.services.base_service_manager import BaseServiceManager
+from halatrans.services.context import create_context
+from halatrans.services.cpu_planner import available_cpus
+from halatrans.services.process_task_manager import ServiceState
+from halatrans.services.utils import create_pub_socket, create_sub_socket
+from halatrans.services.work_queue import (OutputMessages, WorkQueueEndpoints,
+                                           WorkQueueService)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INPUT_ADDR = "svc://bench-cpu-input"
+INPUT_TOPIC = "bench-cpu"
+OUTPUT_TOPIC = "bench-cpu-out"
+STARTUP_TIMEOUT = 120.0  # seconds
+
+
+def output_addr(idx: int) -> str:
+    return f"svc://bench-cpu-output-{idx}"
+
+
+@dataclass
+class MatmulServiceParameters:
+    output_addr: str
+    size: int = 256
+    rounds: int = 8
+
+
+class MatmulService(WorkQueueService):
+    @staticmethod
+    def get_work_queue_endpoints(parameters: Dict[str, Any]) -> WorkQueueEndpoints:
+        config = MatmulServiceParameters(**parameters)
+        return WorkQueueEndpoints(
+            input_addr=INPUT_ADDR,
+            input_topics=[INPUT_TOPIC],
+            output_addr=config.output_addr,
+            output_topics=[OUTPUT_TOPIC],
+        )
+
+    @staticmethod
+    def on_worker_setup(parameters: Dict[str, Any]) -> Any:
+        config = MatmulServiceParameters(**parameters)
+        rng = np.random.default_rng(0)
+        return rng.standard_normal((config.size, config.size), dtype=np.float32)
+
+    @staticmethod
+    def on_worker_process_item(
+        state: Any, parameters: Dict[str, Any], frames: List[Any]
+    ) -> OutputMessages:
+        config = MatmulServiceParameters(**parameters)
+        result = state
+        for _ in range(config.rounds):
+            # keep the values bounded
+            result = (result @ state) * (1.0 / config.size)
+        return [[bytes(OUTPUT_TOPIC, encoding="utf-8"), frames[0].bytes]]
+
+
+class MatmulManager(BaseServiceManager):
+    def __init__(self, services: int, cpu_threads: int, size: int, plan: bool):
+        super().__init__(plan_cpus=plan)
+        self.services = services
+        self.cpu_threads = cpu_threads
+        self.size = size
+
+    def on_prepare_start(self) -> ServiceState:
+        service_state: Dict[str, BaseService] = {}
+        for idx in range(self.services):
+            service_state[f"matmul-{idx}"] = MatmulService(
+                ServiceConfig(
+                    cpu_threads=self.cpu_threads,
+                    parameters=asdict(
+                        MatmulServiceParameters(
+                            output_addr=output_addr(idx), size=self.size
+                        )
+                    ),
+                )
+            )
+        return service_state
+
+
+def run_mode(services: int, cpu_threads: int, size: int, items: int, plan: bool):
+    manager = MatmulManager(services, cpu_threads, size, plan)
+    manager.start()
+
+    ctx = create_context()
+    source = create_pub_socket(ctx, INPUT_ADDR)
+    sinks = [
+        create_sub_socket(ctx, output_addr(idx), [OUTPUT_TOPIC])
+        for idx in range(services)
+    ]
+    poller = zmq.Poller()
+    for sink in sinks:
+        poller.register(sink, zmq.POLLIN)
+    bytes_topic = bytes(INPUT_TOPIC, encoding="utf-8")
+
+    def wait_all(timeout: float) -> bool:
+        # one result of every service
+        pending = set(sinks)
+        deadline = time.time() + timeout
+        while len(pending) > 0 and time.time() < deadline:
+            for sock, _ in poller.poll(100):
+                sock.recv_multipart()
+                pending.discard(sock)
+        return len(pending) == 0
+
+    # startup ends when every service answered a probe
+    deadline = time.time() + STARTUP_TIMEOUT
+    started = False
+    while not started and time.time() < deadline:
+        source.send_multipart([bytes_topic, b"probe"])
+        started = wait_all(1.0)
+    if not started:
+        raise ValueError("Matmul services did not start.")
+    while True:
+        ready = poller.poll(500)
+        if len(ready) == 0:
+            break
+        for sock, _ in ready:
+            sock.recv_multipart()
+
+    latencies: List[float] = []
+    start_ts = time.perf_counter()
+    for idx in range(items):
+        ts = time.perf_counter()
+        source.send_multipart([bytes_topic, b"%d" % idx])
+        if not wait_all(STARTUP_TIMEOUT):
+            raise ValueError("Matmul services did not answer.")
+        latencies.append(time.perf_counter() - ts)
+    elapsed = time.perf_counter() - start_ts
+
+    source.close()
+    for sink in sinks:
+        sink.close()
+    ctx.term()
+    manager.terminate()
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    mode = "planned" if plan else "unplanned"
+    print(
+        f"{mode:<10}{items * services / elapsed:>14.1f}"
+        f"{statistics.median(latencies) * 1000:>12.1f}{p95 * 1000:>12.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--services", type=int, default=4)
+    parser.add_argument("--cpu-threads", type=int, default=2)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--mode", choices=["both", "planned", "unplanned"])
+    args = parser.parse_args()
+
+    if args.mode is not None and args.mode != "both":
+        run_mode(
+            args.services,
+            args.cpu_threads,
+            args.size,
+            args.items,
+            args.mode == "planned",
+        )
+        return
+
+    logger.info(
+        f"{args.services} services, {args.cpu_threads} cpu threads each, "
+        f"{len(available_cpus())} cpus"
+    )
+    logger.info(f"{'mode':<10}{'items/s':>14}{'p50 ms':>12}{'p95 ms':>12}")
+    for mode in ["unplanned", "planned"]:
+        # a fresh interpreter per mode, the thread pools live for the process
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "halatrans.benchmark.cpu_plan_benchmark",
+                "--services",
+                str(args.services),
+                "--cpu-threads",
+                str(args.cpu_threads),
+                "--size",
+                str(args.size),
+                "--items",
+                str(args.items),
+                "--mode",
+                mode,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            logger.error(result.stderr)
+            continue
+        logger.info(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    main()
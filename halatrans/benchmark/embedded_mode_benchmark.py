@@ -0,0 +1,211 @@
+"""
+Startup time, memory and message latency of a chain of relay services run
+by a service manager in worker processes, against the embedded mode where
+they are threads of one process over inproc://. Memory is the PSS of the
+manager process and all its children, Linux only.
+
+    python -m halatrans.benchmark.embedded_mode_benchmark --services 6 --isolated 2
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List
+
+import zmq
+
+from halatrans.services.base_service import (BaseService, CustomService,
+                                             ServiceConfig)
+from halatrans.services.base_service_manager import BaseServiceManager
+from halatrans.services.context import create_context
+from halatrans.services.process_task_manager import ServiceState
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import (create_pub_socket, create_sub_socket,
+                                      poll_messages)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TOPIC = "bench"
+STARTUP_TIMEOUT = 60.0  # seconds
+
+
+def bench_addr(idx: int) -> str:
+    return f"svc://bench-embedded-{idx}"
+
+
+@dataclass
+class RelayServiceParameters:
+    input_addr: str
+    output_addr: str
+
+
+class RelayService(CustomService):
+    @staticmethod
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
+        config = RelayServiceParameters(**parameters)
+        ctx = create_context()
+        output_pub = create_pub_socket(ctx, config.output_addr)
+        input_sub = create_sub_socket(ctx, config.input_addr, [TOPIC])
+        bytes_topic = bytes(TOPIC, encoding="utf-8")
+
+        def message_handler(sock: zmq.Socket, chunks: List[bytes]):
+            for chunk in chunks:
+                output_pub.send_multipart([bytes_topic, chunk])
+
+        try:
+            poll_messages([input_sub], message_handler, lambda: stop_flag.get() != 0)
+        finally:
+            output_pub.close()
+            input_sub.close()
+            ctx.term()
+
+
+class RelayChainManager(BaseServiceManager):
+    def __init__(self, services: int, isolated: int, embedded: bool):
+        super().__init__(embedded=embedded)
+        self.services = services
+        self.isolated = isolated
+
+    def on_prepare_start(self) -> ServiceState:
+        service_state: Dict[str, BaseService] = {}
+        for idx in range(self.services):
+            service_state[f"relay-{idx}"] = RelayService(
+                ServiceConfig(
+                    parameters=asdict(
+                        RelayServiceParameters(
+                            input_addr=bench_addr(idx),
+                            output_addr=bench_addr(idx + 1),
+                        )
+                    ),
+                    # stand-ins for the model stages
+                    isolated=idx < self.isolated,
+                )
+            )
+        return service_state
+
+
+def process_tree(pid: int) -> List[int]:
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # the name field may contain spaces, ppid follows it
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+    return pids
+
+
+def pss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def run_mode(services: int, isolated: int, embedded: bool, messages: int):
+    manager = RelayChainManager(services, isolated, embedded)
+    start_ts = time.perf_counter()
+    manager.start()
+
+    # after start, so that embedded sockets share the context of the services
+    ctx = create_context()
+    source = create_pub_socket(ctx, bench_addr(0))
+    sink = create_sub_socket(ctx, bench_addr(services), [TOPIC])
+    bytes_topic = bytes(TOPIC, encoding="utf-8")
+
+    # startup ends when a message makes it through the whole chain
+    deadline = time.time() + STARTUP_TIMEOUT
+    started = False
+    while not started and time.time() < deadline:
+        source.send_multipart([bytes_topic, b"probe"])
+        started = sink.poll(10) != 0
+    if not started:
+        raise ValueError("Relay chain did not start.")
+    startup = time.perf_counter() - start_ts
+    while sink.poll(100):
+        sink.recv_multipart()
+
+    latencies: List[float] = []
+    for _ in range(messages):
+        ts = time.perf_counter()
+        source.send_multipart([bytes_topic, b"x" * 256])
+        sink.recv_multipart()
+        latencies.append(time.perf_counter() - ts)
+
+    pids = process_tree(os.getpid())
+    pss = sum(pss_kb(pid) for pid in pids)
+
+    source.close()
+    sink.close()
+    ctx.term()
+    manager.terminate()
+
+    mode = "embedded" if embedded else "process"
+    print(
+        f"{mode:<10}{len(pids):>10}{startup * 1000:>14.0f}{pss / 1024:>12.1f}"
+        f"{statistics.median(latencies) * 1e6:>14.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--services", type=int, default=6)
+    parser.add_argument("--isolated", type=int, default=2)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--mode", choices=["both", "process", "embedded"])
+    args = parser.parse_args()
+
+    if args.mode is not None and args.mode != "both":
+        run_mode(args.services, args.isolated, args.mode == "embedded", args.messages)
+        return
+
+    logger.info(
+        f"{args.services} relay services, {args.isolated} isolated in embedded mode"
+    )
+    logger.info(
+        f"{'mode':<10}{'processes':>10}{'startup ms':>14}{'PSS MB':>12}{'latency us':>14}"
+    )
+    for mode in ["process", "embedded"]:
+        # a fresh interpreter per mode, the shared context lives for the process
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "halatrans.benchmark.embedded_mode_benchmark",
+                "--services",
+                str(args.services),
+                "--isolated",
+                str(args.isolated),
+                "--messages",
+                str(args.messages),
+                "--mode",
+                mode,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            logger.error(result.stderr)
+            continue
+        logger.info(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    main()
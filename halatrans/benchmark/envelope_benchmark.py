@@ -0,0 +1,99 @@
+"""
+Compares the JSON dict messages with the protobuf envelope of the backend
+bus, encode plus decode per message kind.
+
+    python -m halatrans.benchmark.envelope_benchmark --count 100000
+"""
+
+import argparse
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from halatrans.model.envelope import (MessageKind, decode_envelope,
+                                      encode_envelope)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MSGID = "3f6d1c1e-2a4b-4f7e-9c55-8d1f0b6e7a21"
+TEXT = "so the next thing we should look at is the latency of the pipeline"
+TRANSLATION = "所以接下来我们应该看的是整个处理流程的延迟"
+
+# kind, legacy JSON item, envelope fields
+MESSAGES: List[Tuple[str, Dict[str, Any], Dict[str, Any]]] = [
+    (
+        "partial",
+        {"msgid": MSGID, "status": "partial", "text": TEXT},
+        {"kind": MessageKind.PARTIAL, "msgid": MSGID, "text": TEXT},
+    ),
+    (
+        "fulltext",
+        {"msgid": MSGID, "status": "fulltext", "text": TEXT},
+        {"kind": MessageKind.FULLTEXT, "msgid": MSGID, "text": TEXT},
+    ),
+    (
+        "translation",
+        {
+            "msgid": MSGID,
+            "status": "translate",
+            "text": TEXT,
+            "translation": TRANSLATION,
+        },
+        {
+            "kind": MessageKind.TRANSLATION,
+            "msgid": MSGID,
+            "text": TEXT,
+            "translation": TRANSLATION,
+        },
+    ),
+    (
+        "assistant",
+        {"msg_type": "assistant", "assistant": {"text": TEXT * 4}},
+        {"kind": MessageKind.ASSISTANT, "text": TEXT * 4},
+    ),
+]
+
+
+def json_roundtrip(item: Dict[str, Any]) -> int:
+    data = bytes(json.dumps(item), encoding="utf-8")
+    json.loads(data)
+    return len(data)
+
+
+def envelope_roundtrip(item: Dict[str, Any]) -> int:
+    data = encode_envelope(**item)
+    decode_envelope(data)
+    return len(data)
+
+
+def run_codec(
+    count: int, item: Dict[str, Any], roundtrip: Callable[[Dict[str, Any]], int]
+) -> Tuple[int, float]:
+    size = roundtrip(item)
+    start = time.perf_counter()
+    for _ in range(count):
+        roundtrip(item)
+    elapsed = time.perf_counter() - start
+    return size, elapsed * 1e6 / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    logger.info(f"{args.count} encode+decode round trips per message kind")
+    logger.info(f"{'kind':<14}{'codec':<10}{'bytes':>8}{'us/msg':>10}")
+    for kind, json_item, envelope_item in MESSAGES:
+        for codec, item, roundtrip in [
+            ("json", json_item, json_roundtrip),
+            ("envelope", envelope_item, envelope_roundtrip),
+        ]:
+            size, us = run_codec(args.count, item, roundtrip)
+            logger.info(f"{kind:<14}{codec:<10}{size:>8}{us:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Cpu, memory and segmentation latency of the utterance segmenters of
+TranscribeService: the full vosk decode, the energy VAD (see
+halatrans/services/vad_segmenter.py) and the VAD with vosk partials.
+
+The audio is fed in blocks of AudioStreamService on a simulated clock that
+also advances by the measured processing time. The segmentation latency is
+the time from the end of the last loud frame of an utterance to its
+fulltext message, the same loudness threshold is used for every mode. Every
+mode runs in a fresh interpreter, so the peak RSS is that of one mode. The
+audio must be a 16 kHz mono int16 wav file.
+
+    python -m halatrans.benchmark.segmenter_benchmark --audio talk.wav
+"""
+
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import sys
+import time
+import wave
+from typing import List, Tuple
+
+import numpy as np
+
+from halatrans.services.vad_segmenter import (FRAME_MS, SAMPLE_RATE,
+                                              VadSegmenter, frame_energies)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 8000  # samples per audio block, same as AudioStreamService
+LOUD_DB = -40.0  # dBFS of the frames that count as the end of speech
+MODES = ["vosk", "vad", "vad-partials"]
+
+# sample range of an utterance and the time of its fulltext message
+Cut = Tuple[int, int, float]
+
+
+def load_wav(path: str) -> np.ndarray:
+    # no whisper_streaming_benchmark import, it loads whisper into the rss
+    with wave.open(path, "rb") as wav:
+        if (
+            wav.getframerate() != SAMPLE_RATE
+            or wav.getnchannels() != 1
+            or wav.getsampwidth() != 2
+        ):
+            raise ValueError(f"{path} is not a 16 kHz mono int16 wav file.")
+        return np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_vosk(pcm: np.ndarray, model_name: str) -> List[Cut]:
+    from vosk import KaldiRecognizer
+
+    from halatrans.services.backend.transcribe_service import (
+        load_vosk_model, warmup_vosk_model)
+
+    model = load_vosk_model(model_name)
+    warmup_vosk_model(model)
+    recognizer = KaldiRecognizer(model, SAMPLE_RATE)
+
+    cuts: List[Cut] = []
+    clock = 0.0
+    start = None
+    for fed in range(0, len(pcm), BLOCK_SIZE):
+        block = pcm[fed : fed + BLOCK_SIZE]
+        start_ts = time.perf_counter()
+        is_endpoint = recognizer.AcceptWaveform(block.tobytes())
+        if is_endpoint:
+            recognizer.Reset()
+        else:
+            text = json.loads(recognizer.PartialResult())["partial"]
+        elapsed = time.perf_counter() - start_ts
+        clock = max(clock, (fed + len(block)) / SAMPLE_RATE) + elapsed
+        if is_endpoint:
+            if start is not None:
+                cuts.append((start, fed + len(block), clock))
+            start = None
+        elif len(text) > 2 and start is None:
+            # the utterance audio starts with its first partial text
+            start = fed
+    return cuts
+
+
+def run_vad(pcm: np.ndarray, model_name: str, partials: bool) -> List[Cut]:
+    recognizer = None
+    if partials:
+        from vosk import KaldiRecognizer
+
+        from halatrans.services.backend.transcribe_service import (
+            load_vosk_model, warmup_vosk_model)
+
+        model = load_vosk_model(model_name)
+        warmup_vosk_model(model)
+        recognizer = KaldiRecognizer(model, SAMPLE_RATE)
+
+    segmenter = VadSegmenter(SAMPLE_RATE)
+    cuts: List[Cut] = []
+    clock = 0.0
+    for fed in range(0, len(pcm), BLOCK_SIZE):
+        block = pcm[fed : fed + BLOCK_SIZE]
+        start_ts = time.perf_counter()
+        segments = segmenter.accept(block)
+        if recognizer:
+            if len(segments) > 0:
+                recognizer.Reset()
+            if segmenter.in_speech and not recognizer.AcceptWaveform(block.tobytes()):
+                recognizer.PartialResult()
+        elapsed = time.perf_counter() - start_ts
+        clock = max(clock, (fed + len(block)) / SAMPLE_RATE) + elapsed
+        cuts.extend((s.start, s.end, clock) for s in segments)
+    return cuts
+
+
+def run_mode(mode: str, pcm: np.ndarray, model_name: str) -> str:
+    cpu_start = time.process_time()
+    if mode == "vosk":
+        cuts = run_vosk(pcm, model_name)
+    else:
+        cuts = run_vad(pcm, model_name, mode == "vad-partials")
+    cpu = time.process_time() - cpu_start
+
+    frame_size = SAMPLE_RATE * FRAME_MS // 1000
+    loud = np.nonzero(frame_energies(pcm, frame_size) > LOUD_DB)[0]
+    latencies = []
+    for start, end, emit_ts in cuts:
+        # the last loud frame that ends in the utterance
+        frames = loud[(loud * frame_size >= start) & ((loud + 1) * frame_size <= end)]
+        if len(frames) > 0:
+            latencies.append(emit_ts - (frames[-1] + 1) * frame_size / SAMPLE_RATE)
+    if len(latencies) == 0:
+        latencies = [0.0]
+    p50, p95 = np.percentile(latencies, [50, 95])
+    peak_rss = peak_rss_mb()
+    duration = len(pcm) / SAMPLE_RATE
+    return (
+        f"{mode:<14}{len(cuts):>8}{cpu / duration * 100:>8.2f}"
+        f"{p50:>10.2f}{p95:>10.2f}{peak_rss:>10.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--audio", required=True)
+    # VOSK_MODEL_NAME, transcribe_service imports vosk
+    parser.add_argument("--model", default="vosk-model-en-us-0.42-gigaspeech")
+    parser.add_argument("--mode", choices=["all", *MODES], default="all")
+    args = parser.parse_args()
+
+    if args.mode != "all":
+        print(run_mode(args.mode, load_wav(args.audio), args.model))
+        return
+
+    logger.info(f"{len(load_wav(args.audio)) / SAMPLE_RATE:.1f}s of audio")
+    # cpu time per audio time, latency in seconds
+    logger.info(
+        f"{'mode':<14}{'cuts':>8}{'cpu %':>8}{'p50 s':>10}{'p95 s':>10}{'rss MB':>10}"
+    )
+    for mode in MODES:
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "halatrans.benchmark.segmenter_benchmark",
+                "--audio",
+                args.audio,
+                "--model",
+                args.model,
+                "--mode",
+                mode,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            logger.error(result.stderr)
+            continue
+        logger.info(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Time to first transcript of the model stages after a start of the service
+manager, for cold workers that load the models on every start against warm
+workers (ServiceConfig.warm) that keep them across stop and start.
+
+A speech recording is played in real time as the audio stream, the vosk
+transcribe service and the whisper service must be able to load their
+models, see halatrans/services/model_cache.py.
+
+    python -m halatrans.benchmark.warm_pool_benchmark --wav speech.wav --cycles 3
+"""
+
+import argparse
+import logging
+import time
+import wave
+from dataclasses import asdict
+from typing import Dict, List, Optional, Tuple
+
+import zmq
+
+from halatrans.services.backend.transcribe_service import (
+    TranscribeService, TranscribeServiceParameters)
+from halatrans.services.backend.whisper_service import (
+    WhisperService, WhisperServiceParameters)
+from halatrans.services.base_service import BaseService, ServiceConfig
+from halatrans.services.base_service_manager import BaseServiceManager
+from halatrans.services.config import (CONST_AUDIO_STREAM_PUB_ADDR,
+                                       CONST_AUDIO_STREAM_PUB_TOPIC,
+                                       CONST_TRANSCRIBE_PUB_ADDR,
+                                       CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
+                                       CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
+                                       CONST_WHISPER_PUB_ADDR,
+                                       CONST_WHISPER_PUB_TOPIC)
+from halatrans.services.process_task_manager import ServiceState
+from halatrans.services.utils import create_pub_socket, create_sub_socket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+BLOCK_SIZE = 8000  # samples per audio block, same as AudioStreamService
+FIRST_TRANSCRIPT_TIMEOUT = 300.0  # seconds
+
+
+class ModelStagesManager(BaseServiceManager):
+    def __init__(self, warm: bool):
+        super().__init__()
+        self.warm = warm
+
+    def on_prepare_start(self) -> ServiceState:
+        service_state: Dict[str, BaseService] = {
+            "transcribe": TranscribeService(
+                ServiceConfig(
+                    warm=self.warm,
+                    parameters=asdict(
+                        TranscribeServiceParameters(
+                            audio_pub_addr=CONST_AUDIO_STREAM_PUB_ADDR,
+                            audio_pub_topic=CONST_AUDIO_STREAM_PUB_TOPIC,
+                            transcribe_pub_addr=CONST_TRANSCRIBE_PUB_ADDR,
+                            transcribe_pub_partial_topic=CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
+                            transcribe_pub_fulltext_topic=CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
+                        )
+                    ),
+                )
+            ),
+            "whisper": WhisperService(
+                ServiceConfig(
+                    warm=self.warm,
+                    parameters=asdict(
+                        WhisperServiceParameters(
+                            transcribe_pub_addr=CONST_TRANSCRIBE_PUB_ADDR,
+                            transcribe_pub_fulltext_topic=CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
+                            whisper_pub_addr=CONST_WHISPER_PUB_ADDR,
+                            whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
+                        )
+                    ),
+                )
+            ),
+        }
+        return service_state
+
+
+def load_wav_blocks(path: str) -> List[bytes]:
+    with wave.open(path, "rb") as f:
+        if (
+            f.getframerate() != SAMPLE_RATE
+            or f.getnchannels() != 1
+            or f.getsampwidth() != 2
+        ):
+            raise ValueError("Expect a 16 kHz mono int16 wav file.")
+        data = f.readframes(f.getnframes())
+    block_bytes = BLOCK_SIZE * 2
+    return [data[i : i + block_bytes] for i in range(0, len(data), block_bytes)]
+
+
+def time_to_first_transcript(
+    manager: ModelStagesManager, blocks: List[bytes]
+) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Seconds from start() to the first partial and to the first whisper
+    transcript, None when it did not arrive.
+    """
+    ctx = zmq.Context()
+    audio_pub = create_pub_socket(ctx, CONST_AUDIO_STREAM_PUB_ADDR)
+    partial_sub = create_sub_socket(
+        ctx, CONST_TRANSCRIBE_PUB_ADDR, [CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC]
+    )
+    whisper_sub = create_sub_socket(
+        ctx, CONST_WHISPER_PUB_ADDR, [CONST_WHISPER_PUB_TOPIC]
+    )
+    poller = zmq.Poller()
+    poller.register(partial_sub, zmq.POLLIN)
+    poller.register(whisper_sub, zmq.POLLIN)
+    audio_topic = bytes(CONST_AUDIO_STREAM_PUB_TOPIC, encoding="utf-8")
+
+    first_partial: Optional[float] = None
+    first_whisper: Optional[float] = None
+    start_ts = time.time()
+    manager.start()
+    block_interval = BLOCK_SIZE / SAMPLE_RATE
+    next_block_ts = start_ts
+    idx = 0
+    while first_whisper is None and time.time() - start_ts < FIRST_TRANSCRIPT_TIMEOUT:
+        # the recording is looped in real time until whisper answers
+        if time.time() >= next_block_ts:
+            audio_pub.send_multipart([audio_topic, blocks[idx % len(blocks)]])
+            idx += 1
+            next_block_ts += block_interval
+        timeout_ms = max(0, int((next_block_ts - time.time()) * 1000))
+        for sock, _ in poller.poll(timeout_ms):
+            sock.recv_multipart()
+            if sock is partial_sub and first_partial is None:
+                first_partial = time.time() - start_ts
+            if sock is whisper_sub:
+                first_whisper = time.time() - start_ts
+
+    manager.stop()
+    audio_pub.close()
+    partial_sub.close()
+    whisper_sub.close()
+    ctx.term()
+    return first_partial, first_whisper
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--wav", required=True)
+    parser.add_argument("--cycles", type=int, default=3)
+    args = parser.parse_args()
+
+    blocks = load_wav_blocks(args.wav)
+
+    results: List[Tuple[str, int, Optional[float], Optional[float]]] = []
+    for warm in [False, True]:
+        manager = ModelStagesManager(warm)
+        for cycle in range(args.cycles):
+            first_partial, first_whisper = time_to_first_transcript(manager, blocks)
+            results.append(
+                ("warm" if warm else "cold", cycle, first_partial, first_whisper)
+            )
+        manager.terminate()
+
+    def fmt(value: Optional[float]) -> str:
+        return "timeout" if value is None else f"{value:.2f}"
+
+    logger.info(
+        f"{'workers':<10}{'start':>6}{'first partial s':>18}{'first whisper s':>18}"
+    )
+    for name, cycle, first_partial, first_whisper in results:
+        logger.info(
+            f"{name:<10}{cycle:>6}{fmt(first_partial):>18}{fmt(first_whisper):>18}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Throughput of whisper on queued utterances, one transcribe() call per
+utterance (WhisperService without batching) against batched CTranslate2
+calls of different sizes (WhisperService.on_worker_process_batch), in
+utterances per second per core of the model.
+
+The utterances are cut from a 16 kHz mono int16 wav file, without one they
+are low noise, which decodes much faster than speech.
+
+    python -m halatrans.benchmark.whisper_batch_benchmark --audio talk.wav --batch-sizes 1,2,4,8
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import time
+import wave
+from typing import Callable, List
+
+import numpy as np
+
+from halatrans.services.backend.whisper_service import (
+    INT16_MAX_ABS_VALUE, SAMPLE_RATE, WHISPER_MODEL_SIZE, WhisperModel,
+    load_whisper_model, process_faster_whisper_batch,
+    process_faster_whisper_transcribe, warmup_whisper_model)
+from halatrans.services.cpu_planner import CPU_THREADS_ENV, available_cpus
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def load_utterances(path: str, seconds: float, count: int) -> List[np.ndarray]:
+    size = int(seconds * SAMPLE_RATE)
+    if path:
+        with wave.open(path, "rb") as wav:
+            if (
+                wav.getframerate() != SAMPLE_RATE
+                or wav.getnchannels() != 1
+                or wav.getsampwidth() != 2
+            ):
+                raise ValueError(f"{path} is not a 16 kHz mono int16 wav file.")
+            pcm = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+        audio = pcm.astype(np.float32) / INT16_MAX_ABS_VALUE
+        if len(audio) < size:
+            raise ValueError(f"{path} is shorter than one utterance.")
+        # the audio is cut round robin into as many utterances as needed
+        starts = range(0, len(audio) - size + 1, size)
+        pieces = [audio[start : start + size] for start in starts]
+        return [pieces[idx % len(pieces)] for idx in range(count)]
+    rng = np.random.default_rng(0)
+    return [rng.normal(0, 0.01, size).astype(np.float32) for _ in range(count)]
+
+
+def run(
+    batch_size: int,
+    utterances: List[np.ndarray],
+    decode: Callable[[List[np.ndarray]], None],
+) -> List[float]:
+    # seconds per batch
+    durations: List[float] = []
+    for start in range(0, len(utterances), batch_size):
+        batch = utterances[start : start + batch_size]
+        start_ts = time.perf_counter()
+        decode(batch)
+        durations.append(time.perf_counter() - start_ts)
+    return durations
+
+
+def report(mode: str, batch_size: int, count: int, durations: List[float], cores: int):
+    per_second = count / sum(durations)
+    logger.info(
+        f"{mode:<12}{batch_size:>6}{per_second:>12.2f}{per_second / cores:>12.2f}"
+        f"{statistics.median(durations) * 1000:>12.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--audio", default="")
+    parser.add_argument("--model", default=WHISPER_MODEL_SIZE)
+    parser.add_argument("--utterance-seconds", type=float, default=5.0)
+    parser.add_argument("--utterances", type=int, default=32)
+    parser.add_argument("--batch-sizes", default="1,2,4,8")
+    parser.add_argument("--beam-size", type=int, default=5)
+    parser.add_argument("--cpu-threads", type=int, default=len(available_cpus()))
+    args = parser.parse_args()
+
+    # the thread budget of load_whisper_model
+    os.environ[CPU_THREADS_ENV] = str(args.cpu_threads)
+    model: WhisperModel = load_whisper_model(args.model)
+    warmup_whisper_model(model)
+    utterances = load_utterances(args.audio, args.utterance_seconds, args.utterances)
+
+    logger.info(
+        f"{args.utterances} utterances of {args.utterance_seconds}s, "
+        f"whisper {args.model}, {args.cpu_threads} cpu threads"
+    )
+    logger.info(
+        f"{'mode':<12}{'batch':>6}{'utt/s':>12}{'utt/s/core':>12}{'batch ms':>12}"
+    )
+
+    def transcribe(batch: List[np.ndarray]):
+        for audio in batch:
+            process_faster_whisper_transcribe(
+                model, "bench", [audio], beam_size=args.beam_size
+            )
+
+    durations = run(1, utterances, transcribe)
+    report("transcribe", 1, len(utterances), durations, args.cpu_threads)
+
+    def batched(batch: List[np.ndarray]):
+        process_faster_whisper_batch(model, batch, beam_size=args.beam_size)
+
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        durations = run(batch_size, utterances, batched)
+        report("batched", batch_size, len(utterances), durations, args.cpu_threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Speed, memory and accuracy of WhisperService decoding on cpu for every
+combination of model, compute type, beam size and thread count. A fixed
+corpus of utterances is decoded one by one like the service does: a
+directory of 16 kHz mono int16 wav files, each with its transcript in a .txt
+file of the same name.
+
+Every combination runs in a fresh interpreter, so the peak RSS is that of
+one loaded model. The real-time factor is the decoding time per audio time,
+the latencies are per utterance.
+
+    python -m halatrans.benchmark.whisper_matrix_benchmark --corpus utterances/ --compute-types float32,int8 --beam-sizes 1,5
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from halatrans.benchmark.whisper_streaming_benchmark import (load_wav,
+                                                             normalize_words,
+                                                             word_error_rate)
+from halatrans.services.backend.whisper_service import (INT16_MAX_ABS_VALUE,
+                                                        SAMPLE_RATE,
+                                                        WHISPER_MODEL_SIZE,
+                                                        load_whisper_model,
+                                                        transcribe_texts,
+                                                        warmup_whisper_model)
+from halatrans.services.cpu_planner import CPU_THREADS_ENV, available_cpus
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def load_corpus(path: str) -> List[Tuple[np.ndarray, List[str]]]:
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".wav"):
+            continue
+        wav_path = os.path.join(path, name)
+        with open(wav_path[: -len(".wav")] + ".txt", encoding="utf-8") as f:
+            reference = normalize_words(f.read())
+        audio = load_wav(wav_path).astype(np.float32) / INT16_MAX_ABS_VALUE
+        corpus.append((audio, reference))
+    if len(corpus) == 0:
+        raise ValueError(f"No wav files in {path}.")
+    return corpus
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_combination(
+    corpus_path: str,
+    model_size: str,
+    compute_type: str,
+    beam_size: int,
+    language: str,
+) -> str:
+    corpus = load_corpus(corpus_path)
+    # the thread budget is read when the model loads
+    model = load_whisper_model(model_size, compute_type)
+    warmup_whisper_model(model)
+
+    latencies: List[float] = []
+    references: List[str] = []
+    hypothesis: List[str] = []
+    for audio, reference in corpus:
+        start_ts = time.perf_counter()
+        texts = transcribe_texts(
+            model, audio, beam_size=beam_size, language=language or None
+        )
+        latencies.append(time.perf_counter() - start_ts)
+        references.extend(reference)
+        hypothesis.extend(normalize_words(" ".join(texts)))
+
+    duration = sum(len(audio) for audio, _ in corpus) / SAMPLE_RATE
+    wer = word_error_rate(references, hypothesis)
+    p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+    peak_rss = peak_rss_mb()
+    return (
+        f"{model_size:<12}{compute_type:<10}{beam_size:>6}"
+        f"{os.environ.get(CPU_THREADS_ENV, ''):>9}"
+        f"{sum(latencies) / duration:>8.3f}{p50:>10.1f}{p95:>10.1f}"
+        f"{peak_rss:>10.0f}{wer * 100:>8.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", required=True)
+    parser.add_argument("--models", default=WHISPER_MODEL_SIZE)
+    parser.add_argument("--compute-types", default="float32,int8")
+    parser.add_argument("--beam-sizes", default="1,5")
+    parser.add_argument("--cpu-threads", default=str(len(available_cpus())))
+    parser.add_argument("--language", default="en", help="empty to detect it")
+    # internal, runs a single combination
+    parser.add_argument("--run", default="")
+    args = parser.parse_args()
+
+    if args.run:
+        model_size, compute_type, beam_size = args.run.split(",")
+        print(
+            run_combination(
+                args.corpus, model_size, compute_type, int(beam_size), args.language
+            )
+        )
+        return
+
+    logger.info(f"Corpus {args.corpus}, {len(available_cpus())} cpus")
+    logger.info(
+        f"{'model':<12}{'compute':<10}{'beam':>6}{'threads':>9}"
+        f"{'rtf':>8}{'p50 ms':>10}{'p95 ms':>10}{'rss MB':>10}{'wer %':>8}"
+    )
+    for model_size, compute_type, beam_size, cpu_threads in itertools.product(
+        args.models.split(","),
+        args.compute_types.split(","),
+        args.beam_sizes.split(","),
+        args.cpu_threads.split(","),
+    ):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "halatrans.benchmark.whisper_matrix_benchmark",
+                "--corpus",
+                args.corpus,
+                "--language",
+                args.language,
+                "--run",
+                f"{model_size},{compute_type},{beam_size}",
+            ],
+            env={**os.environ, CPU_THREADS_ENV: cpu_threads},
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            logger.error(result.stderr)
+            continue
+        logger.info(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Word error rate and time to final word of streaming whisper
+(WhisperStreamService) against the two stage flow of TranscribeService and
+WhisperService, where vosk cuts the utterances and whisper decodes each one
+in a single pass.
+
+The audio is fed in blocks of AudioStreamService on a simulated clock that
+also advances by the measured decoding time, so the latencies are those of
+a live stream on this machine. The time to final word is the time from the
+end of a word in the audio to its final text. The audio must be a 16 kHz
+mono int16 wav file, the reference its transcript.
+
+    python -m halatrans.benchmark.whisper_streaming_benchmark --audio talk.wav --reference talk.txt
+"""
+
+import argparse
+import logging
+import re
+import statistics
+import time
+import wave
+from typing import Any, List, Tuple
+
+import numpy as np
+
+from halatrans.services.backend.whisper_service import (INT16_MAX_ABS_VALUE,
+                                                        WHISPER_MODEL_SIZE,
+                                                        load_whisper_model,
+                                                        warmup_whisper_model)
+from halatrans.services.streaming_transcriber import (SAMPLE_RATE,
+                                                      StreamingTranscriber,
+                                                      Word)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 8000  # samples per audio block, same as AudioStreamService
+
+# final words and the seconds from their end in the audio to the final text
+Result = Tuple[List[str], List[float], float]
+
+
+def load_wav(path: str) -> np.ndarray:
+    with wave.open(path, "rb") as wav:
+        if (
+            wav.getframerate() != SAMPLE_RATE
+            or wav.getnchannels() != 1
+            or wav.getsampwidth() != 2
+        ):
+            raise ValueError(f"{path} is not a 16 kHz mono int16 wav file.")
+        return np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+
+
+def _to_float(pcm: np.ndarray) -> np.ndarray:
+    return pcm.astype(np.float32) / INT16_MAX_ABS_VALUE
+
+
+def normalize_words(text: str) -> List[str]:
+    return [w for w in re.sub(r"[^\w' ]", " ", text.lower()).split() if w]
+
+
+def word_error_rate(reference: List[str], hypothesis: List[str]) -> float:
+    # word level edit distance over the reference length
+    row = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, start=1):
+        prev, row[0] = row[0], i
+        for j, hyp_word in enumerate(hypothesis, start=1):
+            prev, row[j] = row[j], min(
+                row[j] + 1,
+                row[j - 1] + 1,
+                prev + (0 if ref_word == hyp_word else 1),
+            )
+    return row[-1] / max(len(reference), 1)
+
+
+def run_streaming(
+    model: Any,
+    pcm: np.ndarray,
+    decode_interval: float,
+    max_window: float,
+    max_latency: float,
+    beam_size: int,
+) -> Result:
+    transcriber = StreamingTranscriber(max_window, max_latency)
+    texts: List[str] = []
+    latencies: List[float] = []
+    busy = 0.0
+
+    def commit(words: List[Word], now: float):
+        for word in words:
+            texts.append(word.text)
+            latencies.append(now - word.end)
+
+    clock = 0.0
+    fed = 0
+    while fed < len(pcm):
+        # the blocks that arrived until now
+        while fed < len(pcm) and (fed + BLOCK_SIZE) / SAMPLE_RATE <= clock:
+            transcriber.insert_audio(_to_float(pcm[fed : fed + BLOCK_SIZE]))
+            fed += BLOCK_SIZE
+        if transcriber.pending_seconds < decode_interval:
+            # wait for the next block
+            clock = max(clock, (fed + BLOCK_SIZE) / SAMPLE_RATE)
+            continue
+        start_ts = time.perf_counter()
+        words = transcriber.process(model, beam_size=beam_size)
+        elapsed = time.perf_counter() - start_ts
+        busy += elapsed
+        clock += elapsed
+        commit(words, clock)
+
+    start_ts = time.perf_counter()
+    words = transcriber.finish(model, beam_size=beam_size)
+    elapsed = time.perf_counter() - start_ts
+    commit(words, clock + elapsed)
+    return texts, latencies, busy + elapsed
+
+
+def run_two_stage(model: Any, pcm: np.ndarray, beam_size: int) -> Result:
+    from vosk import KaldiRecognizer
+
+    from halatrans.services.backend.transcribe_service import (
+        VOSK_MODEL_NAME, load_vosk_model, warmup_vosk_model)
+
+    vosk_model = load_vosk_model(VOSK_MODEL_NAME)
+    warmup_vosk_model(vosk_model)
+    recognizer = KaldiRecognizer(vosk_model, SAMPLE_RATE)
+
+    texts: List[str] = []
+    latencies: List[float] = []
+    busy = 0.0
+    # vosk and the whisper replica each run on their own
+    vosk_clock = 0.0
+    whisper_free = 0.0
+
+    def decode(start: int, end: int, endpoint_ts: float):
+        nonlocal busy, whisper_free
+        start_ts = time.perf_counter()
+        segments, _ = model.transcribe(
+            _to_float(pcm[start:end]),
+            beam_size=beam_size,
+            language="en",
+            condition_on_previous_text=False,
+            word_timestamps=True,
+            vad_filter=True,
+            vad_parameters=dict(min_silence_duration_ms=500),
+        )
+        words = [w for s in segments for w in (s.words or []) if w.word.strip()]
+        elapsed = time.perf_counter() - start_ts
+        busy += elapsed
+        whisper_free = max(whisper_free, endpoint_ts) + elapsed
+        for word in words:
+            texts.append(word.word.strip())
+            latencies.append(whisper_free - (start / SAMPLE_RATE + word.end))
+
+    utterance_start = 0
+    for fed in range(0, len(pcm), BLOCK_SIZE):
+        block = pcm[fed : fed + BLOCK_SIZE]
+        start_ts = time.perf_counter()
+        is_endpoint = recognizer.AcceptWaveform(block.tobytes())
+        if not is_endpoint:
+            recognizer.PartialResult()
+        arrival_ts = (fed + len(block)) / SAMPLE_RATE
+        vosk_clock = max(vosk_clock, arrival_ts) + time.perf_counter() - start_ts
+        if is_endpoint:
+            recognizer.Reset()
+            decode(utterance_start, fed + len(block), vosk_clock)
+            utterance_start = fed + len(block)
+    if utterance_start < len(pcm):
+        # the end of the stream ends the last utterance
+        recognizer.FinalResult()
+        decode(utterance_start, len(pcm), vosk_clock)
+    return texts, latencies, busy
+
+
+def report(mode: str, result: Result, reference: List[str], duration: float):
+    texts, latencies, busy = result
+    hypothesis = normalize_words(" ".join(texts))
+    wer = word_error_rate(reference, hypothesis)
+    if len(latencies) == 0:
+        latencies = [0.0]
+    latencies = sorted(latencies)
+    p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+    logger.info(
+        f"{mode:<12}{wer * 100:>8.1f}{len(hypothesis):>8}"
+        f"{statistics.median(latencies):>10.2f}{p95:>10.2f}{latencies[-1]:>10.2f}"
+        f"{busy / duration:>8.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--audio", required=True)
+    parser.add_argument("--reference", required=True)
+    parser.add_argument("--model", default=WHISPER_MODEL_SIZE)
+    parser.add_argument("--beam-size", type=int, default=5)
+    parser.add_argument("--decode-interval", type=float, default=0.5)
+    parser.add_argument("--max-window", type=float, default=15.0)
+    parser.add_argument("--max-latency", type=float, default=4.0)
+    parser.add_argument(
+        "--mode", choices=["both", "streaming", "two-stage"], default="both"
+    )
+    args = parser.parse_args()
+
+    pcm = load_wav(args.audio)
+    duration = len(pcm) / SAMPLE_RATE
+    with open(args.reference, encoding="utf-8") as f:
+        reference = normalize_words(f.read())
+
+    model = load_whisper_model(args.model)
+    warmup_whisper_model(model)
+
+    logger.info(
+        f"{duration:.1f}s of audio, {len(reference)} reference words, "
+        f"whisper {args.model}"
+    )
+    # time to final word in seconds, rtf is the decoding time per audio time
+    logger.info(
+        f"{'mode':<12}{'wer %':>8}{'words':>8}"
+        f"{'p50 s':>10}{'p95 s':>10}{'max s':>10}{'rtf':>8}"
+    )
+    if args.mode in ["both", "two-stage"]:
+        result = run_two_stage(model, pcm, args.beam_size)
+        report("two-stage", result, reference, duration)
+    if args.mode in ["both", "streaming"]:
+        result = run_streaming(
+            model,
+            pcm,
+            args.decode_interval,
+            args.max_window,
+            args.max_latency,
+            args.beam_size,
+        )
+        report("streaming", result, reference, duration)
+
+
+if __name__ == "__main__":
+    main()
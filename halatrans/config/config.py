@@ -1,19 +1,23 @@
 import json
 from typing import Any, Tuple, Type
+
 from pydantic import Field
 from pydantic.fields import FieldInfo
-from pydantic_settings import (
-    BaseSettings,
-    EnvSettingsSource,
-    PydanticBaseSettingsSource,
-)
+from pydantic_settings import (BaseSettings, EnvSettingsSource,
+                               PydanticBaseSettingsSource)
 
 
 class HALACustomSource(EnvSettingsSource):
     def prepare_field_value(
         self, field_name: str, field: FieldInfo, value: Any, value_is_complex: bool
     ) -> Any:
-        if field_name in ["backend", "frontend"]:
+        if field_name in [
+            "backend",
+            "frontend",
+            "embedded",
+            "cpu_plan",
+            "whisper_streaming",
+        ]:
             if value == "true" or value == "True":
                 return True
             return False
@@ -22,7 +26,15 @@ class HALACustomSource(EnvSettingsSource):
 
 
 class Settings(BaseSettings):
-    mode: str = Field("dev", alias="mode") # dev | prod 
+    mode: str = Field("dev", alias="mode")  # dev | prod
+    # run the services as threads of the web process, see BaseServiceManager
+    embedded: bool = Field(False, alias="embedded")
+    # thread budget and cpu affinity per service process, see cpu_planner
+    cpu_plan: bool = Field(False, alias="cpu_plan")
+    # whisper transcribes the audio stream itself, see WhisperStreamService
+    whisper_streaming: bool = Field(False, alias="whisper_streaming")
+    # vosk | vad, how utterances are cut, see TranscribeService
+    transcribe_segmenter: str = Field("vosk", alias="transcribe_segmenter")
 
     @classmethod
     def settings_customise_sources(
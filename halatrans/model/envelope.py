@@ -0,0 +1,66 @@
+import time
+from typing import Any, Dict, Optional
+
+from google.protobuf.message import DecodeError
+
+from halatrans.model.envelope_pb2 import Envelope, MessageKind
+
+SCHEMA_VERSION = 1
+
+# status names of the web ui event stream
+KIND_STATUS: Dict[int, str] = {
+    MessageKind.PARTIAL: "partial",
+    MessageKind.FULLTEXT: "fulltext",
+    MessageKind.TRANSLATING: "translating",
+    MessageKind.TRANSLATION: "translate",
+    MessageKind.ASSISTANT: "assistant",
+}
+
+
+def encode_envelope(
+    kind: int,
+    msgid: str = "",
+    text: str = "",
+    translation: str = "",
+    ts: Optional[float] = None,
+) -> bytes:
+    envelope = Envelope(
+        schema_version=SCHEMA_VERSION,
+        kind=kind,
+        msgid=msgid,
+        text=text,
+        translation=translation,
+        ts=time.time() if ts is None else ts,
+    )
+    return envelope.SerializeToString()
+
+
+def decode_envelope(data: bytes) -> Envelope:
+    envelope = Envelope()
+    try:
+        envelope.ParseFromString(data)
+    except DecodeError as err:
+        raise ValueError(f"Invalid envelope. {err}")
+    if envelope.schema_version == 0:
+        raise ValueError("Invalid envelope, schema version is missing.")
+    if envelope.schema_version > SCHEMA_VERSION:
+        raise ValueError(
+            f"Unsupported envelope schema version {envelope.schema_version}."
+        )
+    return envelope
+
+
+def envelope_to_dict(envelope: Envelope) -> Dict[str, Any]:
+    """
+    Converts to the JSON item of the web ui event stream.
+    """
+    if envelope.kind == MessageKind.ASSISTANT:
+        return {"msg_type": "assistant", "assistant": {"text": envelope.text}}
+    item = {
+        "msgid": envelope.msgid,
+        "status": KIND_STATUS.get(envelope.kind, "unknown"),
+        "text": envelope.text,
+    }
+    if envelope.kind in (MessageKind.TRANSLATING, MessageKind.TRANSLATION):
+        item["translation"] = envelope.translation
+    return item
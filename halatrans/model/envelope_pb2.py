@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: envelope.proto
+# Protobuf Python Version: 5.26.1
+"""Generated protocol buffer code."""
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+from google.protobuf.internal import builder as _builder
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0e\x65nvelope.proto\x12\thalatrans\"\x86\x01\n\x08\x45nvelope\x12\x16\n\x0eschema_version\x18\x01 \x01(\r\x12$\n\x04kind\x18\x02 \x01(\x0e\x32\x16.halatrans.MessageKind\x12\r\n\x05msgid\x18\x03 \x01(\t\x12\x0c\n\x04text\x18\x04 \x01(\t\x12\x13\n\x0btranslation\x18\x05 \x01(\t\x12\n\n\x02ts\x18\x06 \x01(\x01*w\n\x0bMessageKind\x12\x1c\n\x18MESSAGE_KIND_UNSPECIFIED\x10\x00\x12\x0b\n\x07PARTIAL\x10\x01\x12\x0c\n\x08\x46ULLTEXT\x10\x02\x12\x0f\n\x0bTRANSLATING\x10\x03\x12\x0f\n\x0bTRANSLATION\x10\x04\x12\r\n\tASSISTANT\x10\x05\x62\x06proto3')
+
+_globals = globals()
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'envelope_pb2', _globals)
+if not _descriptor._USE_C_DESCRIPTORS:
+  DESCRIPTOR._loaded_options = None
+  _globals['_MESSAGEKIND']._serialized_start=166
+  _globals['_MESSAGEKIND']._serialized_end=285
+  _globals['_ENVELOPE']._serialized_start=30
+  _globals['_ENVELOPE']._serialized_end=164
+# @@protoc_insertion_point(module_scope)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Any, Dict, Optional
 
 from pydantic import BaseModel
 
@@ -10,3 +10,13 @@ class ServiceRequest(BaseModel):
 class AudioStreamControlRequest(BaseModel):
     cmd: str
     deviceIndex: Optional[int]
+
+
+class ServiceConfigRequest(BaseModel):
+    service: str
+    parameters: Dict[str, Any]
+
+
+class ModelSwapRequest(BaseModel):
+    service: str
+    model: str
@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import weakref
+from enum import Enum
+from typing import Dict, Optional, Tuple
+
+import zmq
+
+from halatrans.services.config import CONST_SERVICE_TCP_PORTS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Resolves logical "svc://<name>" addresses to transport endpoints.
+#
+#   ipc            ipc://<runtime dir>/<name>.sock, default on POSIX
+#   tcp            tcp://localhost:<fixed port>, see CONST_SERVICE_TCP_PORTS,
+#                  services without a fixed port (e.g. the replica pools of
+#                  work queue services) get an ephemeral port
+#   tcp-ephemeral  tcp://127.0.0.1:<port picked by the OS>
+#
+# The bound endpoint (zmq.LAST_ENDPOINT) is written to <runtime dir>/<name>
+# together with the pid of the binder, so connectors find ephemeral ports and
+# several pipelines can run on one host, each in its own namespace.
+#
+# connect_endpoint waits for the record of an ephemeral port with time.sleep,
+# a zmq.asyncio service awaits async_connect_endpoint (or
+# resolve_service_addr) before it connects, so the event loop keeps running.
+#
+# Every bind also binds inproc://, a socket created on the same context as
+# the binder connects through it instead of the host endpoint.
+#
+# Environment:
+#   HALATRANS_TRANSPORT       auto | ipc | tcp | tcp-ephemeral
+#   HALATRANS_NAMESPACE       isolates the endpoints of one pipeline
+#   HALATRANS_RUNTIME_DIR     where ipc sockets and records live
+#   HALATRANS_ADDR_<NAME>     explicit endpoint, e.g. for a remote service
+#                             HALATRANS_ADDR_AUDIO_STREAM=tcp://10.0.0.2:5101
+
+SERVICE_ADDR_SCHEME = "svc://"
+
+CONNECT_WAIT_TIMEOUT = 10.0  # seconds
+CONNECT_WAIT_INTERVAL = 0.05  # seconds
+
+
+class Transport(Enum):
+    IPC = "ipc"
+    TCP = "tcp"
+    TCP_EPHEMERAL = "tcp-ephemeral"
+
+
+def is_service_addr(addr: str) -> bool:
+    return addr.startswith(SERVICE_ADDR_SCHEME)
+
+
+def service_name(addr: str) -> str:
+    return addr[len(SERVICE_ADDR_SCHEME) :]
+
+
+def default_transport() -> Transport:
+    value = os.environ.get("HALATRANS_TRANSPORT", "auto")
+    if value == "auto":
+        # no Unix domain sockets in libzmq on Windows
+        return Transport.TCP if os.name == "nt" else Transport.IPC
+    try:
+        return Transport(value)
+    except ValueError:
+        raise ValueError(f"Unknown transport: {value}")
+
+
+class ServiceAddressRegistry:
+    def __init__(
+        self,
+        transport: Optional[Transport] = None,
+        namespace: Optional[str] = None,
+        runtime_dir: Optional[str] = None,
+    ):
+        self.transport = transport if transport else default_transport()
+        self.namespace = (
+            namespace if namespace else os.environ.get("HALATRANS_NAMESPACE", "default")
+        )
+        if runtime_dir is None:
+            runtime_dir = os.environ.get("HALATRANS_RUNTIME_DIR")
+        if runtime_dir is None:
+            runtime_dir = os.path.join(
+                tempfile.gettempdir(), f"halatrans-{self.namespace}"
+            )
+        self.runtime_dir = runtime_dir
+        # name -> context of the local binder
+        self.__inproc_binders__: Dict[str, weakref.ref] = {}
+
+    def __override__(self, name: str) -> Optional[str]:
+        key = "HALATRANS_ADDR_" + name.upper().replace("-", "_")
+        return os.environ.get(key)
+
+    def __record_path__(self, name: str) -> str:
+        return os.path.join(self.runtime_dir, name)
+
+    def inproc_endpoint(self, name: str) -> str:
+        return f"inproc://halatrans-{self.namespace}-{name}"
+
+    def __is_ephemeral__(self, name: str) -> bool:
+        if self.transport == Transport.TCP_EPHEMERAL:
+            return True
+        return self.transport == Transport.TCP and name not in CONST_SERVICE_TCP_PORTS
+
+    def bind_endpoint(self, name: str) -> str:
+        override = self.__override__(name)
+        if override:
+            if override.startswith("tcp://"):
+                # bind every interface, remote peers connect to the host
+                return "tcp://*:" + override.rsplit(":", 1)[-1]
+            return override
+
+        if self.transport == Transport.IPC:
+            os.makedirs(self.runtime_dir, exist_ok=True)
+            return f"ipc://{os.path.join(self.runtime_dir, name)}.sock"
+        if self.__is_ephemeral__(name):
+            # connectors find the port in the record of the binder
+            return "tcp://127.0.0.1:*"
+        return f"tcp://localhost:{CONST_SERVICE_TCP_PORTS[name]}"
+
+    def register(self, name: str, endpoint: str):
+        os.makedirs(self.runtime_dir, exist_ok=True)
+        # write then rename, a connector never sees a partial record
+        path = self.__record_path__(name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(f"{os.getpid()} {endpoint}")
+        os.replace(tmp_path, path)
+
+    def lookup(self, name: str) -> Optional[str]:
+        record = self.__read_record__(name)
+        if record is None:
+            return None
+        pid, endpoint = record
+        if not self.__is_alive__(pid):
+            # left behind by a binder that exited
+            return None
+        return endpoint
+
+    def __read_record__(self, name: str) -> Optional[Tuple[int, str]]:
+        try:
+            with open(self.__record_path__(name), "r", encoding="utf-8") as f:
+                pid, endpoint = f.read().split(" ", 1)
+            return int(pid), endpoint
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def __is_alive__(self, pid: int) -> bool:
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def __known_endpoint__(self, name: str) -> Optional[str]:
+        override = self.__override__(name)
+        if override:
+            return override
+
+        endpoint = self.lookup(name)
+        if endpoint:
+            return endpoint
+
+        if self.__is_ephemeral__(name):
+            # the port is only known once the binder registered it
+            return None
+
+        # ipc and fixed tcp endpoints are known in advance, zmq connects once
+        # the binder is up
+        return self.bind_endpoint(name).replace("tcp://*:", "tcp://localhost:")
+
+    def connect_endpoint(self, name: str, timeout: float = CONNECT_WAIT_TIMEOUT) -> str:
+        endpoint = self.__known_endpoint__(name)
+        deadline = time.time() + timeout
+        while endpoint is None and time.time() < deadline:
+            time.sleep(CONNECT_WAIT_INTERVAL)
+            endpoint = self.lookup(name)
+        if endpoint is None:
+            raise ValueError(f"Service {name} is not registered in {self.runtime_dir}")
+        return endpoint
+
+    async def async_connect_endpoint(
+        self, name: str, timeout: float = CONNECT_WAIT_TIMEOUT
+    ) -> str:
+        endpoint = self.__known_endpoint__(name)
+        deadline = time.time() + timeout
+        while endpoint is None and time.time() < deadline:
+            await asyncio.sleep(CONNECT_WAIT_INTERVAL)
+            endpoint = self.lookup(name)
+        if endpoint is None:
+            raise ValueError(f"Service {name} is not registered in {self.runtime_dir}")
+        return endpoint
+
+    def bind(self, sock: zmq.Socket, addr: str) -> str:
+        if not is_service_addr(addr):
+            sock.bind(addr)
+            return sock.getsockopt_string(zmq.LAST_ENDPOINT)
+
+        name = service_name(addr)
+        sock.bind(self.bind_endpoint(name))
+        endpoint = sock.getsockopt_string(zmq.LAST_ENDPOINT)
+        if endpoint.startswith("tcp://0.0.0.0:"):
+            endpoint = endpoint.replace("tcp://0.0.0.0:", "tcp://localhost:")
+        self.register(name, endpoint)
+
+        sock.bind(self.inproc_endpoint(name))
+        self.__inproc_binders__[name] = weakref.ref(sock.context)
+        logger.info(f"Bind service {name}: {endpoint}")
+        return endpoint
+
+    def connect(self, sock: zmq.Socket, addr: str) -> str:
+        if not is_service_addr(addr):
+            sock.connect(addr)
+            return addr
+
+        name = service_name(addr)
+        if self.__is_local__(name, sock.context):
+            endpoint = self.inproc_endpoint(name)
+        else:
+            endpoint = self.connect_endpoint(name)
+        sock.connect(endpoint)
+        return endpoint
+
+    def __is_local__(self, name: str, ctx: zmq.Context) -> bool:
+        ref = self.__inproc_binders__.get(name)
+        binder_ctx = ref() if ref else None
+        if binder_ctx is None or binder_ctx.closed:
+            return False
+        # a zmq.asyncio context may shadow the context of the binder
+        return binder_ctx.underlying == ctx.underlying
+
+
+__default_registry__: Optional[ServiceAddressRegistry] = None
+
+
+def get_address_registry() -> ServiceAddressRegistry:
+    global __default_registry__
+    if __default_registry__ is None:
+        __default_registry__ = ServiceAddressRegistry()
+    return __default_registry__
+
+
+def bind_service_socket(sock: zmq.Socket, addr: str) -> str:
+    return get_address_registry().bind(sock, addr)
+
+
+def connect_service_socket(sock: zmq.Socket, addr: str) -> str:
+    return get_address_registry().connect(sock, addr)
+
+
+async def resolve_service_addr(addr: str) -> str:
+    # Waits until the service of addr is registered, a socket connected to
+    # addr afterwards does not block. For sockets of zmq.asyncio services.
+    if not is_service_addr(addr):
+        return addr
+    return await get_address_registry().async_connect_endpoint(service_name(addr))
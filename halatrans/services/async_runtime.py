@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, List, Optional
+
+import zmq
+import zmq.asyncio
+
+from halatrans.services.context import create_async_context
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import async_recv_batch
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STOP_CHECK_INTERVAL = 0.2  # seconds
+
+MessageHandler = Callable[[zmq.Socket, List[Any]], Any]
+
+
+class AsyncServiceRuntime:
+    """
+    Event loop side of an asynchronous service worker.
+
+    Every subscribed socket gets its own reader task that wakes on socket
+    readiness, so one worker process can overlap socket I/O, blocking calls
+    pushed to the executor and timers. The stop flag is checked by a single
+    watcher task instead of on every message.
+    """
+
+    def __init__(self, stop_flag: ShutdownFlag, max_workers: Optional[int] = None):
+        self.stop_flag = stop_flag
+        self.ctx = create_async_context()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stopping = False
+        self.__stop_event__: Optional[asyncio.Event] = None
+        self.__tasks__: List[asyncio.Task] = []
+
+    def should_stop(self) -> bool:
+        return self.stopping
+
+    def __get_stop_event__(self) -> asyncio.Event:
+        if self.__stop_event__ is None:
+            self.__stop_event__ = asyncio.Event()
+        return self.__stop_event__
+
+    async def __watch_stop_flag__(self):
+        while not self.stopping:
+            if self.stop_flag.get() != 0:
+                self.stop()
+                break
+            await asyncio.sleep(STOP_CHECK_INTERVAL)
+
+    def stop(self):
+        self.stopping = True
+        self.__get_stop_event__().set()
+
+    async def wait_stopped(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self.__get_stop_event__().wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping
+
+    def spawn(self, coro: Awaitable[Any]) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.__tasks__.append(task)
+        return task
+
+    async def run_in_executor(self, fn: Callable[..., Any], *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def subscribe(
+        self, sock: zmq.asyncio.Socket, handler: MessageHandler, frames: bool = False
+    ) -> asyncio.Task:
+        # handler(sock, chunks) is called for every drained batch, it may be a
+        # coroutine function. Batches of one socket are handled in order.
+        async def reader():
+            while not self.stopping:
+                if await sock.poll(int(STOP_CHECK_INTERVAL * 1000)) == 0:
+                    continue
+                chunks = await async_recv_batch(sock, frames=frames)
+                self.stop_flag.on_message(len(chunks))
+                try:
+                    result = handler(sock, chunks)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as err:
+                    logger.error(err)
+
+        return self.spawn(reader())
+
+    def every(self, interval: float, callback: Callable[[], Any]) -> asyncio.Task:
+        async def timer():
+            while not await self.wait_stopped(interval):
+                try:
+                    result = callback()
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as err:
+                    logger.error(err)
+
+        return self.spawn(timer())
+
+    async def run(self):
+        # Runs until the stop flag is set, then waits for the spawned tasks.
+        watcher = asyncio.create_task(self.__watch_stop_flag__())
+        await self.wait_stopped()
+        await asyncio.gather(watcher, *self.__tasks__, return_exceptions=True)
+        self.__tasks__ = []
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.ctx.destroy(linger=0)
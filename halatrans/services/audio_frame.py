@@ -0,0 +1,189 @@
+import logging
+import struct
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import zmq
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Multipart wire format of an utterance on the transcribe "fulltext" topic:
+#
+#   frame 0: topic
+#   frame 1: header, AUDIO_FRAME_HEADER_STRUCT + utf-8 msgid
+#   frame 2..n: raw int16 PCM chunks, in capture order
+#
+# The PCM frames are never re-encoded, consumers can wrap them with
+# np.frombuffer without copying when they receive with copy=False.
+
+AUDIO_FRAME_VERSION = 1
+# version, seq, sample_rate, capture_start_ts, capture_end_ts, msgid_len
+AUDIO_FRAME_HEADER_STRUCT = struct.Struct("<BQIddH")
+
+FrameLike = Union[bytes, memoryview, zmq.Frame]
+
+INT16_MAX_ABS_VALUE = 32768.0
+
+
+@dataclass
+class AudioFrameHeader:
+    msgid: str
+    seq: int
+    sample_rate: int
+    capture_start_ts: float
+    capture_end_ts: float
+
+    def encode(self) -> bytes:
+        msgid = bytes(self.msgid, encoding="utf-8")
+        return (
+            AUDIO_FRAME_HEADER_STRUCT.pack(
+                AUDIO_FRAME_VERSION,
+                self.seq,
+                self.sample_rate,
+                self.capture_start_ts,
+                self.capture_end_ts,
+                len(msgid),
+            )
+            + msgid
+        )
+
+    @staticmethod
+    def decode(data: FrameLike) -> "AudioFrameHeader":
+        buffer = frame_buffer(data)
+        if len(buffer) < AUDIO_FRAME_HEADER_STRUCT.size:
+            raise ValueError(f"Audio frame header too short, size: {len(buffer)}")
+
+        version, seq, sample_rate, start_ts, end_ts, msgid_len = (
+            AUDIO_FRAME_HEADER_STRUCT.unpack_from(buffer)
+        )
+        if version != AUDIO_FRAME_VERSION:
+            raise ValueError(f"Unsupported audio frame version: {version}")
+
+        offset = AUDIO_FRAME_HEADER_STRUCT.size
+        msgid = str(buffer[offset : offset + msgid_len], encoding="utf-8")
+        return AudioFrameHeader(
+            msgid=msgid,
+            seq=seq,
+            sample_rate=sample_rate,
+            capture_start_ts=start_ts,
+            capture_end_ts=end_ts,
+        )
+
+
+def frame_buffer(frame: FrameLike) -> memoryview:
+    if isinstance(frame, zmq.Frame):
+        return frame.buffer
+    return memoryview(frame)
+
+
+def encode_audio_frames(
+    topic: bytes, header: AudioFrameHeader, pcm_chunks: Sequence[bytes]
+) -> List[bytes]:
+    return [topic, header.encode(), *pcm_chunks]
+
+
+def decode_audio_frames(
+    frames: Sequence[FrameLike],
+) -> Tuple[AudioFrameHeader, List[memoryview]]:
+    """
+    Decodes an utterance message, the topic frame must already be stripped.
+
+    Returns the header and one memoryview per PCM chunk, the views share
+    memory with the received frames.
+    """
+    if len(frames) == 0:
+        raise ValueError("Audio frames message is empty.")
+    header = AudioFrameHeader.decode(frames[0])
+    return header, [frame_buffer(frame) for frame in frames[1:]]
+
+
+def pcm_frame_view(frame: FrameLike) -> np.ndarray:
+    return np.frombuffer(frame_buffer(frame), dtype=np.int16)
+
+
+def send_audio_frames(
+    sock: zmq.Socket,
+    topic: bytes,
+    header: AudioFrameHeader,
+    pcm_chunks: Sequence[bytes],
+):
+    sock.send_multipart(encode_audio_frames(topic, header, pcm_chunks), copy=False)
+
+
+class SequenceGapDetector:
+    def __init__(self, name: str):
+        self.name = name
+        self.last_seq: Optional[int] = None
+        self.gap_count = 0
+        self.missing_count = 0
+
+    def check(self, seq: int) -> int:
+        """
+        Returns how many messages were lost before seq.
+
+        The first seq seen is taken as the baseline, since a subscriber that
+        joins late never received the earlier ones. A seq that goes backwards
+        means the publisher restarted, and it becomes the new baseline.
+        """
+        missing = 0
+        if self.last_seq is not None:
+            if seq > self.last_seq + 1:
+                missing = seq - self.last_seq - 1
+                self.gap_count += 1
+                self.missing_count += missing
+                logger.warning(
+                    f"[{self.name}] sequence gap, expect {self.last_seq + 1} got {seq}, missing: {missing}"
+                )
+            elif seq <= self.last_seq:
+                logger.info(f"[{self.name}] sequence reset {self.last_seq} -> {seq}")
+        self.last_seq = seq
+        return missing
+
+
+class AudioBuffer:
+    """
+    A growable float32 buffer that PCM frames are converted into, reused for
+    every utterance of a worker. Every int16 frame is scaled straight into
+    its final position by one numpy multiply, no intermediate arrays. The
+    buffer grows by doubling, after that an utterance allocates nothing.
+
+    The views returned by append() are valid until the next clear().
+    """
+
+    def __init__(self, capacity: int = 0):
+        self.__buffer__ = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+        self.grow_count = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.__buffer__)
+
+    def clear(self):
+        self.size = 0
+
+    def append(self, pcm_chunks: Sequence[FrameLike]) -> np.ndarray:
+        # the float32 samples of the chunks, a view into the buffer
+        start = self.size
+        # int16 samples
+        self.__reserve__(start + sum(frame_buffer(c).nbytes for c in pcm_chunks) // 2)
+        for chunk in pcm_chunks:
+            pcm = pcm_frame_view(chunk)
+            np.multiply(
+                pcm,
+                np.float32(1.0 / INT16_MAX_ABS_VALUE),
+                out=self.__buffer__[self.size : self.size + len(pcm)],
+            )
+            self.size += len(pcm)
+        return self.__buffer__[start : self.size]
+
+    def __reserve__(self, size: int):
+        if size <= self.capacity:
+            return
+        # views of the old buffer keep it alive, so they stay valid
+        buffer = np.empty(max(size, 2 * self.capacity), dtype=np.float32)
+        buffer[: self.size] = self.__buffer__[: self.size]
+        self.__buffer__ = buffer
+        self.grow_count += 1
@@ -0,0 +1,293 @@
+import collections
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from halatrans.services.process_task_manager import ProcessTaskManager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# how many scaling decisions are kept for the metrics
+DECISION_HISTORY = 50
+
+
+@dataclass
+class AutoscalerOptions:
+    check_interval: float = 2.0  # seconds
+    # queued items per replica that ask for one more replica
+    scale_up_backlog: float = 2.0
+    # how long the backlog stays that high before a replica is added
+    scale_up_after: float = 4.0
+    # how long a replica is idle on average before one is removed
+    scale_down_after: float = 30.0
+    # between two decisions of a service
+    cooldown: float = 10.0
+    # weight of the newest sample in the rates and the busy replicas
+    smoothing: float = 0.3
+
+
+@dataclass
+class ScalingDecision:
+    ts: float
+    service: str
+    replicas_from: int
+    replicas_to: int
+    reason: str
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "ts": self.ts,
+            "service": self.service,
+            "from": self.replicas_from,
+            "to": self.replicas_to,
+            "reason": self.reason,
+        }
+
+
+@dataclass
+class ScalableService:
+    service: str
+    dispatcher_task_id: str
+    replica_task_ids: List[str]
+    min_replicas: int
+    max_replicas: int
+    starting: int = 0  # replicas that did not ask for work yet
+    backlog: int = 0
+    in_flight: int = 0
+    busy: float = 0.0  # replicas with work, smoothed
+    input_rate: float = 0.0  # items per second
+    process_rate: float = 0.0
+    scale_ups: int = 0
+    scale_downs: int = 0
+    high_since: Optional[float] = None
+    low_since: Optional[float] = None
+    last_decision_ts: float = 0.0
+    last_input_count: Optional[int] = None
+    last_check_ts: float = 0.0
+    task_messages: Dict[str, int] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "service": self.service,
+            "replicas": len(self.replica_task_ids),
+            "minReplicas": self.min_replicas,
+            "maxReplicas": self.max_replicas,
+            "starting": self.starting,
+            "backlog": self.backlog,
+            "inFlight": self.in_flight,
+            "busy": round(self.busy, 2),
+            "inputRate": round(self.input_rate, 2),
+            "processRate": round(self.process_rate, 2),
+            "scaleUps": self.scale_ups,
+            "scaleDowns": self.scale_downs,
+        }
+
+
+class ServiceAutoscaler:
+    """
+    Grows and shrinks the replica pools of work queue services within
+    ServiceConfig.replicas and ServiceConfig.max_replicas, from a thread of
+    the manager process.
+
+    The dispatcher of a pool writes its backlog and the items in flight into
+    its heartbeat, the replicas count the items they processed. A backlog
+    that stays above scale_up_backlog per replica adds a replica, a replica
+    that stays idle on average is removed. A new replica asks the dispatcher
+    for work only after its models are loaded, the pool is not scaled again
+    until it did.
+    """
+
+    def __init__(
+        self,
+        task_manager: ProcessTaskManager,
+        lock: threading.RLock,
+        scale: Callable[[str, int], int],
+        options: Optional[AutoscalerOptions] = None,
+    ):
+        self.task_manager = task_manager
+        self.lock = lock
+        # sets the number of replicas of a service, returns the new number
+        self.scale = scale
+        self.options = options if options else AutoscalerOptions()
+        self.services: Dict[str, ScalableService] = {}
+        self.decisions: Deque[ScalingDecision] = collections.deque(
+            maxlen=DECISION_HISTORY
+        )
+        self.__stop_event__ = threading.Event()
+        self.__thread__: Optional[threading.Thread] = None
+
+    def watch(
+        self,
+        service: str,
+        dispatcher_task_id: str,
+        replica_task_ids: List[str],
+        min_replicas: int,
+        max_replicas: int,
+    ):
+        with self.lock:
+            self.services[service] = ScalableService(
+                service=service,
+                dispatcher_task_id=dispatcher_task_id,
+                replica_task_ids=list(replica_task_ids),
+                min_replicas=min_replicas,
+                max_replicas=max_replicas,
+            )
+
+    def set_replicas(self, service: str, replica_task_ids: List[str]):
+        with self.lock:
+            scalable = self.services.get(service)
+            if scalable is None:
+                return
+            scalable.replica_task_ids = list(replica_task_ids)
+            scalable.task_messages = {
+                task_id: count
+                for task_id, count in scalable.task_messages.items()
+                if task_id in replica_task_ids
+            }
+
+    def unwatch(self, service: str):
+        with self.lock:
+            self.services.pop(service, None)
+
+    def unwatch_all(self):
+        with self.lock:
+            self.services = {}
+
+    def start(self):
+        if self.__thread__ is not None:
+            return
+        self.__stop_event__.clear()
+        self.__thread__ = threading.Thread(
+            target=self.__run__, name="service-autoscaler", daemon=True
+        )
+        self.__thread__.start()
+
+    def stop(self):
+        if self.__thread__ is None:
+            return
+        self.__stop_event__.set()
+        self.__thread__.join()
+        self.__thread__ = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "services": [s.to_dict() for s in self.services.values()],
+                "decisions": [d.to_dict() for d in self.decisions],
+            }
+
+    def __run__(self):
+        logger.info("Service autoscaler start.")
+        while not self.__stop_event__.wait(self.options.check_interval):
+            try:
+                with self.lock:
+                    for scalable in list(self.services.values()):
+                        self.__update__(scalable, time.time())
+                        self.__check__(scalable, time.time())
+            except Exception as err:
+                logger.error(err)
+        logger.info("Service autoscaler end.")
+
+    def __smooth__(self, current: float, sample: float) -> float:
+        weight = self.options.smoothing
+        return (1 - weight) * current + weight * sample
+
+    def __update__(self, scalable: ScalableService, now: float):
+        heartbeat = self.task_manager.get_task_heartbeat(scalable.dispatcher_task_id)
+        if heartbeat is None:
+            return
+        scalable.backlog = heartbeat.backlog
+        scalable.in_flight = heartbeat.in_flight
+
+        processed = 0
+        starting = 0
+        for task_id in scalable.replica_task_ids:
+            replica = self.task_manager.get_task_heartbeat(task_id)
+            if replica is None or not self.task_manager.is_task_ready(task_id):
+                starting += 1
+                continue
+            # a restarted replica counts from zero again
+            last = scalable.task_messages.get(task_id, 0)
+            processed += max(replica.messages - last, 0)
+            scalable.task_messages[task_id] = replica.messages
+        scalable.starting = starting
+
+        replicas = max(len(scalable.replica_task_ids) - starting, 1)
+        busy = min(scalable.in_flight, replicas)
+        scalable.busy = self.__smooth__(scalable.busy, busy)
+        if scalable.last_input_count is not None and scalable.last_check_ts > 0:
+            elapsed = max(now - scalable.last_check_ts, 1e-6)
+            input_count = max(heartbeat.messages - scalable.last_input_count, 0)
+            scalable.input_rate = self.__smooth__(
+                scalable.input_rate, input_count / elapsed
+            )
+            scalable.process_rate = self.__smooth__(
+                scalable.process_rate, processed / elapsed
+            )
+        scalable.last_input_count = heartbeat.messages
+        scalable.last_check_ts = now
+
+    def __check__(self, scalable: ScalableService, now: float):
+        replicas = len(scalable.replica_task_ids)
+        if scalable.starting > 0:
+            # wait for the new replica before the next decision
+            scalable.high_since = None
+            scalable.low_since = None
+            return
+
+        backlog_per_replica = scalable.backlog / max(replicas, 1)
+        if backlog_per_replica >= self.options.scale_up_backlog:
+            scalable.low_since = None
+            if scalable.high_since is None:
+                scalable.high_since = now
+            if (
+                replicas < scalable.max_replicas
+                and now - scalable.high_since >= self.options.scale_up_after
+                and now - scalable.last_decision_ts >= self.options.cooldown
+            ):
+                self.__scale__(
+                    scalable,
+                    replicas + 1,
+                    f"backlog {scalable.backlog} for {replicas} replicas",
+                    now,
+                )
+            return
+
+        scalable.high_since = None
+        if scalable.backlog == 0 and scalable.busy < replicas - 1:
+            if scalable.low_since is None:
+                scalable.low_since = now
+            if (
+                replicas > scalable.min_replicas
+                and now - scalable.low_since >= self.options.scale_down_after
+                and now - scalable.last_decision_ts >= self.options.cooldown
+            ):
+                self.__scale__(
+                    scalable,
+                    replicas - 1,
+                    f"{scalable.busy:.1f} of {replicas} replicas busy",
+                    now,
+                )
+            return
+        scalable.low_since = None
+
+    def __scale__(
+        self, scalable: ScalableService, replicas: int, reason: str, now: float
+    ):
+        before = len(scalable.replica_task_ids)
+        after = self.scale(scalable.service, replicas)
+        scalable.last_decision_ts = now
+        scalable.high_since = None
+        scalable.low_since = None
+        if after == before:
+            return
+        if after > before:
+            scalable.scale_ups += 1
+        else:
+            scalable.scale_downs += 1
+        decision = ScalingDecision(now, scalable.service, before, after, reason)
+        self.decisions.append(decision)
+        logger.info(f"Scale {scalable.service} from {before} to {after}: {reason}")
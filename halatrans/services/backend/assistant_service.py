@@ -1,16 +1,20 @@
-import json
 import logging
 import os
 from dataclasses import dataclass
-from multiprocessing.managers import ValueProxy
 from typing import Any, Dict, List, Optional
 
 import zmq
 from openai import OpenAI
 
+from halatrans.model.envelope import (MessageKind, decode_envelope,
+                                      encode_envelope)
 from halatrans.services.base_service import CustomService, ServiceConfig
-from halatrans.services.utils import (create_pub_socket, create_sub_socket,
-                                      poll_messages)
+from halatrans.services.context import create_context
+from halatrans.services.live_parameters import LiveParameters
+from halatrans.services.qos import (QosPublisher, create_qos_publisher,
+                                    create_qos_sub_socket)
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import poll_messages
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,6 +26,8 @@ class AssistantServiceParameters:
     whisper_pub_topic: str
     assistant_pub_addr: str
     assistant_pub_topic: str
+    # number of the latest utterances the assistant analyzes
+    window_size: int = 5
 
 
 def openai_chat_completions(client: OpenAI, text: str) -> str:
@@ -47,7 +53,7 @@ def openai_chat_completions(client: OpenAI, text: str) -> str:
 # Do not use long sentence, response in short.
 def process_openai_assistant(
     client: OpenAI,
-    pub: zmq.Socket,
+    pub: QosPublisher,
     topic: bytes,
     all_messages: List[str],
 ):
@@ -65,13 +71,7 @@ Analyze the following conversation content, extract the main points using concis
     content = openai_chat_completions(client, all_texts)
     logger.info(content)
 
-    item = {
-        "msg_type": "assistant",
-        "assistant": {
-            "text": content,
-        },
-    }
-    pub.send_multipart([topic, bytes(json.dumps(item), encoding="utf-8")])
+    pub.send_multipart([topic, encode_envelope(MessageKind.ASSISTANT, text=content)])
 
 
 class AssistantService(CustomService):
@@ -79,17 +79,26 @@ class AssistantService(CustomService):
         super().__init__(config)
 
     @staticmethod
-    def on_worker_process_custom(
-        stop_flag: ValueProxy[int], parameters: Dict[str, Any]
-    ):
+    def get_parameters_type() -> Optional[type]:
+        return AssistantServiceParameters
+
+    @staticmethod
+    def get_live_parameters() -> List[str]:
+        return ["window_size"]
+
+    @staticmethod
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
         config = AssistantServiceParameters(**parameters)
         logger.info(f"AssistantService worker start. {config}")
 
-        ctx = zmq.Context()
-        whisper_sub = create_sub_socket(
+        ctx = create_context()
+        whisper_sub = create_qos_sub_socket(
             ctx, config.whisper_pub_addr, [config.whisper_pub_topic]
         )
-        assistant_pub = create_pub_socket(ctx, config.assistant_pub_addr)
+        assistant_pub = create_qos_publisher(
+            ctx, config.assistant_pub_addr, [config.assistant_pub_topic]
+        )
+        live = LiveParameters(ctx, stop_flag, AssistantService, parameters)
 
         api_key = os.getenv("OPENAI_API_KEY", "")
         client = OpenAI(api_key=api_key)
@@ -109,22 +118,26 @@ class AssistantService(CustomService):
                 nonlocal all_messages, assistant_pub, assistant_pub_topic
                 if len(chunks) == 0:
                     return
+                stop_flag.on_message(len(chunks))
+                live.poll()
 
+                count = len(all_messages)
                 for chunk in chunks:
-                    item = json.loads(chunk)
-                    # msgid = item["msgid"]
-                    # status = item["status"]
-                    text = item["text"]
-                    all_messages.append(text)
+                    item = decode_envelope(chunk)
+                    # streaming whisper also publishes the partials
+                    if item.kind == MessageKind.FULLTEXT:
+                        all_messages.append(item.text)
+                if len(all_messages) == count:
+                    return
 
                 # need update
-                SHIFT_WINDOW_SIZE = 5
-                if len(all_messages) > SHIFT_WINDOW_SIZE:
+                window_size = live.parameters["window_size"]
+                if len(all_messages) > window_size:
                     process_openai_assistant(
                         client,
                         assistant_pub,
                         assistant_pub_topic,
-                        all_messages[-SHIFT_WINDOW_SIZE:],
+                        all_messages[-window_size:],
                     )
                 else:
                     process_openai_assistant(
@@ -135,6 +148,7 @@ class AssistantService(CustomService):
         except Exception as err:
             logger.error(err)
         finally:
+            live.close()
             assistant_pub.close()
             whisper_sub.close()
             ctx.term()
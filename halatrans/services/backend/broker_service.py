@@ -0,0 +1,159 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import zmq
+
+from halatrans.services.base_service import CustomService, ServiceConfig
+from halatrans.services.context import create_context
+from halatrans.services.qos import (QOS_RETRY_INTERVAL_MS, TOPIC_QOS,
+                                    QosPublisher, partial_msgid)
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import attach_socket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BrokerServiceParameters:
+    # publishers connect to the XSUB side, subscribers to the XPUB side
+    xsub_addr: str
+    xpub_addr: str
+    capture_addr: Optional[str] = None
+    stats_interval: float = 60.0  # seconds
+
+
+class TopicStats:
+    def __init__(self):
+        self.message_count = 0
+        self.byte_count = 0
+        self.subscriber_count = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "messages": self.message_count,
+            "bytes": self.byte_count,
+            "subscribers": self.subscriber_count,
+        }
+
+
+class BrokerService(CustomService):
+    """
+    XSUB/XPUB forwarder of the backend message bus.
+
+    Services publish and subscribe through two well-known endpoints instead
+    of connecting to every publisher. It is a manual proxy rather than
+    zmq.proxy, so that traffic and subscriptions are counted per topic and
+    the TopicQos of every topic applies to the subscribers: a lossless topic
+    is held back for a slow subscriber up to its send timeout, a lossy one is
+    dropped or conflated, see halatrans/services/qos.py. The loop never
+    blocks on a subscriber, the other topics keep flowing.
+    """
+
+    def __init__(self, config: ServiceConfig):
+        super().__init__(config)
+
+    @staticmethod
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
+        config = BrokerServiceParameters(**parameters)
+        logger.info(f"BrokerService worker start. {config}")
+
+        ctx = create_context()
+        xsub = ctx.socket(zmq.XSUB)
+        attach_socket(xsub, config.xsub_addr, bind=True)
+        xpub = ctx.socket(zmq.XPUB)
+        # report every (un)subscription, not only the first and the last one
+        xpub.setsockopt(zmq.XPUB_VERBOSER, 1)
+
+        def conflation_key(frames: List[zmq.Frame]) -> Optional[str]:
+            # partials are conflated per msgid, as their publishers do
+            return partial_msgid(frames[1].bytes) if len(frames) > 1 else None
+
+        qos_pub = QosPublisher(
+            xpub, list(TOPIC_QOS.keys()), key_fn=conflation_key, blocking=False
+        )
+        attach_socket(xpub, config.xpub_addr, bind=True)
+        capture: Optional[zmq.Socket] = None
+        if config.capture_addr:
+            capture = ctx.socket(zmq.PUB)
+            attach_socket(capture, config.capture_addr, bind=True)
+
+        topic_stats: Dict[bytes, TopicStats] = {}
+
+        def get_stats(topic: bytes) -> TopicStats:
+            if topic not in topic_stats:
+                topic_stats[topic] = TopicStats()
+            return topic_stats[topic]
+
+        def log_stats():
+            qos_stats = qos_pub.stats
+            stats = {
+                str(k, encoding="utf-8", errors="replace"): {
+                    **v.to_dict(),
+                    **(qos_stats[k].to_dict() if k in qos_stats else {}),
+                }
+                for k, v in topic_stats.items()
+            }
+            logger.info(f"Broker topic stats: {stats}")
+
+        def forward_messages():
+            while True:
+                try:
+                    frames: List[zmq.Frame] = xsub.recv_multipart(
+                        zmq.DONTWAIT, copy=False
+                    )
+                except zmq.Again:
+                    break
+                stats = get_stats(frames[0].bytes)
+                stats.message_count += 1
+                stop_flag.on_message()
+                stats.byte_count += sum(len(frame) for frame in frames)
+                # frames are forwarded without copying
+                qos_pub.send_multipart(frames, copy=False)
+                if capture:
+                    capture.send_multipart(frames, copy=False)
+
+        def forward_subscriptions():
+            while True:
+                try:
+                    event = xpub.recv(zmq.DONTWAIT)
+                except zmq.Again:
+                    break
+                # b"\x01" + topic subscribes, b"\x00" + topic unsubscribes
+                if len(event) > 0:
+                    stats = get_stats(event[1:])
+                    stats.subscriber_count += 1 if event[0] == 1 else -1
+                xsub.send(event)
+
+        poller = zmq.Poller()
+        poller.register(xsub, zmq.POLLIN)
+        poller.register(xpub, zmq.POLLIN)
+
+        last_stats_ts = time.time()
+        try:
+            while stop_flag.get() == 0:
+                # held back messages wait for a slow subscriber to catch up
+                timeout = QOS_RETRY_INTERVAL_MS if qos_pub.has_pending() else 1000
+                events = dict(poller.poll(timeout))
+                qos_pub.flush()
+                if xpub in events:
+                    forward_subscriptions()
+                if xsub in events:
+                    forward_messages()
+
+                if time.time() - last_stats_ts > config.stats_interval:
+                    last_stats_ts = time.time()
+                    log_stats()
+        except Exception as err:
+            logger.error(err)
+        finally:
+            log_stats()
+            xsub.close(linger=0)
+            xpub.close(linger=0)
+            if capture:
+                capture.close(linger=0)
+            ctx.term()
+
+        logger.info("BrokerService worker end.")
@@ -3,14 +3,19 @@ import logging
 import queue
 import threading
 from dataclasses import dataclass
-from multiprocessing.managers import ValueProxy
 from typing import Any, Dict, List, Optional
 
 import zmq
+import zmq.asyncio
 
-from halatrans.services.base_service import CustomService, ServiceConfig
-from halatrans.services.utils import (create_pub_socket, create_sub_socket,
-                                      poll_messages)
+from halatrans.services.async_runtime import AsyncServiceRuntime
+from halatrans.services.base_service import AsyncCustomService, ServiceConfig
+from halatrans.services.context import create_async_context
+from halatrans.services.qos import (conflate_messages, create_qos_pub_socket,
+                                    create_qos_sub_socket, partial_msgid)
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import (async_poll_messages,
+                                      async_wait_connectable)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,15 +35,17 @@ class RTS2TServiceParameters:
     translation_pub_topic: str
     assistant_pub_addr: str
     assistant_pub_topic: str
+    # where the output is subscribed, output_pub_addr when it is not set
+    output_sub_addr: Optional[str] = None
 
 
-class RTS2TService(CustomService):
+class RTS2TService(AsyncCustomService):
     def __init__(self, config: ServiceConfig):
         super().__init__(config)
         self.__output_queue__ = queue.Queue(maxsize=OUTPUT_QUEUE_SIZE_LIMIT)
         self.__output_msg_thread__: Optional[threading.Thread] = None
 
-    def __init_output_msg_thread__(self, stop_flag: ValueProxy[int]):
+    def __init_output_msg_thread__(self, stop_flag: ShutdownFlag):
         if self.__output_msg_thread__ is not None:
             raise ValueError("output msg thread already exist.")
 
@@ -59,7 +66,7 @@ class RTS2TService(CustomService):
     def get_output_msg_queue(self) -> queue.Queue:
         return self.__output_queue__
 
-    def on_worker_process_launched(self, stop_flag: ValueProxy[int]):
+    def on_worker_process_launched(self, stop_flag: ShutdownFlag):
         super().on_worker_process_launched(stop_flag)
         self.__init_output_msg_thread__(stop_flag)
 
@@ -69,14 +76,18 @@ class RTS2TService(CustomService):
 
     @staticmethod
     async def __thread_task_handler__(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         output_queue: queue.Queue,
         config: RTS2TServiceParameters,
     ):
         logger.info(f"RTS2TService output msg thread start. {config}")
-        ctx = zmq.Context()
-        output_sub = create_sub_socket(
-            ctx, config.output_pub_addr, [config.output_pub_topic]
+        ctx = create_async_context()
+        output_sub_addr = (
+            config.output_sub_addr if config.output_sub_addr else config.output_pub_addr
+        )
+        await async_wait_connectable([output_sub_addr])
+        output_sub = create_qos_sub_socket(
+            ctx, output_sub_addr, [config.output_pub_topic]
         )
         try:
 
@@ -89,7 +100,7 @@ class RTS2TService(CustomService):
                 for chunk in chunks:
                     output_queue.put(chunk)
 
-            poll_messages([output_sub], message_handler, should_stop)
+            await async_poll_messages([output_sub], message_handler, should_stop)
         except Exception as err:
             logger.error(err)
         finally:
@@ -100,7 +111,7 @@ class RTS2TService(CustomService):
 
     @staticmethod
     async def __thread_main__(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         output_queue: queue.Queue,
         config: RTS2TServiceParameters,
     ):
@@ -111,69 +122,63 @@ class RTS2TService(CustomService):
 
     def __output_msg_thread_func__(
         self,
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         output_queue: queue.Queue,
         config: RTS2TServiceParameters,
     ):
         asyncio.run(RTS2TService.__thread_main__(stop_flag, output_queue, config))
 
     @staticmethod
-    def on_worker_process_custom(
-        stop_flag: ValueProxy[int], parameters: Dict[str, Any]
+    async def on_worker_process_async(
+        runtime: AsyncServiceRuntime, parameters: Dict[str, Any]
     ):
         config = RTS2TServiceParameters(**parameters)
         logger.info(f"RTS2TService worker start. {config}")
 
-        ctx = zmq.Context()
+        ctx = runtime.ctx
 
-        output_pub = create_pub_socket(ctx, config.output_pub_addr)
-        # output_pub.bind("tcp://*:0")
-        # Get the port that was assigned
-        # addr = socket.getsockopt(zmq.LAST_ENDPOINT).decode("utf-8")
-        # port = addr.split(":")[-1]
+        output_pub = create_qos_pub_socket(
+            ctx, config.output_pub_addr, [config.output_pub_topic]
+        )
+
+        await async_wait_connectable(
+            [
+                config.transcribe_pub_addr,
+                config.whisper_pub_addr,
+                config.translation_pub_addr,
+                config.assistant_pub_addr,
+            ]
+        )
 
-        transcribe_sub = create_sub_socket(
+        transcribe_sub = create_qos_sub_socket(
             ctx, config.transcribe_pub_addr, [config.transcribe_pub_partial_topic]
         )
-        whisper_sub = create_sub_socket(
+        whisper_sub = create_qos_sub_socket(
             ctx, config.whisper_pub_addr, [config.whisper_pub_topic]
         )
-        translation_sub = create_sub_socket(
+        translation_sub = create_qos_sub_socket(
             ctx, config.translation_pub_addr, [config.translation_pub_topic]
         )
-        assistant_sub = create_sub_socket(
+        assistant_sub = create_qos_sub_socket(
             ctx, config.assistant_pub_addr, [config.assistant_pub_topic]
         )
 
-        def should_stop() -> bool:
-            if stop_flag.get() != 0:
-                return True
-            return False
-
         bytes_topic = bytes(config.output_pub_topic, encoding="utf-8")
 
-        def message_handler(sock: zmq.Socket, chunks: List[bytes]):
-            nonlocal output_pub, bytes_topic
+        async def message_handler(sock: zmq.Socket, chunks: List[bytes]):
+            if sock is transcribe_sub:
+                # a drained batch may hold stale partials of an utterance
+                chunks = conflate_messages(chunks, partial_msgid)
             for chunk in chunks:
-                output_pub.send_multipart([bytes_topic, chunk])
-
-        poll_messages(
-            [
-                transcribe_sub,
-                whisper_sub,
-                translation_sub,
-                assistant_sub,
-            ],
-            message_handler,
-            should_stop,
-        )
+                await output_pub.send_multipart([bytes_topic, chunk])
 
-        # cleanup
-        assistant_sub.close()
-        transcribe_sub.close()
-        whisper_sub.close()
-        translation_sub.close()
-        output_pub.close()
-        ctx.term()
+        # every input is forwarded as soon as it is readable
+        for sub_sock in [transcribe_sub, whisper_sub, translation_sub, assistant_sub]:
+            runtime.subscribe(sub_sock, message_handler)
 
+    @staticmethod
+    async def on_worker_process_stopped(
+        runtime: AsyncServiceRuntime, parameters: Dict[str, Any]
+    ):
+        # sockets are closed with the runtime context
         logger.info("RTS2TService worker end.")
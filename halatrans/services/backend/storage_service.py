@@ -1,8 +1,5 @@
-import base64
-import json
 import logging
 from dataclasses import dataclass
-from multiprocessing.managers import ValueProxy
 from typing import Any, Dict, List, Optional
 
 import zmq
@@ -10,8 +7,14 @@ from sqlalchemy import Column, Integer, LargeBinary, String, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from halatrans.model.envelope import MessageKind, decode_envelope
+from halatrans.services.audio_frame import (SequenceGapDetector,
+                                            decode_audio_frames)
 from halatrans.services.base_service import CustomService, ServiceConfig
-from halatrans.services.utils import create_sub_socket, poll_messages
+from halatrans.services.context import create_context
+from halatrans.services.qos import create_qos_sub_socket
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import poll_messages
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -60,22 +63,22 @@ class StorageService(CustomService):
         super().__init__(config)
 
     @staticmethod
-    def on_worker_process_custom(
-        stop_flag: ValueProxy[int], parameters: Dict[str, Any]
-    ):
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
         config = StorageServiceParameters(**parameters)
         logger.info(f"StorageService worker start. {config}")
 
         Base.metadata.create_all(engine)
 
-        ctx = zmq.Context()
-        rawchunks_sub = create_sub_socket(
+        ctx = create_context()
+        rawchunks_sub = create_qos_sub_socket(
             ctx, config.transcribe_pub_addr, [config.transcribe_pub_fulltext_topic]
         )
-        translation_sub = create_sub_socket(
+        translation_sub = create_qos_sub_socket(
             ctx, config.translation_pub_addr, [config.translation_pub_topic]
         )
 
+        gap_detector = SequenceGapDetector("storage-fulltext")
+
         def should_top() -> bool:
             if stop_flag.get() != 0:
                 return True
@@ -83,41 +86,40 @@ class StorageService(CustomService):
 
         try:
 
-            def message_handler(sock: zmq.Socket, chunks: List[bytes]):
-                for chunk in chunks:
-                    data = json.loads(chunk)
-                    msgid = data["msgid"]
-                    status = data["status"]
-                    if status == "translate" and "translation" in data:
-                        text = data["text"]
-                        translation = data["translation"]
-                        newMsg = DBChatMessage(
-                            msgid=msgid,
-                            text=text,
-                            translation=translation,
-                        )
-                        session.add(newMsg)
-                    elif status == "fulltext" and "chunks" in data:
-                        # is from rawchunks_sub
-                        b64_chunks = data["chunks"]
-                        rawbytes = b"".join(
-                            [
-                                base64.b64decode(b64ecoded_text)
-                                for b64ecoded_text in b64_chunks
-                            ]
-                        )
+            def message_handler(sock: zmq.Socket, chunks: List[Any]):
+                stop_flag.on_message(len(chunks))
+                if sock is rawchunks_sub:
+                    # multipart audio frames from the fulltext topic
+                    for frames in chunks:
+                        header, pcm_chunks = decode_audio_frames(frames)
+                        gap_detector.check(header.seq)
                         newData = DBChatRawChunks(
-                            msgid=msgid,
-                            data=rawbytes,
+                            msgid=header.msgid,
+                            data=b"".join(pcm_chunks),
                         )
                         session.add(newData)
+                else:
+                    for chunk in chunks:
+                        data = decode_envelope(chunk)
+                        if data.kind == MessageKind.TRANSLATION:
+                            newMsg = DBChatMessage(
+                                msgid=data.msgid,
+                                text=data.text,
+                                translation=data.translation,
+                            )
+                            session.add(newMsg)
 
                 session.commit()
                 # msgs = session.query(DBChatMessage).all()
                 # for msg in msgs:
                 #     logger.info(msg)
 
-            poll_messages([rawchunks_sub, translation_sub], message_handler, should_top)
+            poll_messages(
+                [rawchunks_sub, translation_sub],
+                message_handler,
+                should_top,
+                frame_socks=[rawchunks_sub],
+            )
         except Exception as err:
             logger.error(err)
         finally:
@@ -1,23 +1,34 @@
-import base64
 import json
 import logging
+import time
 from dataclasses import dataclass
 # from dataclasses import dataclass
 from datetime import datetime
-from multiprocessing.managers import ValueProxy
 from typing import Any, Dict, List, Optional
 
+import numpy as np
 import vosk
 import zmq
 from vosk import KaldiRecognizer
 
+from halatrans.model.envelope import MessageKind, encode_envelope
+from halatrans.services.audio_frame import AudioFrameHeader, send_audio_frames
 from halatrans.services.base_service import CustomService, ServiceConfig
-from halatrans.services.utils import (create_pub_socket, create_sub_socket,
-                                      poll_messages)
+from halatrans.services.context import create_context
+from halatrans.services.live_parameters import LiveParameters
+from halatrans.services.model_cache import (HotSwapModel, is_model_loaded,
+                                            resolve_model_path)
+from halatrans.services.qos import create_qos_publisher, create_qos_sub_socket
+from halatrans.services.shm_ring_buffer import ShmRingSubscriber
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import poll_messages
+from halatrans.services.vad_segmenter import VadSegmenter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+VOSK_MODEL_NAME = "vosk-model-en-us-0.42-gigaspeech"
+
 
 @dataclass
 class TranscribeServiceParameters:
@@ -26,44 +37,124 @@ class TranscribeServiceParameters:
     transcribe_pub_addr: str
     transcribe_pub_partial_topic: str
     transcribe_pub_fulltext_topic: str
+    audio_shm_name: Optional[str] = None  # read audio from the local ring
+    model: str = VOSK_MODEL_NAME  # swapped while running, see HotSwapModel
+    # "vad" cuts the utterances by frame energy instead of a full vosk decode
+    segmenter: str = "vosk"
+    vad_partials: bool = False  # vosk partials of the utterances cut by vad
+    vad_end_silence: float = 0.5  # seconds of silence that end an utterance
+
+
+def load_vosk_model(model_name: str) -> vosk.Model:
+    model_path = resolve_model_path(model_name)
+    if model_path:
+        return vosk.Model(model_path=model_path)
+    return vosk.Model(model_name=model_name, lang="en-us")
+
+
+def warmup_vosk_model(model: vosk.Model):
+    recognizer = KaldiRecognizer(model, 16000)
+    # half a second of silence
+    recognizer.AcceptWaveform(bytes(16000))
+    recognizer.FinalResult()
 
 
 class TranscribeService(CustomService):
+    """
+    Recognizes the audio stream with vosk and cuts it into utterances. With
+    the "vad" segmenter the utterances are cut by frame energy, see
+    vad_segmenter.py, and vosk only runs for the optional partials.
+    Updating the model parameter loads the new model next to the running
+    one, the recognizer switches to it between two utterances.
+    """
+
     def __init__(self, config: ServiceConfig):
         super().__init__(config)
 
     @staticmethod
-    def on_worker_process_custom(
-        stop_flag: ValueProxy[int], parameters: Dict[str, Any]
-    ):
+    def check_model(name: str):
+        # a local model directory or a model vosk downloads by name
+        if resolve_model_path(name) is None and not name.startswith("vosk-model"):
+            raise ValueError(f"Unknown vosk model: {name}")
+
+    @staticmethod
+    def get_parameters_type() -> Optional[type]:
+        return TranscribeServiceParameters
+
+    @staticmethod
+    def get_live_parameters() -> List[str]:
+        return ["model", "vad_end_silence"]
+
+    @staticmethod
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
         config = TranscribeServiceParameters(**parameters)
         logger.info(f"TranscribeService worker start. {config}")
 
         sample_rate = 16000
+        worker_start_ts = time.time()
 
-        logger.info("Start init vosk...")
-        model = vosk.Model(
-            model_name="vosk-model-en-us-0.42-gigaspeech",
-            lang="en-us",
-        )
-        recognizer = KaldiRecognizer(model, sample_rate)
-        logger.info("Init vosk finish.")
+        segmenter: Optional[VadSegmenter] = None
+        if config.segmenter == "vad":
+            segmenter = VadSegmenter(sample_rate, end_silence=config.vad_end_silence)
+        elif config.segmenter != "vosk":
+            raise ValueError(f"Unknown segmenter {config.segmenter}.")
 
-        logger.info("Initial MQ")
+        ctx = create_context()
+        # subscribed before the model loads, no update during it is lost
+        live = LiveParameters(ctx, stop_flag, TranscribeService, parameters)
+
+        is_warm = False
+        models: Optional[HotSwapModel] = None
+        recognizer_model: Optional[vosk.Model] = None
+        recognizer: Optional[KaldiRecognizer] = None
+        if segmenter is None or config.vad_partials:
+            logger.info("Start init vosk...")
+            is_warm = is_model_loaded(config.model)
+            models = HotSwapModel(config.model, load_vosk_model, warmup_vosk_model)
+            recognizer_model = models.model
+            recognizer = KaldiRecognizer(recognizer_model, sample_rate)
+            logger.info("Init vosk finish.")
 
-        ctx = zmq.Context()
+        logger.info("Initial MQ")
 
-        transcribe_pub = create_pub_socket(ctx, config.transcribe_pub_addr)
-        audio_sub = create_sub_socket(
-            ctx, config.audio_pub_addr, [config.audio_pub_topic]
+        transcribe_pub = create_qos_publisher(
+            ctx,
+            config.transcribe_pub_addr,
+            [config.transcribe_pub_partial_topic, config.transcribe_pub_fulltext_topic],
         )
+        ring_sub: Optional[ShmRingSubscriber] = None
+        if config.audio_shm_name:
+            ring_sub = ShmRingSubscriber(
+                ctx,
+                config.audio_pub_addr,
+                config.audio_pub_topic,
+                config.audio_shm_name,
+            )
+            audio_socks = ring_sub.get_sockets()
+        else:
+            audio_sub = create_qos_sub_socket(
+                ctx, config.audio_pub_addr, [config.audio_pub_topic]
+            )
+            audio_socks = [audio_sub]
 
         logger.info("Transcribe service start handle message...")
 
         params: List[Optional[str]] = [None]  # msgid
         chunk_buff: List[bytes] = []
+        # utterance seq number and the capture time range of chunk_buff
+        fulltext_seq = 0
+        capture_ts: List[float] = [0.0, 0.0]
+        has_transcript = False
 
         def should_stop() -> bool:
+            if live.poll():
+                live_config = TranscribeServiceParameters(**live.parameters)
+                if models:
+                    models.swap(live_config.model)
+                if segmenter:
+                    segmenter.end_silence = live_config.vad_end_silence
+            # a partial conflated while the subscriber was slow
+            transcribe_pub.flush()
             if stop_flag.get() != 0:
                 return True
             return False
@@ -73,16 +164,54 @@ class TranscribeService(CustomService):
 
         try:
 
+            def start_utterance():
+                nonlocal recognizer, recognizer_model
+                # between two utterances, a swapped model takes over
+                if models and models.get() is not recognizer_model:
+                    recognizer_model = models.model
+                    recognizer = KaldiRecognizer(recognizer_model, sample_rate)
+
+                # TODO: gen id, and add ts to item
+                ts = int(datetime.timestamp(datetime.now()))
+                params[0] = f"msgid-{ts}-{fulltext_seq}"
+
+            def publish_fulltext(pcm_chunks: List[bytes]):
+                nonlocal fulltext_seq
+                header = AudioFrameHeader(
+                    msgid=params[0],
+                    seq=fulltext_seq,
+                    sample_rate=sample_rate,
+                    capture_start_ts=capture_ts[0],
+                    capture_end_ts=capture_ts[1],
+                )
+                send_audio_frames(transcribe_pub, fulltext_topic, header, pcm_chunks)
+                fulltext_seq += 1
+                params[0] = None
+
+            def publish_partial(text: str):
+                nonlocal has_transcript
+                msg_body = encode_envelope(
+                    MessageKind.PARTIAL, msgid=params[0], text=text
+                )
+                # a partial replaces the previous one of the utterance
+                transcribe_pub.send_multipart([partial_topic, msg_body], key=params[0])
+                if not has_transcript:
+                    has_transcript = True
+                    logger.info(
+                        f"First transcript {time.time() - worker_start_ts:.2f}s after worker start, {'warm' if is_warm else 'cold'} model."
+                    )
+
             def message_handler(sock: zmq.Socket, chunks: List[bytes]):
-                nonlocal chunk_buff, params, transcribe_pub
+                stop_flag.on_message(len(chunks))
 
-                if params[0] is None:
-                    # TODO: gen id, and add ts to item
-                    ts = int(datetime.timestamp(datetime.now()))
-                    params[0] = f"msgid-{ts}"
+                if ring_sub:
+                    chunks = ring_sub.read(sock, chunks)
 
                 # batch handle chunks
                 for chunk in chunks:
+                    # a batch may hold several endpoints
+                    if params[0] is None:
+                        start_utterance()
                     if recognizer.AcceptWaveform(chunk):
                         recognizer.Reset()
                         # TODO: use faster-whisper instead
@@ -90,43 +219,67 @@ class TranscribeService(CustomService):
                         # text = res["text"]
 
                         # output
-                        item = {
-                            "msgid": params[0],
-                            "status": "fulltext",
-                            "chunks": [
-                                base64.b64encode(item).decode("utf-8")
-                                for item in chunk_buff
-                            ],
-                        }
-
-                        msg_body = bytes(json.dumps(item), encoding="utf-8")
-                        transcribe_pub.send_multipart([fulltext_topic, msg_body])
+                        publish_fulltext(chunk_buff)
 
                         # reset
                         chunk_buff.clear()
-                        params[0] = None
                     else:
                         res = json.loads(recognizer.PartialResult())
                         text = res["partial"]
                         if len(text) > 2:
+                            # chunks carry no capture time, use arrival time
+                            now = time.time()
+                            if len(chunk_buff) == 0:
+                                capture_ts[0] = now
+                            capture_ts[1] = now
                             chunk_buff.append(chunk)
+                            publish_partial(text)
+
+            def vad_message_handler(sock: zmq.Socket, chunks: List[bytes]):
+                stop_flag.on_message(len(chunks))
 
-                            item = {
-                                "msgid": params[0],
-                                "status": "partial",
-                                "text": text,
-                            }
+                if ring_sub:
+                    chunks = ring_sub.read(sock, chunks)
 
-                            msg_body = bytes(json.dumps(item), encoding="utf-8")
-                            transcribe_pub.send_multipart([partial_topic, msg_body])
+                for chunk in chunks:
+                    if params[0] is None:
+                        start_utterance()
+                    # chunks carry no capture time, use arrival time
+                    now = time.time()
+                    if not segmenter.in_speech:
+                        capture_ts[0] = now
+                    capture_ts[1] = now
+                    segments = segmenter.accept(np.frombuffer(chunk, dtype=np.int16))
+                    for segment in segments:
+                        publish_fulltext([segment.audio.tobytes()])
+                        start_utterance()
+                        capture_ts[0] = now
+                    if recognizer is None:
+                        continue
+                    if len(segments) > 0:
+                        recognizer.Reset()
+                    # the segmenter ends the utterance, a vosk endpoint only
+                    # starts its partial text again
+                    if segmenter.in_speech and not recognizer.AcceptWaveform(chunk):
+                        text = json.loads(recognizer.PartialResult())["partial"]
+                        if len(text) > 2:
+                            publish_partial(text)
 
-            poll_messages([audio_sub], message_handler, should_stop)
+            poll_messages(
+                audio_socks,
+                vad_message_handler if segmenter else message_handler,
+                should_stop,
+            )
         except Exception as err:
             logger.error(err)
         finally:
             # cleanup
+            live.close()
             transcribe_pub.close()
-            audio_sub.close()
+            if ring_sub:
+                ring_sub.close()
+            else:
+                audio_sub.close()
             ctx.term()
 
         logger.info("TranscribeService worker end.")
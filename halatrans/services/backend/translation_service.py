@@ -5,15 +5,20 @@ import queue
 import threading
 import time
 from dataclasses import dataclass
-from multiprocessing.managers import ValueProxy
 from typing import Any, Dict, List, Optional
 
 import zmq
 from openai import OpenAI
 
+from halatrans.model.envelope import (MessageKind, decode_envelope,
+                                      encode_envelope)
 from halatrans.services.base_service import CustomService, ServiceConfig
-from halatrans.services.utils import (create_pub_socket, create_sub_socket,
-                                      poll_messages)
+from halatrans.services.context import create_context
+from halatrans.services.live_parameters import LiveParameters
+from halatrans.services.qos import (conflate_messages, create_qos_publisher,
+                                    create_qos_sub_socket, partial_msgid)
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import poll_messages
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,6 +32,8 @@ class TranslationServiceParameters:
     whisper_pub_topic: str
     translation_pub_addr: str
     translation_pub_topic: str
+    # seconds between two translations of partial texts
+    partial_translate_interval: float = 2.0
 
 
 prompt_sample_ask = """Translate below English texts into Chinese.
@@ -82,9 +89,10 @@ def openai_translate_text(client: OpenAI, text: str) -> str:
 
 
 def openai_translate_thread(
-    stop_flag: ValueProxy[int],
+    stop_flag: ShutdownFlag,
     input_queue: queue.Queue,
     output_queue: queue.Queue,
+    parameters: Dict[str, Any],
 ):
     api_key = os.getenv("OPENAI_API_KEY", "")
     if len(api_key) == 0:
@@ -105,41 +113,43 @@ def openai_translate_thread(
             pass
 
         if chunk:
-            item = json.loads(chunk)
-            msgid = item["msgid"]
-            status = item["status"]
-            text = item["text"]
-            if status == "fulltext":
+            item = decode_envelope(chunk)
+            msgid = item.msgid
+            text = item.text
+            if item.kind == MessageKind.FULLTEXT:
                 # translate fulltext, final result
                 translate_text = openai_translate_text(openai_client, text)
                 logger.info(
                     f"---- translation ----\n{text}\n---- translation ----\n{translate_text}\n---- end ----\n"
                 )
                 # output
-                translate_item = {
-                    "msgid": msgid,
-                    "status": "translate",
-                    "text": text,
-                    "translation": translate_text,
-                }
-                output_queue.put(json.dumps(translate_item))
-            elif status == "partial":
+                output_queue.put(
+                    encode_envelope(
+                        MessageKind.TRANSLATION,
+                        msgid=msgid,
+                        text=text,
+                        translation=translate_text,
+                    )
+                )
+            elif item.kind == MessageKind.PARTIAL:
                 # translate partial text
                 cur_partial_translate = time.time()
-                # perform 1 seconds
-                if cur_partial_translate - last_partial_translate > 2:
+                # the message loop updates the interval in place
+                interval = parameters["partial_translate_interval"]
+                if cur_partial_translate - last_partial_translate > interval:
                     translate_text = openai_translate_text(openai_client, text)
                     # logger.info(
                     #     f"---- translation ----\n{text}\n---- translation ----\n{translate_text}\n---- end ----\n"
                     # )
                     # output
-                    translate_item = {
-                        "msgid": msgid,
-                        "status": "translating",
-                        "text": text,
-                        "translation": translate_text,
-                    }
-                    output_queue.put(json.dumps(translate_item))
+                    output_queue.put(
+                        encode_envelope(
+                            MessageKind.TRANSLATING,
+                            msgid=msgid,
+                            text=text,
+                            translation=translate_text,
+                        )
+                    )
                     # update ts
                     last_partial_translate = time.time()
         else:
@@ -147,29 +157,29 @@ def openai_translate_thread(
 
 
 def translation_pub_thread(
-    stop_flag: ValueProxy[int],
+    stop_flag: ShutdownFlag,
     input_queue: queue.Queue,
     translation_pub_addr: str,
     translation_pub_topic: str,
 ):
-    ctx = zmq.Context()
-    translation_pub = create_pub_socket(ctx, translation_pub_addr)
+    ctx = create_context()
+    translation_pub = create_qos_publisher(
+        ctx, translation_pub_addr, [translation_pub_topic]
+    )
     bytes_topic = bytes(translation_pub_topic, encoding="utf-8")
 
     while True:
         if stop_flag.get() != 0:
             break
 
-        chunk: Optional[str] = None
+        chunk: Optional[bytes] = None
         try:
             chunk = input_queue.get(block=False)
         except queue.Empty:
             pass
 
         if chunk:
-            translation_pub.send_multipart(
-                [bytes_topic, bytes(chunk, encoding="utf-8")]
-            )
+            translation_pub.send_multipart([bytes_topic, chunk])
         else:
             time.sleep(0.1)
     # cleanup
@@ -182,19 +192,26 @@ class TranslationService(CustomService):
         super().__init__(config)
 
     @staticmethod
-    def on_worker_process_custom(
-        stop_flag: ValueProxy[int], parameters: Dict[str, Any]
-    ):
+    def get_parameters_type() -> Optional[type]:
+        return TranslationServiceParameters
+
+    @staticmethod
+    def get_live_parameters() -> List[str]:
+        return ["partial_translate_interval"]
+
+    @staticmethod
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
         config = TranslationServiceParameters(**parameters)
         logger.info(f"TranslationService worker start. {config}")
 
-        ctx = zmq.Context()
-        whisper_sub = create_sub_socket(
+        ctx = create_context()
+        whisper_sub = create_qos_sub_socket(
             ctx, config.whisper_pub_addr, [config.whisper_pub_topic]
         )
-        transcribe_sub = create_sub_socket(
+        transcribe_sub = create_qos_sub_socket(
             ctx, config.transcribe_pub_addr, [config.transcribe_pub_partial_topic]
         )
+        live = LiveParameters(ctx, stop_flag, TranslationService, parameters)
 
         # start openai thread
         logger.info("Start openai translate thread.")
@@ -203,9 +220,11 @@ class TranslationService(CustomService):
         openai_thread = threading.Thread(
             target=openai_translate_thread,
             args=(
-                stop_flag,
+                # only the message loop beats for the task
+                stop_flag.observer(),
                 input_queue,
                 output_queue,
+                live.parameters,
             ),
         )
         openai_thread.daemon = True
@@ -215,7 +234,7 @@ class TranslationService(CustomService):
         pub_thread = threading.Thread(
             target=translation_pub_thread,
             args=(
-                stop_flag,
+                stop_flag.observer(),
                 output_queue,
                 config.translation_pub_addr,
                 config.translation_pub_topic,
@@ -235,6 +254,11 @@ class TranslationService(CustomService):
 
             def messages_handler(sock: zmq.Socket, chunks: List[bytes]):
                 nonlocal input_queue
+                stop_flag.on_message(len(chunks))
+                live.poll()
+                if sock is transcribe_sub:
+                    # only the latest partial of an utterance is translated
+                    chunks = conflate_messages(chunks, partial_msgid)
                 for chunk in chunks:
                     # item = json.loads(chunk)
                     # msgid = item["msgid"]
@@ -249,6 +273,7 @@ class TranslationService(CustomService):
             openai_thread.join()
             pub_thread.join()
 
+            live.close()
             whisper_sub.close()
             transcribe_sub.close()
             ctx.term()
@@ -1,24 +1,39 @@
-import base64
-import json
 import logging
 import os
 from dataclasses import dataclass
-from multiprocessing.managers import ValueProxy
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import numpy as np
-import zmq
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, available_models
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 
-from halatrans.services.base_service import CustomService, ServiceConfig
-from halatrans.services.utils import (create_pub_socket, create_sub_socket,
-                                      poll_messages)
+from halatrans.model.envelope import MessageKind, encode_envelope
+from halatrans.services.audio_frame import (AudioBuffer, AudioFrameHeader,
+                                            SequenceGapDetector,
+                                            decode_audio_frames)
+from halatrans.services.base_service import ServiceConfig
+from halatrans.services.cpu_planner import get_cpu_threads
+from halatrans.services.model_cache import (HotSwapModel, get_model_dir,
+                                            resolve_model_path)
+from halatrans.services.work_queue import (OutputMessages, WorkQueueEndpoints,
+                                           WorkQueueService)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 INT16_MAX_ABS_VALUE = 32768.0
 MIN_TEXT_LEN = 2
+WHISPER_MODEL_SIZE = "tiny.en"
+WHISPER_COMPUTE_TYPE = "float32"
+WHISPER_LANGUAGE = "en"
+SAMPLE_RATE = 16000
+# one encoder window, longer utterances are decoded on their own
+BATCH_MAX_UTTERANCE = 30.0  # seconds
+MAX_TEXT_TOKENS = 448
+# the silence filter of transcribe(), for the batched decodes
+NO_SPEECH_THRESHOLD = 0.6
+LOG_PROB_THRESHOLD = -1.0
 
 
 @dataclass
@@ -27,27 +42,33 @@ class WhisperServiceParameters:
     transcribe_pub_fulltext_topic: str
     whisper_pub_addr: str
     whisper_pub_topic: str
+    model: str = WHISPER_MODEL_SIZE  # swapped while running, see HotSwapModel
+    # int8 quantization is several times faster on cpu than float32
+    compute_type: str = WHISPER_COMPUTE_TYPE
+    num_workers: int = 1  # concurrent decodes of one model
+    beam_size: int = 5
+    language: Optional[str] = WHISPER_LANGUAGE  # None detects it per utterance
+    vad_filter: bool = True
+    vad_min_silence_duration_ms: int = 500
+    # seconds of audio decoded in one batch, see ReplicaOptions.max_batch
+    batch_max_audio: float = 60.0
 
 
-def process_faster_whisper_transcribe(
+def transcribe_texts(
     faster_whipser: WhisperModel,
-    msgid: str,
-    frame_buffer: List[np.ndarray],
-    whisper_pub: zmq.Socket,
-    whisper_pub_topic: bytes,
-):
-    if len(frame_buffer) == 0:
-        return
-
-    combined_frames = np.concatenate(frame_buffer)
-
+    audio: np.ndarray,
+    beam_size: int = 5,
+    language: Optional[str] = WHISPER_LANGUAGE,
+    vad_filter: bool = True,
+    vad_min_silence_duration_ms: int = 500,
+) -> List[str]:
     segments, info = faster_whipser.transcribe(
-        combined_frames,
-        beam_size=5,
-        language="en",
+        audio,
+        beam_size=beam_size,
+        language=language,
         condition_on_previous_text=False,
-        vad_filter=True,
-        vad_parameters=dict(min_silence_duration_ms=500),
+        vad_filter=vad_filter,
+        vad_parameters=dict(min_silence_duration_ms=vad_min_silence_duration_ms),
     )
     texts = []
     for segment in segments:
@@ -55,90 +76,337 @@ def process_faster_whisper_transcribe(
         # logger.info(f"[{segment.start:.2f}s -> {segment.end:.2f}s] {text}")
         if len(text) > MIN_TEXT_LEN:
             texts.append(text)
+    return texts
+
+
+def process_faster_whisper_transcribe(
+    faster_whipser: WhisperModel,
+    msgid: str,
+    frame_buffer: List[np.ndarray],
+    beam_size: int = 5,
+    language: Optional[str] = WHISPER_LANGUAGE,
+    vad_filter: bool = True,
+    vad_min_silence_duration_ms: int = 500,
+) -> Optional[bytes]:
+    if len(frame_buffer) == 0:
+        return None
+
+    if len(frame_buffer) == 1:
+        combined_frames = frame_buffer[0]
+    else:
+        combined_frames = np.concatenate(frame_buffer)
+    texts = transcribe_texts(
+        faster_whipser,
+        combined_frames,
+        beam_size=beam_size,
+        language=language,
+        vad_filter=vad_filter,
+        vad_min_silence_duration_ms=vad_min_silence_duration_ms,
+    )
+    return encode_fulltext(msgid, texts)
+
 
+def encode_fulltext(msgid: str, texts: List[str]) -> Optional[bytes]:
     # update ui
-    if len(texts) > 0:
-        fulltext = " ".join(texts).strip()
-        arr = fulltext.split(". ")
-        fulltext = ".\n".join([s.strip() for s in arr])
-        logger.info(f"\n--- {msgid} ---\n{fulltext}\n--- end ---\n")
-        item = {
-            "msgid": msgid,
-            "status": "fulltext",
-            "text": fulltext,
-        }
-        msg_body = bytes(json.dumps(item), encoding="utf-8")
-        whisper_pub.send_multipart([whisper_pub_topic, msg_body])
-
-
-class WhisperService(CustomService):
+    if len(texts) == 0:
+        return None
+
+    fulltext = " ".join(texts).strip()
+    arr = fulltext.split(". ")
+    fulltext = ".\n".join([s.strip() for s in arr])
+    logger.info(f"\n--- {msgid} ---\n{fulltext}\n--- end ---\n")
+    return encode_envelope(MessageKind.FULLTEXT, msgid=msgid, text=fulltext)
+
+
+def speech_audio(audio: np.ndarray, min_silence_duration_ms: int) -> np.ndarray:
+    # the speech chunks found by the VAD filter of transcribe(), empty when
+    # there is none
+    chunks = get_speech_timestamps(
+        audio, VadOptions(min_silence_duration_ms=min_silence_duration_ms)
+    )
+    if len(chunks) == 0:
+        return audio[:0]
+    return np.concatenate([audio[c["start"] : c["end"]] for c in chunks])
+
+
+def process_faster_whisper_batch(
+    faster_whipser: WhisperModel,
+    audios: List[np.ndarray],
+    beam_size: int = 5,
+    language: Optional[str] = WHISPER_LANGUAGE,
+    vad_filter: bool = True,
+    vad_min_silence_duration_ms: int = 500,
+) -> List[List[str]]:
+    """
+    Decodes utterances of up to one 30s window together, with one encoder
+    and one decoder call of CTranslate2 for the whole batch. Returns the
+    texts of every utterance. Silence is filtered like transcribe() does:
+    the VAD filter before and the no-speech probability after the decode.
+    """
+    if vad_filter:
+        audios = [speech_audio(a, vad_min_silence_duration_ms) for a in audios]
+    texts: List[List[str]] = [[] for _ in audios]
+    speech = [idx for idx, audio in enumerate(audios) if len(audio) > 0]
+    if len(speech) == 0:
+        return texts
+
+    extractor = faster_whipser.feature_extractor
+    n_frames = extractor.nb_max_frames
+    features = []
+    for idx in speech:
+        feature = extractor(audios[idx])[:, :n_frames]
+        pad = n_frames - feature.shape[-1]
+        features.append(np.pad(feature, ((0, 0), (0, pad))) if pad > 0 else feature)
+    encoder_output = faster_whipser.encode(np.stack(features))
+
+    is_multilingual = faster_whipser.model.is_multilingual
+    if language is None and is_multilingual:
+        # the most probable language token of every utterance, e.g. <|en|>
+        languages = [
+            result[0][0][2:-2]
+            for result in faster_whipser.model.detect_language(encoder_output)
+        ]
+    else:
+        languages = [language or WHISPER_LANGUAGE] * len(speech)
+    tokenizers: Dict[str, Tokenizer] = {}
+    for lang in languages:
+        if lang not in tokenizers:
+            tokenizers[lang] = Tokenizer(
+                faster_whipser.hf_tokenizer,
+                is_multilingual,
+                task="transcribe",
+                language=lang,
+            )
+    prompts = [
+        list(tokenizers[lang].sot_sequence) + [tokenizers[lang].no_timestamps]
+        for lang in languages
+    ]
+    results = faster_whipser.model.generate(
+        encoder_output,
+        prompts,
+        beam_size=beam_size,
+        max_length=MAX_TEXT_TOKENS,
+        suppress_blank=True,
+        return_scores=True,
+        return_no_speech_prob=True,
+    )
+    for idx, lang, result in zip(speech, languages, results):
+        tokens = result.sequences_ids[0]
+        # the score is the log probability normalized by the token count
+        avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+        if (
+            result.no_speech_prob > NO_SPEECH_THRESHOLD
+            and avg_logprob < LOG_PROB_THRESHOLD
+        ):
+            continue
+        text = tokenizers[lang].decode(tokens).strip()
+        if len(text) > MIN_TEXT_LEN:
+            texts[idx] = [text]
+    return texts
+
+
+def load_whisper_model(
+    model_size: str,
+    compute_type: str = WHISPER_COMPUTE_TYPE,
+    num_workers: int = 1,
+) -> WhisperModel:
+    # a local model directory, otherwise downloaded by size into the model dir
+    model_path = resolve_model_path(f"faster-whisper-{model_size}")
+    return WhisperModel(
+        model_path if model_path else model_size,
+        device="cpu",
+        compute_type=compute_type,
+        # all cores without a cpu plan
+        cpu_threads=get_cpu_threads(),
+        num_workers=num_workers,
+        download_root=get_model_dir(),
+    )
+
+
+def check_whisper_model(model_size: str):
+    # the sources of load_whisper_model: a local model directory, a known
+    # size or a huggingface repo id
+    if resolve_model_path(f"faster-whisper-{model_size}") or os.path.isdir(model_size):
+        return
+    if model_size not in available_models() and "/" not in model_size:
+        raise ValueError(
+            f"Unknown whisper model: {model_size}, one of {available_models()}"
+        )
+
+
+def warmup_whisper_model(model: WhisperModel):
+    # one second of low noise, the segments generator runs the decoder
+    rng = np.random.default_rng(0)
+    audio = rng.normal(0, 0.01, 16000).astype(np.float32)
+    segments, _ = model.transcribe(audio, beam_size=1, language="en")
+    for _ in segments:
+        pass
+
+
+def create_whisper_model(
+    model_size: str, compute_type: str, num_workers: int
+) -> HotSwapModel:
+    # the same model size loaded with other settings is another model
+    return HotSwapModel(
+        model_size,
+        lambda name: load_whisper_model(name, compute_type, num_workers),
+        warmup_whisper_model,
+        key_prefix=f"faster-whisper-{compute_type}-{num_workers}-",
+    )
+
+
+@dataclass
+class WhisperWorkerState:
+    models: HotSwapModel
+    # float32 audio of the utterances in progress, reused by every utterance
+    audio: AudioBuffer
+
+
+class WhisperService(WorkQueueService):
+    """
+    Transcribes every utterance of the transcribe fulltext topic with faster
+    whisper. Set ServiceConfig.replicas to decode utterances in parallel.
+    Updating the model parameter loads the new model next to the running
+    one in every worker, the next utterance after its warm-up uses it.
+    compute_type and num_workers take effect when the service restarts.
+    """
+
     def __init__(self, config: ServiceConfig):
         super().__init__(config)
 
     @staticmethod
-    def on_worker_process_custom(
-        stop_flag: ValueProxy[int], parameters: Dict[str, Any]
-    ):
+    def check_model(name: str):
+        check_whisper_model(name)
+
+    @staticmethod
+    def get_parameters_type() -> Optional[type]:
+        return WhisperServiceParameters
+
+    @staticmethod
+    def get_live_parameters() -> List[str]:
+        return [
+            "model",
+            "beam_size",
+            "language",
+            "vad_filter",
+            "vad_min_silence_duration_ms",
+            "batch_max_audio",
+        ]
+
+    @staticmethod
+    def get_work_queue_endpoints(parameters: Dict[str, Any]) -> WorkQueueEndpoints:
+        config = WhisperServiceParameters(**parameters)
+        return WorkQueueEndpoints(
+            input_addr=config.transcribe_pub_addr,
+            input_topics=[config.transcribe_pub_fulltext_topic],
+            output_addr=config.whisper_pub_addr,
+            output_topics=[config.whisper_pub_topic],
+        )
+
+    @staticmethod
+    def create_input_monitor(
+        parameters: Dict[str, Any],
+    ) -> Optional[Callable[[List[Any]], None]]:
+        gap_detector = SequenceGapDetector("whisper-fulltext")
+
+        def check_seq(frames: List[Any]):
+            header = AudioFrameHeader.decode(frames[0])
+            gap_detector.check(header.seq)
+
+        return check_seq
+
+    @staticmethod
+    def on_worker_setup(parameters: Dict[str, Any]) -> Any:
         config = WhisperServiceParameters(**parameters)
         logger.info(f"WhisperService worker start. {config}")
 
         logger.info("Init faster whisper")
         os.environ["KMP_DUPLICATE_LIB_OK"] = "True"
-        model_size = "tiny.en"
-        faster_whipser = WhisperModel(
-            model_size,
-            device="cpu",
-            compute_type="float32",
-            cpu_threads=0,
-            num_workers=1,
+        faster_whipser = create_whisper_model(
+            config.model, config.compute_type, config.num_workers
         )
-
-        logger.info("Initial MQ")
-        ctx = zmq.Context()
-        whisper_pub = create_pub_socket(ctx, config.whisper_pub_addr)
-        transcribe_sub = create_sub_socket(
-            ctx, config.transcribe_pub_addr, [config.transcribe_pub_fulltext_topic]
+        logger.info("Whisper service start handle message...")
+        return WhisperWorkerState(
+            models=faster_whipser,
+            audio=AudioBuffer(int(BATCH_MAX_UTTERANCE * SAMPLE_RATE)),
         )
 
-        logger.info("Whisper service start handle message...")
+    @staticmethod
+    def on_worker_parameters_updated(state: Any, parameters: Dict[str, Any]):
+        config = WhisperServiceParameters(**parameters)
+        state.models.swap(config.model)
+
+    @classmethod
+    def on_worker_process_batch(
+        cls, state: Any, parameters: Dict[str, Any], items: List[List[Any]]
+    ) -> List[OutputMessages]:
+        config = WhisperServiceParameters(**parameters)
+        topic = bytes(config.whisper_pub_topic, encoding="utf-8")
+        outputs: List[OutputMessages] = [[] for _ in items]
+        model = state.models.get()
+
+        # batches of utterances up to batch_max_audio seconds
+        batches: List[List[Tuple[int, str, np.ndarray]]] = [[]]
+        batch_audio = 0.0
+        long_items: List[int] = []
+        state.audio.clear()
+        for idx, frames in enumerate(items):
+            header, pcm_chunks = decode_audio_frames(frames)
+            # int16 samples
+            duration = sum(c.nbytes for c in pcm_chunks) / 2 / SAMPLE_RATE
+            if duration == 0:
+                continue
+            if duration > BATCH_MAX_UTTERANCE:
+                long_items.append(idx)
+                continue
+            if len(batches[-1]) > 0 and batch_audio + duration > config.batch_max_audio:
+                batches.append([])
+                batch_audio = 0.0
+            batches[-1].append((idx, header.msgid, state.audio.append(pcm_chunks)))
+            batch_audio += duration
+
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            texts = process_faster_whisper_batch(
+                model,
+                [audio for _, _, audio in batch],
+                beam_size=config.beam_size,
+                language=config.language,
+                vad_filter=config.vad_filter,
+                vad_min_silence_duration_ms=config.vad_min_silence_duration_ms,
+            )
+            for (idx, msgid, _), utterance_texts in zip(batch, texts):
+                msg_body = encode_fulltext(msgid, utterance_texts)
+                if msg_body is not None:
+                    outputs[idx] = [[topic, msg_body]]
 
-        def should_stop() -> bool:
-            if stop_flag.get() != 0:
-                return True
-            return False
-
-        whisper_pub_topic = bytes(config.whisper_pub_topic, encoding="utf-8")
-
-        try:
-
-            def messages_handler(sock: zmq.Socket, chunks: List[bytes]):
-                for chunk in chunks:
-                    item = json.loads(chunk)
-                    msgid = item["msgid"]
-                    b64_chunks = item["chunks"]
-                    frame_buffer: List[np.ndarray] = []
-                    for b64ecoded_text in b64_chunks:
-                        chunk_bytes = base64.b64decode(b64ecoded_text)
-
-                        frame = np.frombuffer(chunk_bytes, dtype=np.int16)
-                        audio_array = frame.astype(np.float32) / INT16_MAX_ABS_VALUE
-                        frame_buffer.append(audio_array)
-                    # use faster whisper to transcribe audio to text
-                    process_faster_whisper_transcribe(
-                        faster_whipser=faster_whipser,
-                        msgid=msgid,
-                        frame_buffer=frame_buffer,
-                        whisper_pub=whisper_pub,
-                        whisper_pub_topic=whisper_pub_topic,
-                    )
-
-            poll_messages([transcribe_sub], messages_handler, should_stop)
-        except Exception as err:
-            logger.error(err)
-        finally:
-            # cleanup
-            whisper_pub.close()
-            transcribe_sub.close()
-            ctx.term()
-
-        logger.info("WhisperService worker end.")
+        # after the batches, they share the audio buffer
+        for idx in long_items:
+            outputs[idx] = cls.on_worker_process_item(state, parameters, items[idx])
+        return outputs
+
+    @staticmethod
+    def on_worker_process_item(
+        state: Any, parameters: Dict[str, Any], frames: List[Any]
+    ) -> OutputMessages:
+        header, pcm_chunks = decode_audio_frames(frames)
+        if len(pcm_chunks) == 0:
+            return []
+        # int16 views over the received frames, converted into the buffer
+        state.audio.clear()
+        audio_array = state.audio.append(pcm_chunks)
+        config = WhisperServiceParameters(**parameters)
+        # use faster whisper to transcribe audio to text
+        msg_body = process_faster_whisper_transcribe(
+            faster_whipser=state.models.get(),
+            msgid=header.msgid,
+            frame_buffer=[audio_array],
+            beam_size=config.beam_size,
+            language=config.language,
+            vad_filter=config.vad_filter,
+            vad_min_silence_duration_ms=config.vad_min_silence_duration_ms,
+        )
+        if msg_body is None:
+            return []
+        return [[bytes(config.whisper_pub_topic, encoding="utf-8"), msg_body]]
@@ -0,0 +1,266 @@
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import zmq
+
+from halatrans.model.envelope import MessageKind, encode_envelope
+from halatrans.services.backend.whisper_service import (INT16_MAX_ABS_VALUE,
+                                                        WHISPER_COMPUTE_TYPE,
+                                                        WHISPER_LANGUAGE,
+                                                        WHISPER_MODEL_SIZE,
+                                                        check_whisper_model,
+                                                        create_whisper_model)
+from halatrans.services.base_service import CustomService, ServiceConfig
+from halatrans.services.context import create_context
+from halatrans.services.live_parameters import LiveParameters
+from halatrans.services.model_cache import HotSwapModel
+from halatrans.services.qos import create_qos_publisher, create_qos_sub_socket
+from halatrans.services.shm_ring_buffer import ShmRingSubscriber
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.streaming_transcriber import StreamingTranscriber, Word
+from halatrans.services.utils import poll_messages
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SENTENCE_END = (".", "?", "!")
+
+
+@dataclass
+class WhisperStreamServiceParameters:
+    audio_pub_addr: str
+    audio_pub_topic: str
+    whisper_pub_addr: str
+    whisper_pub_topic: str
+    audio_shm_name: Optional[str] = None  # read audio from the local ring
+    model: str = WHISPER_MODEL_SIZE
+    compute_type: str = WHISPER_COMPUTE_TYPE
+    num_workers: int = 1
+    beam_size: int = 5
+    language: str = WHISPER_LANGUAGE
+    # seconds of new audio between two decodes of the window
+    decode_interval: float = 0.5
+    # seconds of audio decoded at most
+    max_window: float = 15.0
+    # seconds after which a word is final without an agreement
+    max_latency: float = 4.0
+    # a pause this long between two words ends the utterance
+    utterance_pause: float = 1.0
+
+
+class Utterance:
+    def __init__(self):
+        self.seq = 0
+        self.msgid = ""
+        self.words: List[Word] = []
+
+    @property
+    def text(self) -> str:
+        return " ".join(w.text for w in self.words)
+
+    def add(self, word: Word):
+        if len(self.words) == 0:
+            self.msgid = f"msgid-{int(time.time())}-{self.seq}"
+            self.seq += 1
+        self.words.append(word)
+
+    def clear(self):
+        self.words = []
+
+
+def whisper_stream_thread(
+    stop_flag: ShutdownFlag,
+    audio_queue: queue.Queue,
+    parameters: Dict[str, Any],
+    models: HotSwapModel,
+    failed: threading.Event,
+):
+    config = WhisperStreamServiceParameters(**parameters)
+    ctx = create_context()
+    whisper_pub = create_qos_publisher(
+        ctx, config.whisper_pub_addr, [config.whisper_pub_topic]
+    )
+    bytes_topic = bytes(config.whisper_pub_topic, encoding="utf-8")
+    transcriber = StreamingTranscriber(config.max_window, config.max_latency)
+    utterance = Utterance()
+
+    def publish(kind: int):
+        msg_body = encode_envelope(kind, msgid=utterance.msgid, text=utterance.text)
+        if kind == MessageKind.PARTIAL:
+            # a partial replaces the previous one of the utterance
+            whisper_pub.send_multipart([bytes_topic, msg_body], key=utterance.msgid)
+            return
+        logger.info(f"\n--- {utterance.msgid} ---\n{utterance.text}\n--- end ---\n")
+        whisper_pub.send_multipart([bytes_topic, msg_body])
+        utterance.clear()
+
+    def publish_words(words: List[Word]):
+        pause = parameters["utterance_pause"]
+        for word in words:
+            if (
+                len(utterance.words) > 0
+                and word.start - utterance.words[-1].end > pause
+            ):
+                publish(MessageKind.FULLTEXT)
+            utterance.add(word)
+            if word.text.endswith(SENTENCE_END):
+                publish(MessageKind.FULLTEXT)
+        if len(utterance.words) == 0:
+            return
+        # nothing follows the last word of the utterance any more
+        silence = transcriber.stream_end - utterance.words[-1].end
+        if silence > max(pause, transcriber.max_latency):
+            publish(MessageKind.FULLTEXT)
+        elif len(words) > 0:
+            publish(MessageKind.PARTIAL)
+
+    try:
+        while True:
+            while True:
+                try:
+                    transcriber.insert_audio(audio_queue.get(block=False))
+                except queue.Empty:
+                    break
+            if stop_flag.get() != 0:
+                break
+            if transcriber.pending_seconds < parameters["decode_interval"]:
+                time.sleep(0.05)
+                continue
+            transcriber.max_latency = parameters["max_latency"]
+            publish_words(
+                transcriber.process(
+                    models.get(), parameters["beam_size"], parameters["language"]
+                )
+            )
+        publish_words(
+            transcriber.finish(
+                models.get(), parameters["beam_size"], parameters["language"]
+            )
+        )
+        if len(utterance.words) > 0:
+            publish(MessageKind.FULLTEXT)
+    except Exception as err:
+        logger.error(err)
+        # stops the message loop of the worker
+        failed.set()
+    finally:
+        whisper_pub.close()
+        ctx.term()
+
+
+class WhisperStreamService(CustomService):
+    """
+    Streaming mode of WhisperService. Transcribes the live audio topic
+    directly instead of the utterances cut by vosk: a bounded window of the
+    newest audio is decoded again every decode_interval and words are
+    committed once two decodes agree on them, see streaming_transcriber.py.
+    The committed text of an utterance is published as a partial, a pause or
+    the end of a sentence publishes the fulltext.
+    """
+
+    def __init__(self, config: ServiceConfig):
+        super().__init__(config)
+
+    @staticmethod
+    def check_model(name: str):
+        check_whisper_model(name)
+
+    @staticmethod
+    def get_parameters_type() -> Optional[type]:
+        return WhisperStreamServiceParameters
+
+    @staticmethod
+    def get_live_parameters() -> List[str]:
+        return ["model", "beam_size", "language", "decode_interval", "max_latency"]
+
+    @staticmethod
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
+        config = WhisperStreamServiceParameters(**parameters)
+        logger.info(f"WhisperStreamService worker start. {config}")
+
+        ctx = create_context()
+        # subscribed before the model loads, no update during it is lost
+        live = LiveParameters(ctx, stop_flag, WhisperStreamService, parameters)
+
+        os.environ["KMP_DUPLICATE_LIB_OK"] = "True"
+        models = create_whisper_model(
+            config.model, config.compute_type, config.num_workers
+        )
+
+        ring_sub: Optional[ShmRingSubscriber] = None
+        if config.audio_shm_name:
+            ring_sub = ShmRingSubscriber(
+                ctx,
+                config.audio_pub_addr,
+                config.audio_pub_topic,
+                config.audio_shm_name,
+            )
+            audio_socks = ring_sub.get_sockets()
+        else:
+            audio_sub = create_qos_sub_socket(
+                ctx, config.audio_pub_addr, [config.audio_pub_topic]
+            )
+            audio_socks = [audio_sub]
+
+        # decoding takes longer than a block of audio, it runs next to the
+        # message loop so that no audio waits in the sockets
+        audio_queue = queue.Queue(maxsize=10000)
+        decode_failed = threading.Event()
+        decode_thread = threading.Thread(
+            target=whisper_stream_thread,
+            args=(
+                stop_flag.observer(),
+                audio_queue,
+                live.parameters,
+                models,
+                decode_failed,
+            ),
+        )
+        decode_thread.daemon = True
+        decode_thread.start()
+
+        logger.info("Whisper stream service start handle message...")
+
+        def should_stop() -> bool:
+            if live.poll():
+                models.swap(live.parameters["model"])
+            if decode_failed.is_set():
+                return True
+            if stop_flag.get() != 0:
+                return True
+            return False
+
+        try:
+
+            def message_handler(sock: zmq.Socket, chunks: List[bytes]):
+                stop_flag.on_message(len(chunks))
+                if ring_sub:
+                    chunks = ring_sub.read(sock, chunks)
+                for chunk in chunks:
+                    pcm = np.frombuffer(chunk, dtype=np.int16)
+                    audio_queue.put(pcm.astype(np.float32) / INT16_MAX_ABS_VALUE)
+
+            poll_messages(audio_socks, message_handler, should_stop)
+        except Exception as err:
+            logger.error(err)
+        finally:
+            # cleanup
+            decode_thread.join()
+
+            live.close()
+            if ring_sub:
+                ring_sub.close()
+            else:
+                audio_sub.close()
+            ctx.term()
+
+        if decode_failed.is_set():
+            # the error of the task, the supervisor restarts it
+            raise ValueError("Whisper decode thread failed.")
+        logger.info("WhisperStreamService worker end.")
@@ -1,21 +1,32 @@
 import asyncio
 import logging
 import signal
+import threading
+import time
 import uuid
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
-from multiprocessing.managers import ValueProxy
-from typing import Any, Dict, Generator, List, Optional, Type, TypeVar
-
-import zmq
-
-from halatrans.services.utils import (create_pub_socket, create_rep_socket,
-                                      create_req_socket)
+from typing import Any, Dict, Generator, List, Optional, Set, Type, TypeVar
+
+from halatrans.services.async_runtime import AsyncServiceRuntime
+from halatrans.services.context import create_context
+from halatrans.services.live_parameters import LiveParameters
+from halatrans.services.qos import create_qos_publisher
+from halatrans.services.request_client import AsyncRequestClient
+from halatrans.services.request_router import (RequestRouterStats,
+                                               split_envelope, timed_call)
+from halatrans.services.shm_ring_buffer import ShmRingWriter, shm_notify_topic
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import create_rep_socket, create_router_socket
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# a publisher waits this long for its first subscriber before it sends
+SUBSCRIBER_WAIT_TIMEOUT = 2.0  # seconds
+
 
 class ServiceMode(Enum):
     CUSTOM = 0
@@ -28,11 +39,42 @@ class ServiceConfig:
     addr: Optional[str] = None  # Only available when mode is [REQREP | PUBSUB]
     topic: Optional[str] = None  # Only available when mode is PUBSUB
     parameters: Dict[str, Any] = None
+    # Options of the worker itself, e.g. RequestResponseWorkerOptions
+    options: Dict[str, Any] = None
+    # Only available for WorkQueueService, number of worker processes
+    replicas: int = 1
+    # Only available for WorkQueueService, the pool grows up to this many
+    # replicas under load and shrinks back to replicas. See
+    # halatrans/services/autoscaler.py.
+    max_replicas: int = 0
+    # Always runs in a worker process, also when the manager is embedded.
+    # For stages that hold the GIL, e.g. model inference.
+    isolated: bool = False
+    # Keeps the worker process, and the models it loaded, across stop and
+    # start of the manager. See halatrans/services/model_cache.py.
+    warm: bool = False
+    # Names of the services this one subscribes to or requests from. It is
+    # started once they are ready and stopped after them, once it processed
+    # what they sent.
+    depends_on: List[str] = field(default_factory=list)
+    # Carries the messages of the services that depend on it instead of
+    # producing them, e.g. the broker. It is stopped after all the others.
+    transport: bool = False
+    # Cores dedicated to every worker process of the service, also its thread
+    # budget, when the manager plans the cpus. 0 shares the common cores.
+    # See halatrans/services/cpu_planner.py.
+    cpu_threads: int = 0
 
 
-# Get the port that was assigned
-# addr = socket.getsockopt(zmq.LAST_ENDPOINT).decode("utf-8")
-# port = addr.split(":")[-1]
+@dataclass
+class RequestResponseWorkerOptions:
+    # ROUTER socket, requests are served concurrently by a pool and answered
+    # out of order. Otherwise a REP socket serves one request at a time.
+    router: bool = False
+    pool: str = "thread"  # thread | process
+    pool_size: int = 4
+    stats_interval: float = 60.0  # seconds
+
 
 ServiceT = TypeVar("ServiceT", bound="BaseService")
 RequestResponseServiceT = TypeVar(
@@ -42,6 +84,7 @@ PublishSubscribeServiceT = TypeVar(
     "PublishSubscribeServiceT", bound="PublishSubscribeService"
 )
 CustomServiceT = TypeVar("CustomServiceT", bound="CustomService")
+AsyncCustomServiceT = TypeVar("AsyncCustomServiceT", bound="AsyncCustomService")
 
 
 class BaseService(ABC):
@@ -57,47 +100,71 @@ class BaseService(ABC):
         pass
 
     @abstractmethod
-    def on_worker_process_launched(self, stop_flag: ValueProxy[int]):
+    def on_worker_process_launched(self, stop_flag: ShutdownFlag):
         pass
 
     @abstractmethod
     def on_terminating(self):
         pass
 
+    @staticmethod
+    def get_live_parameters() -> List[str]:
+        # override this method to list the parameters that can be updated
+        # while the workers run, see halatrans/services/live_parameters.py
+        return []
+
+    @staticmethod
+    def get_parameters_type() -> Optional[type]:
+        # override this method to return the dataclass of the parameters,
+        # live updates are checked against its field types
+        return None
+
+    @staticmethod
+    def check_model(name: str):
+        # override this method to raise ValueError for a model the workers
+        # can not load, checked before a model swap is accepted
+        pass
+
     @staticmethod
     @abstractmethod
     async def on_worker_process_begin(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         cls: Type[ServiceT],
         addr: Optional[str],
         topic: Optional[str],
         parameters: Dict[str, Any],
+        options: Optional[Dict[str, Any]] = None,
     ):
         pass
 
     @staticmethod
     def process_worker(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         cls: Type[ServiceT],
         mode: ServiceMode,
         addr: Optional[str],
         topic: Optional[str],
         parameters: Dict[str, Any],
+        options: Optional[Dict[str, Any]] = None,
     ):
-        # setup worker process SIGINT
-        original_sigint_handler = signal.getsignal(signal.SIGINT)
+        # setup worker process SIGINT, a worker thread of an embedded service
+        # is stopped by the manager of the process instead
+        if threading.current_thread() is threading.main_thread():
+            original_sigint_handler = signal.getsignal(signal.SIGINT)
 
-        def handle_sigint(signal_num, frame):
-            logger.error("handle sigint!!! set stop flag.")
-            stop_flag.set(1)
-            if original_sigint_handler:
-                original_sigint_handler(signal_num, frame)
+            def handle_sigint(signal_num, frame):
+                logger.error("handle sigint!!! set stop flag.")
+                stop_flag.set(1)
+                if original_sigint_handler:
+                    original_sigint_handler(signal_num, frame)
 
-        signal.signal(signal.SIGINT, handle_sigint)
+            signal.signal(signal.SIGINT, handle_sigint)
 
         # start worker logic
         asyncio.run(
-            cls.on_worker_process_begin(stop_flag, cls, addr, topic, parameters)
+            cls.on_worker_process_begin(
+                stop_flag, cls, addr, topic, parameters, options
+            )
         )
 
 
@@ -105,7 +172,7 @@ class BaseServiceImpl(BaseService):
     def __init__(self, config: ServiceConfig):
         super().__init__(config)
 
-    def on_worker_process_launched(self, stop_flag: ValueProxy[int]):
+    def on_worker_process_launched(self, stop_flag: ShutdownFlag):
         super().on_worker_process_launched(stop_flag)
 
     def on_terminating(self):
@@ -124,14 +191,16 @@ class RequestResponseService(BaseServiceImpl):
         """
         Sends a request to service and waits for a response.
 
-        It sends the input bytes as a multipart message and waits for the response.
+        It sends the input bytes as a multipart message through the pooled
+        async client and waits for the response without blocking the loop.
 
         Args:
             input: The input data to be sent as bytes.
             timeout: The maximum time in seconds to wait for a response. Default is 0 (no timeout).
 
         Returns:
-            The response data as bytes, or None if an error occurred or the response is invalid.
+            The response data as bytes, or None if an error occurred, the request
+            timed out or the response is invalid.
 
         Raises:
             ValueError: If the service mode is not REQREP or the address is not configured.
@@ -139,40 +208,20 @@ class RequestResponseService(BaseServiceImpl):
         if self.config.addr is None:
             raise ValueError(f"Config addr is not setted. {self.config}")
 
-        async def request_task(
-            addr: str, bytes_topic: bytes, input: bytes
-        ) -> Optional[bytes]:
-            # TODO: implement timeout
-            ctx = zmq.Context()
-            req = create_req_socket(ctx, self.config.addr)
-            try:
-                req.send_multipart([bytes_topic, input])
-                recv_topic, chunk = req.recv_multipart()
-                if recv_topic != bytes_topic:
-                    raise ValueError(
-                        f"Recv topic is not match, s: {bytes_topic}, r: {recv_topic}"
-                    )
-                return chunk
-            except Exception as err:
-                logger.error(err)
-            finally:
-                req.close()
-                ctx.term()
-            return None
-
-        request_task = asyncio.create_task(
-            request_task(self.config.addr, self.unique_topic, input)
-        )
-        responses: List[Optional[bytes]] = await asyncio.gather(request_task)
-        return responses[0]
+        return await self.client.request(self.unique_topic, input, timeout)
 
     def __init_reqrep_server__(self):
         if self.config.addr is None:
             raise ValueError("Config addr is None")
 
         self.unique_topic = bytes(uuid.uuid4().hex[:8], encoding="utf-8")
+        self.client = AsyncRequestClient(self.config.addr)
         logger.info(f"initial REQREP server, unique topic: {self.unique_topic}")
 
+    def on_terminating(self):
+        super().on_terminating()
+        self.client.close()
+
     @staticmethod
     @abstractmethod
     def on_worker_process_response(
@@ -180,64 +229,153 @@ class RequestResponseService(BaseServiceImpl):
     ) -> Optional[bytes]:
         pass
 
+    @staticmethod
+    def get_request_type(parameters: Dict[str, Any], topic: str, chunk: bytes) -> str:
+        # override this method to group the router stats by request type
+        return "default"
+
     @staticmethod
     async def on_worker_process_begin(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         cls: Type[ServiceT],
         addr: Optional[str],
         topic: Optional[str],
         parameters: Dict[str, Any],
+        options: Optional[Dict[str, Any]] = None,
     ):
         if not issubclass(cls, RequestResponseService):
             raise ValueError(f"Class is not subclass of RequestResponseService, {cls}")
 
-        logger.info("REQREP worker start...")
-        response_task = asyncio.create_task(
-            RequestResponseService.__reqrep_worker_response_handler__(
+        worker_options = RequestResponseWorkerOptions(**(options or {}))
+        logger.info(f"REQREP worker start... {worker_options}")
+        if worker_options.router:
+            handler = RequestResponseService.__router_worker_response_handler__(
+                stop_flag, cls, addr, parameters, worker_options
+            )
+        else:
+            handler = RequestResponseService.__reqrep_worker_response_handler__(
                 stop_flag, cls, addr, parameters
             )
-        )
+        response_task = asyncio.create_task(handler)
         await asyncio.gather(response_task)
         logger.info("REQREP worker end.")
 
     @staticmethod
     async def __reqrep_worker_response_handler__(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         cls: Type[RequestResponseServiceT],
         addr: str,
         parameters: Dict[str, Any],
     ):
-        ctx = zmq.Context()
-        rep_sock = create_rep_socket(ctx, addr)
-        poller = zmq.Poller()
-        poller.register(rep_sock, zmq.POLLIN)
-
-        while True:
-            # detect stop
-            if stop_flag.get() != 0:
-                break
-
-            socks = dict(poller.poll(1000))  # timeout in milliseconds
-            if rep_sock in socks and socks[rep_sock] == zmq.POLLIN:
+        runtime = AsyncServiceRuntime(stop_flag, max_workers=1)
+        rep_sock = create_rep_socket(runtime.ctx, addr)
+
+        async def handle_request():
+            while not runtime.should_stop():
+                # wakes as soon as a request arrives
+                if await rep_sock.poll(1000) == 0:
+                    continue
+                frames = await rep_sock.recv_multipart()
+                stop_flag.on_message()
+                # REP must answer every request, a malformed one included
+                bytes_topic = frames[0]
                 try:
-                    bytes_topic, chunk = rep_sock.recv_multipart()
+                    _, chunk = frames
                     topic = str(bytes_topic, encoding="utf-8")
-                    response_data = cls.on_worker_process_response(
-                        parameters, topic, chunk
+                    # keep the loop responsive while the handler runs
+                    response_data = await runtime.run_in_executor(
+                        cls.on_worker_process_response, parameters, topic, chunk
                     )
-                    if response_data:
-                        rep_sock.send_multipart([bytes_topic, response_data])
-                    else:
-                        rep_sock.send_multipart([bytes_topic, b""])
                 except Exception as err:
                     logger.error(err)
-            else:
-                # No message received yet, retrying...
-                await asyncio.sleep(0.2)
+                    response_data = None
+                if response_data:
+                    await rep_sock.send_multipart([bytes_topic, response_data])
+                else:
+                    await rep_sock.send_multipart([bytes_topic, b""])
+
+        runtime.spawn(handle_request())
+        await runtime.run()
 
-        poller.unregister(rep_sock)
         rep_sock.close()
-        ctx.term()
+        runtime.close()
+
+    @staticmethod
+    async def __router_worker_response_handler__(
+        stop_flag: ShutdownFlag,
+        cls: Type[RequestResponseServiceT],
+        addr: str,
+        parameters: Dict[str, Any],
+        options: RequestResponseWorkerOptions,
+    ):
+        if options.pool == "process":
+            runtime = AsyncServiceRuntime(stop_flag, max_workers=1)
+            pool = ProcessPoolExecutor(max_workers=options.pool_size)
+        elif options.pool == "thread":
+            runtime = AsyncServiceRuntime(stop_flag, max_workers=options.pool_size)
+            pool = runtime.executor
+        else:
+            raise ValueError(f"Unknown request pool: {options.pool}")
+
+        router_sock = create_router_socket(runtime.ctx, addr)
+        stats = RequestRouterStats(cls.__name__)
+
+        async def serve(envelope: List[bytes], bytes_topic: bytes, chunk: bytes):
+            recv_ts = time.time()
+            topic = str(bytes_topic, encoding="utf-8")
+            request_type = "unknown"
+            response_data = None
+            start_ts, service_time, is_error = recv_ts, 0.0, False
+            try:
+                request_type = cls.get_request_type(parameters, topic, chunk)
+                loop = asyncio.get_running_loop()
+                response_data, start_ts, service_time = await loop.run_in_executor(
+                    pool,
+                    timed_call,
+                    cls.on_worker_process_response,
+                    parameters,
+                    topic,
+                    chunk,
+                )
+            except Exception as err:
+                logger.error(err)
+                is_error = True
+            stats.on_done(
+                request_type, max(start_ts - recv_ts, 0), service_time, is_error
+            )
+            await router_sock.send_multipart(
+                envelope + [bytes_topic, response_data if response_data else b""]
+            )
+
+        in_flight: Set[asyncio.Task] = set()
+
+        async def handle_request():
+            while not runtime.should_stop():
+                if await router_sock.poll(1000) == 0:
+                    continue
+                frames = await router_sock.recv_multipart()
+                try:
+                    envelope, body = split_envelope(frames)
+                    bytes_topic, chunk = body
+                except ValueError as err:
+                    logger.error(err)
+                    continue
+                stats.on_enqueue()
+                stop_flag.on_message()
+                # every request runs on its own, responses go out by envelope
+                task = asyncio.create_task(serve(envelope, bytes_topic, chunk))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+
+        runtime.spawn(handle_request())
+        runtime.every(options.stats_interval, stats.log)
+        await runtime.run()
+
+        stats.log()
+        router_sock.close()
+        if pool is not runtime.executor:
+            pool.shutdown(wait=False, cancel_futures=True)
+        runtime.close()
 
 
 class PublishSubscribeService(BaseServiceImpl):
@@ -262,13 +400,22 @@ class PublishSubscribeService(BaseServiceImpl):
     ) -> Generator[bytes, Optional[str], None]:
         pass
 
+    @staticmethod
+    def on_worker_process_shm_ring(
+        parameters: Dict[str, Any],
+    ) -> Optional[ShmRingWriter]:
+        # override this method to also write the published chunks into a
+        # shared memory ring for consumers on the same host
+        return None
+
     @staticmethod
     async def on_worker_process_begin(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         cls: Type[ServiceT],
         addr: Optional[str],
         topic: Optional[str],
         parameters: Dict[str, Any],
+        options: Optional[Dict[str, Any]] = None,
     ):
         if not issubclass(cls, PublishSubscribeService):
             raise ValueError(f"Class is not subclass of PublishSubscribeService, {cls}")
@@ -284,25 +431,43 @@ class PublishSubscribeService(BaseServiceImpl):
 
     @staticmethod
     async def __pubsub_worker_handler__(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         cls: Type[PublishSubscribeServiceT],
         addr: str,
         topic: str,
         parameters: Dict[str, Any],
     ):
-        ctx = zmq.Context()
-        pub_sock = create_pub_socket(ctx, addr)
+        ctx = create_context()
+        ring = cls.on_worker_process_shm_ring(parameters)
+        notify_topic = bytes(shm_notify_topic(topic), encoding="utf-8")
+        pub_sock = create_qos_publisher(ctx, addr, [topic, shm_notify_topic(topic)])
 
-        gen = cls.on_worker_process_publisher(parameters)
+        if not pub_sock.wait_subscribed(SUBSCRIBER_WAIT_TIMEOUT):
+            logger.warning(f"No subscriber of {topic} yet, publish anyway.")
+
+        # the publisher reads the updated parameters on its next chunk
+        live = LiveParameters(ctx, stop_flag, cls, parameters)
+        gen = cls.on_worker_process_publisher(live.parameters)
         bytes_topic = bytes(topic, encoding="utf-8")
         while True:
             if stop_flag.get() != 0:
                 gen.send("STOP")
                 break
+            live.poll()
             chunk = gen.send(None)
+            stop_flag.on_message()
+            if ring:
+                # local consumers read the ring, only the notification is sent
+                ring.write(chunk)
+                pub_sock.send_multipart([notify_topic, ring.notification()])
+            # PUB filters on the sender side, without remote subscribers of
+            # the data topic this is not copied to any peer
             pub_sock.send_multipart([bytes_topic, chunk])
 
+        live.close()
         pub_sock.close()
+        if ring:
+            ring.close()
 
 
 class CustomService(BaseServiceImpl):
@@ -318,18 +483,17 @@ class CustomService(BaseServiceImpl):
 
     @staticmethod
     @abstractmethod
-    def on_worker_process_custom(
-        stop_flag: ValueProxy[int], parameters: Dict[str, Any]
-    ):
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
         pass
 
     @staticmethod
     async def on_worker_process_begin(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         cls: Type[ServiceT],
         addr: Optional[str],
         topic: Optional[str],
         parameters: Dict[str, Any],
+        options: Optional[Dict[str, Any]] = None,
     ):
         if not issubclass(cls, CustomService):
             raise ValueError(f"Class is not subclass of CustomService, {cls}")
@@ -343,8 +507,55 @@ class CustomService(BaseServiceImpl):
 
     @staticmethod
     async def __custom_worker_handler__(
-        stop_flag: ValueProxy[int],
+        stop_flag: ShutdownFlag,
         cls: Type[CustomServiceT],
         parameters: Dict[str, Any],
     ):
         cls.on_worker_process_custom(stop_flag, parameters)
+
+
+class AsyncCustomService(BaseServiceImpl):
+    def __init__(self, config: ServiceConfig):
+        super().__init__(config)
+
+    def get_mode(self) -> ServiceMode:
+        return ServiceMode.CUSTOM
+
+    @staticmethod
+    @abstractmethod
+    async def on_worker_process_async(
+        runtime: AsyncServiceRuntime, parameters: Dict[str, Any]
+    ):
+        # Create sockets from runtime.ctx, register handlers with
+        # runtime.subscribe / runtime.every, then return. The runtime runs
+        # until the stop flag is set.
+        pass
+
+    @staticmethod
+    async def on_worker_process_stopped(
+        runtime: AsyncServiceRuntime, parameters: Dict[str, Any]
+    ):
+        # override this method to release resources after the runtime stopped
+        pass
+
+    @staticmethod
+    async def on_worker_process_begin(
+        stop_flag: ShutdownFlag,
+        cls: Type[ServiceT],
+        addr: Optional[str],
+        topic: Optional[str],
+        parameters: Dict[str, Any],
+        options: Optional[Dict[str, Any]] = None,
+    ):
+        if not issubclass(cls, AsyncCustomService):
+            raise ValueError(f"Class is not subclass of AsyncCustomService, {cls}")
+
+        logger.info("ASYNC CUSTOM worker start...")
+        runtime = AsyncServiceRuntime(stop_flag)
+        try:
+            await cls.on_worker_process_async(runtime, parameters)
+            await runtime.run()
+        finally:
+            await cls.on_worker_process_stopped(runtime, parameters)
+            runtime.close()
+        logger.info("ASYNC CUSTOM worker end.")
@@ -1,24 +1,122 @@
 import logging
+import multiprocessing
 import queue
 import signal
-from typing import Any, Dict, List, Optional
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
+from halatrans.services.autoscaler import AutoscalerOptions, ServiceAutoscaler
 from halatrans.services.base_service import BaseService
+from halatrans.services.context import enable_shared_context
+from halatrans.services.cpu_planner import CpuPlan, plan_cpus
+from halatrans.services.live_parameters import (ControlPublisher,
+                                                check_parameter_updates)
 from halatrans.services.process_task_manager import (ProcessTaskManager,
                                                      ServiceState,
                                                      ServiceTaskIdDict)
+from halatrans.services.supervisor import ServiceSupervisor, SupervisorOptions
+from halatrans.services.work_queue import (WorkQueueService, replica_options,
+                                           replica_task, replica_tasks)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# models may be loaded or downloaded before a service is ready
+DEFAULT_READY_TIMEOUT = 600.0  # seconds
+# a service is drained when it did not process a message for this long
+DRAIN_IDLE = 0.5  # seconds
+DRAIN_TIMEOUT = 10.0  # seconds, per layer
+WAIT_INTERVAL = 0.05  # seconds
+
+
+def dependency_layers(services: ServiceState) -> List[List[str]]:
+    """
+    Groups the services by ServiceConfig.depends_on, every service comes in a
+    later layer than the services it depends on. The services of one layer
+    do not depend on each other.
+    """
+    remaining: Dict[str, List[str]] = {}
+    for name, service in services.items():
+        depends_on = service.get_config().depends_on
+        for dep in depends_on:
+            if dep not in services:
+                raise ValueError(f"{name} depends on unknown service {dep}.")
+        remaining[name] = list(depends_on)
+
+    layers: List[List[str]] = []
+    started: List[str] = []
+    while len(remaining) > 0:
+        layer = [
+            name
+            for name, depends_on in remaining.items()
+            if all(dep in started for dep in depends_on)
+        ]
+        if len(layer) == 0:
+            raise ValueError(f"Dependency cycle between {list(remaining.keys())}.")
+        for name in layer:
+            remaining.pop(name)
+        started.extend(layer)
+        layers.append(layer)
+    return layers
+
 
 class BaseServiceManager:
-    def __init__(self):
+    """
+    Runs every service in worker processes. When embedded, the services run
+    as threads of this process over inproc:// and only isolated services get
+    a worker process.
+
+    A supervisor restarts the tasks that crash or hang, see
+    halatrans/services/supervisor.py.
+
+    Services start in layers of ServiceConfig.depends_on, a layer once the
+    one before it is ready. Subscribers so connect to bound publishers and
+    are subscribed when start() returns and is_ready is set. Shutdown stops
+    the layers in start order, the sources first and every later layer once
+    it processed what is in flight. Transport services stop last.
+
+    With a control address, the live parameters of a running service are
+    updated by update_service_parameters() without restarting its workers.
+
+    With plan_cpus, every worker process gets a thread budget and the cores
+    it runs on, see halatrans/services/cpu_planner.py.
+
+    Work queue services with ServiceConfig.max_replicas are scaled by the
+    backlog of their dispatcher, see halatrans/services/autoscaler.py.
+    """
+
+    def __init__(
+        self,
+        embedded: bool = False,
+        supervisor_options: Optional[SupervisorOptions] = None,
+        control_addr: Optional[str] = None,
+        plan_cpus: bool = False,
+        autoscaler_options: Optional[AutoscalerOptions] = None,
+    ):
+        self.embedded = embedded
+        self.supervisor_options = supervisor_options
+        self.autoscaler_options = autoscaler_options
+        self.control_addr = control_addr
+        self.plan_cpus = plan_cpus
+        # task name -> cpu plan of the current start
+        self.__cpu_plans__: Dict[str, CpuPlan] = dict()
+        self.__control__: Optional[ControlPublisher] = None
+        # service name -> parameters updated while it ran, kept for the next
+        # start
+        self.__parameter_overrides__: Dict[str, Dict[str, Any]] = dict()
         self.__task_manager__: Optional[ProcessTaskManager] = None
+        self.__supervisor__: Optional[ServiceSupervisor] = None
+        self.__autoscaler__: Optional[ServiceAutoscaler] = None
+        # held by the supervisor thread while it checks and restarts tasks
+        self.__lock__ = threading.RLock()
         self.__service_state__: ServiceState = dict()
         self.__service_task_id_dict__: ServiceTaskIdDict = dict()
+        self.__layers__: List[List[str]] = []
+        self.ready_timeout = DEFAULT_READY_TIMEOUT
         self.is_terminating = False
         self.is_running = False
+        self.is_ready = False
         self.is_exit = False
 
         self.__original_sigint_handler__ = signal.getsignal(signal.SIGINT)
@@ -31,25 +129,145 @@ class BaseServiceManager:
         if self.__original_sigint_handler__:
             self.__original_sigint_handler__(signal_num, frame)
 
+    def __service_tasks__(
+        self, service_name: str, service: BaseService
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        config = service.get_config()
+        options: Dict[str, Any] = {} if config.options is None else config.options
+        if self.__is_scalable__(service) or (
+            isinstance(service, WorkQueueService) and config.replicas > 1
+        ):
+            # a dispatcher and the replicas, in separate processes
+            return replica_tasks(service_name, config.replicas, options)
+        return [(service_name, options)]
+
+    def __is_scalable__(self, service: BaseService) -> bool:
+        config = service.get_config()
+        return (
+            isinstance(service, WorkQueueService)
+            and config.max_replicas > config.replicas
+        )
+
+    def __is_in_thread__(self, service: BaseService) -> bool:
+        return self.embedded and not service.get_config().isolated
+
+    def __plan_cpus__(self, services: ServiceState) -> Dict[str, CpuPlan]:
+        demands: Dict[str, int] = {}
+        for name, service in services.items():
+            if self.__is_in_thread__(service):
+                continue
+            config = service.get_config()
+            tasks = self.__service_tasks__(name, service)
+            if self.__is_scalable__(service):
+                # cores for the replicas the pool may grow to
+                for idx in range(config.replicas, config.max_replicas):
+                    tasks.append(replica_task(name, idx, config.options))
+            for task_name, task_options in tasks:
+                # a dispatcher only moves messages
+                role = replica_options(task_options).role
+                demands[task_name] = 0 if role == "dispatcher" else config.cpu_threads
+        if len(demands) == 0:
+            return {}
+        plans = plan_cpus(demands)
+        for task_name, plan in plans.items():
+            logger.info(f"Cpu plan of {task_name}: {plan}")
+        return plans
+
     def __submit_task__(self, service_name: str, service: BaseService):
         config = service.get_config()
-        mode = service.get_mode()
-        addr = config.addr
-        topic = config.topic
+        overrides = self.__parameter_overrides__.get(service_name)
+        if overrides and config.parameters is not None:
+            config.parameters.update(overrides)
+
+        tasks = self.__service_tasks__(service_name, service)
+        task_ids: List[str] = []
+        with self.__lock__:
+            for task_name, task_options in tasks:
+                task_ids.append(
+                    self.__submit_one__(service_name, service, task_name, task_options)
+                )
+            self.__service_task_id_dict__[service_name] = task_ids
+            if self.__is_scalable__(service):
+                self.__autoscaler__.watch(
+                    service_name,
+                    task_ids[0],
+                    task_ids[1:],
+                    config.replicas,
+                    config.max_replicas,
+                )
+
+    def __submit_one__(
+        self,
+        service_name: str,
+        service: BaseService,
+        task_name: str,
+        task_options: Dict[str, Any],
+    ) -> str:
+        config = service.get_config()
         parameters: Dict[str, Any] = (
-            {}
-            if service.get_config().parameters is None
-            else service.get_config().parameters
+            {} if config.parameters is None else config.parameters
         )
-
+        in_thread = self.__is_in_thread__(service)
+        warm = config.warm and not in_thread
         task_id = self.__task_manager__.submit(
             service,
-            mode,
-            addr,
-            topic,
+            service.get_mode(),
+            config.addr,
+            config.topic,
             parameters,
+            task_options,
+            in_thread=in_thread,
+            warm_key=task_name if warm else None,
+            cpu_plan=self.__cpu_plans__.get(task_name),
         )
-        self.__service_task_id_dict__[service_name] = task_id
+        placement = "thread" if in_thread else "process"
+        logger.info(f"Launch {task_name} as {task_id} ({placement})")
+        self.__supervisor__.watch(service_name, task_name, task_id)
+        return task_id
+
+    def __get_task_ids__(self, service_names: List[str]) -> List[str]:
+        task_ids: List[str] = []
+        for name in service_names:
+            task_ids.extend(self.__service_task_id_dict__.get(name, []))
+        return task_ids
+
+    def __wait_ready__(self, layer: List[str]) -> bool:
+        task_ids = self.__get_task_ids__(layer)
+        deadline = time.time() + self.ready_timeout
+        while self.is_running:
+            if all(self.__task_manager__.is_task_ready(t) for t in task_ids):
+                return True
+            if time.time() > deadline:
+                logger.warning(f"Services {layer} are not ready, continue.")
+                return False
+            time.sleep(WAIT_INTERVAL)
+        return False
+
+    def __wait_idle__(self, layer: List[str], task_ids: List[str]):
+        deadline = time.time() + DRAIN_TIMEOUT
+        while time.time() < deadline:
+            idle = True
+            for task_id in task_ids:
+                heartbeat = self.__task_manager__.get_task_heartbeat(task_id)
+                if heartbeat and time.time() - heartbeat.message_ts < DRAIN_IDLE:
+                    idle = False
+                    break
+            if idle:
+                return
+            time.sleep(WAIT_INTERVAL)
+        logger.warning(f"Services {layer} are not drained, stop them.")
+
+    def __drain__(self, layers: List[List[str]], layer_task_ids: List[List[str]]):
+        # The sources stop first, then every layer once it went idle, it
+        # gets no more messages from the stopped layers before it.
+        is_source = True
+        for layer, task_ids in zip(layers, layer_task_ids):
+            if len(task_ids) == 0:
+                continue
+            if not is_source:
+                self.__wait_idle__(layer, task_ids)
+            is_source = False
+            self.__task_manager__.stop_tasks(task_ids)
 
     def get_service(self, name: str) -> Optional[BaseService]:
         if name in self.__service_state__:
@@ -63,17 +281,53 @@ class BaseServiceManager:
             return "services are stopping."
 
         if self.__task_manager__ is None:
-            self.__task_manager__ = ProcessTaskManager()
+            mp_context = None
+            if self.embedded:
+                enable_shared_context()
+                if "forkserver" in multiprocessing.get_all_start_methods():
+                    # do not fork a process that runs service threads
+                    mp_context = "forkserver"
+            self.__task_manager__ = ProcessTaskManager(
+                mp_context=mp_context, control_addr=self.control_addr
+            )
+            self.__supervisor__ = ServiceSupervisor(
+                self.__task_manager__, self.__lock__, self.supervisor_options
+            )
+            self.__autoscaler__ = ServiceAutoscaler(
+                self.__task_manager__,
+                self.__lock__,
+                self.scale_service,
+                self.autoscaler_options,
+            )
+
+        if self.control_addr and self.__control__ is None:
+            # bound before the workers connect to it
+            self.__control__ = ControlPublisher(self.control_addr)
 
         self.is_running = True
+        self.__supervisor__.start()
 
         service_descs = self.on_prepare_start()
+        self.__layers__ = dependency_layers(service_descs)
+        if self.plan_cpus:
+            self.__cpu_plans__ = self.__plan_cpus__(service_descs)
 
-        # launch all services
-        for k, v in service_descs.items():
-            self.__service_state__[k] = v
-            self.__submit_task__(k, v)
+        # launch the services of a layer in parallel
+        start_ts = time.time()
+        for layer in self.__layers__:
+            for k in layer:
+                self.__service_state__[k] = service_descs[k]
+                self.__submit_task__(k, service_descs[k])
+            self.__wait_ready__(layer)
+            if not self.is_running:
+                return "Services are stopping."
 
+        # scale once the pools are up
+        self.__autoscaler__.start()
+        self.is_ready = True
+        logger.info(
+            f"Services ready in {time.time() - start_ts:.2f}s, layers: {self.__layers__}"
+        )
         self.on_start_finished()
 
         return "Servcies started."
@@ -84,29 +338,176 @@ class BaseServiceManager:
         if self.is_terminating or self.is_exit:
             return "Services are stopping."
 
-        self.terminate()
+        self.terminate(keep_warm=True)
 
         return "Services stopped."
 
+    def get_service_health(self) -> List[Dict[str, Any]]:
+        if self.__supervisor__ is None:
+            return []
+        return self.__supervisor__.get_health()
+
+    def get_autoscale_metrics(self) -> Dict[str, Any]:
+        if self.__autoscaler__ is None:
+            return {"services": [], "decisions": []}
+        return self.__autoscaler__.get_metrics()
+
+    def scale_service(self, service_name: str, replicas: int) -> int:
+        """
+        Adds or removes replicas of a running work queue service, bounded by
+        ServiceConfig.replicas and max_replicas. A new replica asks for work
+        once its models are loaded, a removed one finishes the work it holds.
+        Returns the number of replicas.
+        """
+        with self.__lock__:
+            if self.is_terminating:
+                raise ValueError("Services are stopping.")
+            task_manager = self.__task_manager__
+            service = self.get_service(service_name)
+            if service is None or not self.__is_scalable__(service):
+                raise ValueError(f"Service is not scalable: {service_name}")
+            config = service.get_config()
+            replicas = min(max(replicas, config.replicas), config.max_replicas)
+            task_ids = self.__service_task_id_dict__[service_name]
+            dispatcher_id, replica_ids = task_ids[0], task_ids[1:]
+            while len(replica_ids) < replicas:
+                task_name, task_options = replica_task(
+                    service_name, len(replica_ids), config.options
+                )
+                replica_ids.append(
+                    self.__submit_one__(service_name, service, task_name, task_options)
+                )
+            removed = replica_ids[replicas:]
+            replica_ids = replica_ids[:replicas]
+            for task_id in removed:
+                self.__supervisor__.unwatch(task_id)
+            stopped = task_manager.signal_stop_tasks(removed)
+            self.__service_task_id_dict__[service_name] = [dispatcher_id, *replica_ids]
+            self.__autoscaler__.set_replicas(service_name, replica_ids)
+        # not under the lock, the removed replicas finish their work first
+        task_manager.wait_stopped(stopped)
+        return len(replica_ids)
+
+    def get_service_parameters(self) -> Dict[str, Dict[str, Any]]:
+        # the effective parameters of every running service
+        with self.__lock__:
+            return {
+                name: {
+                    "parameters": dict(service.get_config().parameters or {}),
+                    "live": service.get_live_parameters(),
+                }
+                for name, service in self.__service_state__.items()
+            }
+
+    def update_service_parameters(
+        self, service_name: str, updates: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        Applies updates of live parameters to the workers of a running
+        service, each worker between two messages. The workers of one
+        service class share the control topic. Raises ValueError when the
+        service does not run or an update is not allowed.
+        """
+        with self.__lock__:
+            service = self.get_service(service_name)
+            if service is None:
+                raise ValueError(f"Service is not running: {service_name}")
+            if self.__control__ is None:
+                raise ValueError("Service manager has no control channel.")
+            config = service.get_config()
+            parameters = config.parameters if config.parameters is not None else {}
+            updates = check_parameter_updates(
+                service.get_live_parameters(),
+                parameters,
+                updates,
+                service.get_parameters_type(),
+            )
+            if "model" in updates:
+                # not saved as an override when the workers can not load it
+                service.check_model(updates["model"])
+            if len(updates) > 0:
+                # a task restarted by the supervisor is launched with them
+                parameters.update(updates)
+                self.__parameter_overrides__.setdefault(service_name, {}).update(
+                    updates
+                )
+                self.__control__.publish(service.__class__, updates)
+                logger.info(f"Update parameters of {service_name}: {updates}")
+            return dict(parameters)
+
+    def swap_service_model(self, service_name: str, model: str) -> Dict[str, Any]:
+        """
+        Starts a hot swap of the model of a running service. Its workers
+        load and warm up the new model next to the running one and switch
+        to it between two utterances, nothing is restarted. The swap runs
+        in the background, this returns once the workers got the update.
+        """
+        service = self.get_service(service_name)
+        if service is None:
+            raise ValueError(f"Service is not running: {service_name}")
+        if "model" not in service.get_live_parameters():
+            raise ValueError(f"Service has no swappable model: {service_name}")
+        return self.update_service_parameters(service_name, {"model": model})
+
     def cancel_task_by_name(self, service_name: str):
         if (
             service_name in self.__service_state__
             and service_name in self.__service_task_id_dict__
         ):
-            task_id = self.__service_task_id_dict__[service_name]
-            service = self.__service_state__.pop(service_name, None)
-            self.__task_manager__.cancel_task(task_id)
-            self.__service_task_id_dict__.pop(service_name, None)
+            with self.__lock__:
+                task_ids = self.__service_task_id_dict__[service_name]
+                service = self.__service_state__.pop(service_name, None)
+                self.__autoscaler__.unwatch(service_name)
+                for task_id in task_ids:
+                    self.__supervisor__.unwatch(task_id)
+                    self.__task_manager__.cancel_task(task_id)
+                self.__service_task_id_dict__.pop(service_name, None)
             if service:
                 service.on_terminating()
 
-    def terminate(self):
+    def terminate(self, keep_warm: bool = False):
         self.on_terminate()
-        self.is_running = False
-        self.is_terminating = True
+        with self.__lock__:
+            # a scale_service call after this raises
+            self.is_running = False
+            self.is_ready = False
+            self.is_terminating = True
+        if self.__autoscaler__:
+            self.__autoscaler__.stop()
+        if self.__supervisor__:
+            # nothing is restarted while the tasks stop
+            self.__supervisor__.stop()
         if self.__task_manager__:
-            self.__task_manager__.terminate()
-            self.__task_manager__ = None
+            with self.__lock__:
+                layers, self.__layers__ = self.__layers__, []
+                transport = [
+                    name
+                    for name, service in self.__service_state__.items()
+                    if service.get_config().transport
+                ]
+                layers = [
+                    [name for name in layer if name not in transport]
+                    for layer in layers
+                ]
+                layers.append(transport)
+                layer_task_ids = [self.__get_task_ids__(layer) for layer in layers]
+            # not under the lock, the api answers while the layers drain
+            self.__drain__(layers, layer_task_ids)
+            with self.__lock__:
+                if keep_warm:
+                    # the worker processes stay for the next start
+                    self.__task_manager__.stop_all_tasks()
+                    self.__supervisor__.unwatch_all()
+                    self.__autoscaler__.unwatch_all()
+                else:
+                    self.__task_manager__.terminate()
+                    self.__task_manager__ = None
+                    self.__supervisor__ = None
+                    self.__autoscaler__ = None
+                self.__service_task_id_dict__ = {}
+        if self.__control__:
+            self.__control__.close()
+            self.__control__ = None
         exit_task_services: List[BaseService] = []
         for _, v in self.__service_state__.items():
             exit_task_services.append(v)
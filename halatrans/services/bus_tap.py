@@ -0,0 +1,303 @@
+"""
+Records the traffic of the backend bus and the audio stream into a file and
+publishes a recording back, so that a downstream service can be run and
+measured without a microphone or the OpenAI API.
+
+    python -m halatrans.services.bus_tap record tap.bin --duration 60
+    python -m halatrans.services.bus_tap replay tap.bin --speed 4
+
+The recorder reads the capture endpoint of the broker and the audio topic.
+The replayer publishes into the broker and binds the audio stream address.
+With --direct the services are addressed without the broker. A transcribe
+service fed by a replay must not use the shared memory ring, audio is
+replayed as PUB/SUB data messages.
+"""
+
+import argparse
+import json
+import logging
+import struct
+import time
+from collections import defaultdict
+from typing import (Any, BinaryIO, Dict, Generator, List, Optional, Sequence,
+                    Tuple)
+
+import zmq
+
+from halatrans.services.config import (CONST_ASSISTANT_PUB_ADDR,
+                                       CONST_ASSISTANT_PUB_TOPIC,
+                                       CONST_AUDIO_STREAM_PUB_ADDR,
+                                       CONST_AUDIO_STREAM_PUB_TOPIC,
+                                       CONST_BUS_CAPTURE_ADDR,
+                                       CONST_BUS_PUB_ADDR,
+                                       CONST_RTS2T_PUB_ADDR,
+                                       CONST_RTS2T_PUB_TOPIC,
+                                       CONST_TRANSCRIBE_PUB_ADDR,
+                                       CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
+                                       CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
+                                       CONST_TRANSLATION_PUB_ADDR,
+                                       CONST_TRANSLATION_PUB_TOPIC,
+                                       CONST_WHISPER_PUB_ADDR,
+                                       CONST_WHISPER_PUB_TOPIC)
+from halatrans.services.context import create_context
+from halatrans.services.qos import QosPublisher, create_qos_publisher
+from halatrans.services.utils import create_sub_socket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# File layout, little endian:
+#
+#   b"HTAP", version u16, metadata length u32, metadata (utf-8 JSON)
+#   records: ts_ns u64, frame count u16, (frame length u32, frame)*
+#
+# ts_ns is the receive time relative to the start of the recording. The
+# first frame of a record is the topic.
+TAP_MAGIC = b"HTAP"
+TAP_VERSION = 1
+TAP_FILE_HEADER = struct.Struct("<4sHI")
+TAP_RECORD_HEADER = struct.Struct("<QH")
+TAP_FRAME_HEADER = struct.Struct("<I")
+
+# topic -> publisher address of the service, when there is no broker
+TOPIC_SERVICE_ADDRS: Dict[str, str] = {
+    CONST_AUDIO_STREAM_PUB_TOPIC: CONST_AUDIO_STREAM_PUB_ADDR,
+    CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC: CONST_TRANSCRIBE_PUB_ADDR,
+    CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC: CONST_TRANSCRIBE_PUB_ADDR,
+    CONST_WHISPER_PUB_TOPIC: CONST_WHISPER_PUB_ADDR,
+    CONST_TRANSLATION_PUB_TOPIC: CONST_TRANSLATION_PUB_ADDR,
+    CONST_ASSISTANT_PUB_TOPIC: CONST_ASSISTANT_PUB_ADDR,
+    CONST_RTS2T_PUB_TOPIC: CONST_RTS2T_PUB_ADDR,
+}
+
+TapRecord = Tuple[int, List[bytes]]
+
+
+class TapWriter:
+    def __init__(self, f: BinaryIO, metadata: Dict[str, Any]):
+        self.f = f
+        meta = bytes(json.dumps(metadata), encoding="utf-8")
+        self.f.write(TAP_FILE_HEADER.pack(TAP_MAGIC, TAP_VERSION, len(meta)))
+        self.f.write(meta)
+
+    def write(self, ts_ns: int, frames: Sequence[Any]):
+        self.f.write(TAP_RECORD_HEADER.pack(ts_ns, len(frames)))
+        for frame in frames:
+            data = memoryview(frame.buffer if isinstance(frame, zmq.Frame) else frame)
+            self.f.write(TAP_FRAME_HEADER.pack(data.nbytes))
+            self.f.write(data)
+
+
+def read_tap_metadata(f: BinaryIO) -> Dict[str, Any]:
+    magic, version, meta_len = TAP_FILE_HEADER.unpack(f.read(TAP_FILE_HEADER.size))
+    if magic != TAP_MAGIC:
+        raise ValueError("Not a bus tap recording.")
+    if version != TAP_VERSION:
+        raise ValueError(f"Unsupported bus tap version {version}.")
+    return json.loads(f.read(meta_len))
+
+
+def read_tap_records(f: BinaryIO) -> Generator[TapRecord, None, None]:
+    # f must be positioned after the metadata
+    while True:
+        header = f.read(TAP_RECORD_HEADER.size)
+        if len(header) < TAP_RECORD_HEADER.size:
+            return
+        ts_ns, frame_count = TAP_RECORD_HEADER.unpack(header)
+        frames: List[bytes] = []
+        for _ in range(frame_count):
+            (frame_len,) = TAP_FRAME_HEADER.unpack(f.read(TAP_FRAME_HEADER.size))
+            frames.append(f.read(frame_len))
+        yield ts_ns, frames
+
+
+def record(
+    path: str,
+    sources: List[Tuple[str, List[str]]],
+    duration: Optional[float] = None,
+    max_messages: Optional[int] = None,
+):
+    """
+    Subscribes to every (addr, topics) source and appends each message to
+    the recording until the duration or the message count is reached, or
+    until interrupted.
+    """
+    ctx = create_context()
+    subs = [create_sub_socket(ctx, addr, topics) for addr, topics in sources]
+    poller = zmq.Poller()
+    for sub in subs:
+        poller.register(sub, zmq.POLLIN)
+
+    counts: Dict[bytes, int] = defaultdict(int)
+    total = 0
+    with open(path, "wb") as f:
+        writer = TapWriter(
+            f,
+            {
+                "start_time": time.time(),
+                "sources": [{"addr": a, "topics": t} for a, t in sources],
+            },
+        )
+        start_ns = time.perf_counter_ns()
+        deadline = None if duration is None else time.time() + duration
+        logger.info(f"Recording {sources} into {path}")
+        try:
+            while deadline is None or time.time() < deadline:
+                if max_messages is not None and total >= max_messages:
+                    break
+                for sub, _ in poller.poll(100):
+                    while True:
+                        try:
+                            frames = sub.recv_multipart(zmq.DONTWAIT, copy=False)
+                        except zmq.Again:
+                            break
+                        writer.write(time.perf_counter_ns() - start_ns, frames)
+                        counts[frames[0].bytes] += 1
+                        total += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for sub in subs:
+                sub.close(linger=0)
+            ctx.term()
+
+    stats = {str(k, encoding="utf-8"): v for k, v in counts.items()}
+    logger.info(f"Recorded {total} messages: {stats}")
+
+
+def replay(
+    path: str,
+    topic_addrs: Dict[str, str],
+    speed: float = 1.0,
+    warmup: float = 1.0,
+    loops: int = 1,
+):
+    """
+    Publishes a recording, every topic on its address in topic_addrs, other
+    topics are skipped. The recorded timing is kept at speed 1, compressed by the
+    speed factor above it, and speed 0 publishes as fast as possible.
+    """
+    ctx = create_context()
+    publishers: Dict[str, QosPublisher] = {}
+
+    def get_publisher(topic: str) -> Optional[QosPublisher]:
+        addr = topic_addrs.get(topic)
+        if addr is None:
+            return None
+        if addr not in publishers:
+            topics = [t for t, a in topic_addrs.items() if a == addr]
+            publishers[addr] = create_qos_publisher(ctx, addr, topics)
+        return publishers[addr]
+
+    # bind and connect everything before the subscribers are waited for
+    for topic in topic_addrs:
+        get_publisher(topic)
+
+    with open(path, "rb") as f:
+        metadata = read_tap_metadata(f)
+        records_offset = f.tell()
+        logger.info(f"Replay {path}, recorded at {metadata.get('start_time')}")
+        # subscribers of a new publisher join late
+        time.sleep(warmup)
+
+        sent = 0
+        max_lag_ns = 0
+        start_ts = time.perf_counter()
+        try:
+            for _ in range(loops):
+                f.seek(records_offset)
+                loop_start_ns = time.perf_counter_ns()
+                for ts_ns, frames in read_tap_records(f):
+                    publisher = get_publisher(str(frames[0], encoding="utf-8"))
+                    if publisher is None:
+                        continue
+                    if speed > 0:
+                        due_ns = loop_start_ns + int(ts_ns / speed)
+                        wait_ns = due_ns - time.perf_counter_ns()
+                        if wait_ns > 0:
+                            time.sleep(wait_ns / 1e9)
+                        else:
+                            max_lag_ns = max(max_lag_ns, -wait_ns)
+                    publisher.send_multipart(frames)
+                    sent += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            elapsed = time.perf_counter() - start_ts
+            for publisher in publishers.values():
+                publisher.close()
+            ctx.term()
+
+    logger.info(
+        f"Replayed {sent} messages in {elapsed:.2f}s, {sent / max(elapsed, 1e-9):.0f} msg/s, max lag {max_lag_ns / 1e6:.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="cmd", required=True)
+
+    record_parser = subparsers.add_parser("record")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--duration", type=float, default=None)
+    record_parser.add_argument("--max-messages", type=int, default=None)
+    record_parser.add_argument("--no-audio", action="store_true")
+    record_parser.add_argument(
+        "--direct", action="store_true", help="subscribe to every service"
+    )
+
+    replay_parser = subparsers.add_parser("replay")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument(
+        "--speed", type=float, default=1.0, help="0 replays unbounded"
+    )
+    replay_parser.add_argument("--warmup", type=float, default=1.0)
+    replay_parser.add_argument("--loops", type=int, default=1)
+    replay_parser.add_argument(
+        "--topics", nargs="*", default=None, help="only replay these topics"
+    )
+    replay_parser.add_argument(
+        "--direct", action="store_true", help="bind the address of every service"
+    )
+
+    args = parser.parse_args()
+
+    bus_topics = [t for t in TOPIC_SERVICE_ADDRS if t != CONST_AUDIO_STREAM_PUB_TOPIC]
+
+    if args.cmd == "record":
+        sources: List[Tuple[str, List[str]]] = []
+        if not args.no_audio:
+            sources.append(
+                (CONST_AUDIO_STREAM_PUB_ADDR, [CONST_AUDIO_STREAM_PUB_TOPIC])
+            )
+        if args.direct:
+            addrs: Dict[str, List[str]] = defaultdict(list)
+            for topic in bus_topics:
+                addrs[TOPIC_SERVICE_ADDRS[topic]].append(topic)
+            sources.extend(addrs.items())
+        else:
+            sources.append((CONST_BUS_CAPTURE_ADDR, bus_topics))
+        record(args.path, sources, args.duration, args.max_messages)
+        return
+
+    if args.direct:
+        topic_addrs = dict(TOPIC_SERVICE_ADDRS)
+    else:
+        # into the XSUB side of the broker, audio is not on the bus
+        topic_addrs = {t: ">" + CONST_BUS_PUB_ADDR for t in bus_topics}
+        topic_addrs[CONST_AUDIO_STREAM_PUB_TOPIC] = CONST_AUDIO_STREAM_PUB_ADDR
+    if args.topics is not None:
+        topic_addrs = {t: a for t, a in topic_addrs.items() if t in args.topics}
+    replay(
+        args.path,
+        topic_addrs,
+        speed=args.speed,
+        warmup=args.warmup,
+        loops=args.loops,
+    )
+
+
+if __name__ == "__main__":
+    main()
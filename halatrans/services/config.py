@@ -1,25 +1,68 @@
+# Service addresses are logical "svc://<name>" names, the address registry
+# resolves them to ipc://, inproc:// or tcp:// endpoints when the sockets are
+# bound and connected. See halatrans/services/address_registry.py.
+
 # frontend
 CONST_AUDIO_DEVICE_SERVICE = "audio-device"
 CONST_AUDIO_STREAM_SERVICE = "audio-stream"
 
-CONST_AUDIO_DEVICE_REP_ADDR = "tcp://localhost:5100"
+CONST_AUDIO_DEVICE_REP_ADDR = "svc://audio-device"
 
-CONST_AUDIO_STREAM_PUB_ADDR = "tcp://localhost:5101"
+CONST_AUDIO_STREAM_PUB_ADDR = "svc://audio-stream"
 CONST_AUDIO_STREAM_PUB_TOPIC = "audio-stream-pub"
+CONST_AUDIO_STREAM_SHM_NAME = "halatrans-audio-stream"
 
 # backend
-CONST_RTS2T_PUB_ADDR = "tcp://localhost:5200"
+CONST_RTS2T_PUB_ADDR = "svc://rts2t"
 CONST_RTS2T_PUB_TOPIC = "rts2t"
 
-CONST_TRANSCRIBE_PUB_ADDR = "tcp://localhost:5201"
+CONST_TRANSCRIBE_PUB_ADDR = "svc://transcribe"
 CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC = "partial"
 CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC = "fulltext"
 
-CONST_WHISPER_PUB_ADDR = "tcp://localhost:5202"
-CONST_WHISPER_PUB_TOPIC = "fulltext"
+CONST_WHISPER_PUB_ADDR = "svc://whisper"
+# must differ from the transcribe topics, they share the broker bus
+CONST_WHISPER_PUB_TOPIC = "whisper"
+CONST_WHISPER_REPLICAS = 2
+# the autoscaler adds replicas up to this under load
+CONST_WHISPER_MAX_REPLICAS = 4
+# queued utterances a replica decodes in one batched call
+CONST_WHISPER_MAX_BATCH = 4
+# dedicated cores per worker process when the cpus are planned
+CONST_WHISPER_CPU_THREADS = 4
+CONST_TRANSCRIBE_CPU_THREADS = 1
 
-CONST_TRANSLATION_PUB_ADDR = "tcp://localhost:5203"
+CONST_TRANSLATION_PUB_ADDR = "svc://translation"
 CONST_TRANSLATION_PUB_TOPIC = "translation"
 
-CONST_ASSISTANT_PUB_ADDR = "tcp://localhost:5204"
+CONST_ASSISTANT_PUB_ADDR = "svc://assistant"
 CONST_ASSISTANT_PUB_TOPIC = "assistant"
+
+# Backend message bus, publishers connect to the XSUB side, subscribers to
+# the XPUB side. The capture endpoint republishes all traffic for taps.
+CONST_BROKER_SERVICE = "broker"
+CONST_BUS_PUB_ADDR = "svc://bus-pub"
+CONST_BUS_SUB_ADDR = "svc://bus-sub"
+CONST_BUS_CAPTURE_ADDR = "svc://bus-capture"
+
+# Control channel of a service manager, it publishes parameter updates to
+# its workers. See halatrans/services/live_parameters.py.
+CONST_FRONTEND_CONTROL_ADDR = "svc://frontend-control"
+CONST_BACKEND_CONTROL_ADDR = "svc://backend-control"
+
+# Fixed ports used by the "tcp" transport, same as the former hard-coded
+# addresses.
+CONST_SERVICE_TCP_PORTS = {
+    "audio-device": 5100,
+    "audio-stream": 5101,
+    "frontend-control": 5120,
+    "rts2t": 5200,
+    "transcribe": 5201,
+    "whisper": 5202,
+    "translation": 5203,
+    "assistant": 5204,
+    "bus-pub": 5210,
+    "bus-sub": 5211,
+    "bus-capture": 5212,
+    "backend-control": 5220,
+}
@@ -0,0 +1,59 @@
+import logging
+import os
+from typing import Optional
+
+import zmq
+import zmq.asyncio
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Services create their zmq context with create_context(). By default every
+# worker gets its own context. When the services of a manager run as threads
+# of one process (embedded mode) they get shadows of one shared context, so
+# the address registry connects them over inproc:// instead of ipc or tcp.
+
+
+class SharedContext(zmq.Context):
+    def term(self):
+        # other services still use the shared context, only the sockets of
+        # this shadow are closed by destroy()
+        pass
+
+
+class SharedAsyncContext(zmq.asyncio.Context):
+    def term(self):
+        pass
+
+
+__shared_context__: Optional[zmq.Context] = None
+__shared_context_pid__ = 0
+
+
+def enable_shared_context():
+    global __shared_context__, __shared_context_pid__
+    if __shared_context__ is None:
+        __shared_context__ = zmq.Context.instance()
+        __shared_context_pid__ = os.getpid()
+        logger.info("Shared zmq context enabled.")
+
+
+def get_shared_context() -> Optional[zmq.Context]:
+    # a forked worker process inherits the module state, not a usable context
+    if __shared_context__ is None or __shared_context_pid__ != os.getpid():
+        return None
+    return __shared_context__
+
+
+def create_context() -> zmq.Context:
+    shared = get_shared_context()
+    if shared is None:
+        return zmq.Context()
+    return SharedContext.shadow(shared.underlying)
+
+
+def create_async_context() -> zmq.asyncio.Context:
+    shared = get_shared_context()
+    if shared is None:
+        return zmq.asyncio.Context()
+    return SharedAsyncContext.shadow(shared.underlying)
@@ -0,0 +1,116 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Every worker process runs its own thread pools, ctranslate2 for whisper,
+# OpenMP and the BLAS of numpy. Each sizes them to all cores of the host by
+# default, so N processes start N times as many threads as there are cores.
+#
+# The planner gives every process task a thread budget and the cores it runs
+# on. Tasks of services with ServiceConfig.cpu_threads > 0 get dedicated
+# cores. All other tasks (I/O, dispatchers, light stages) share a few common
+# cores and run one thread each.
+#
+# The plan is applied in the worker process before the service starts:
+#   - the cpu affinity of the process
+#   - the thread count variables of OpenMP and the BLAS libraries, they take
+#     effect for libraries the worker loads after that
+#   - threadpoolctl, when installed, also resizes the pools of libraries the
+#     worker inherited loaded from the manager process
+#   - CPU_THREADS_ENV, which services read with get_cpu_threads(), e.g. the
+#     cpu_threads of the whisper model
+
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+CPU_THREADS_ENV = "HALATRANS_CPU_THREADS"
+# cores shared by the tasks without dedicated cores
+DEFAULT_SHARED_CPUS = 2
+
+
+@dataclass
+class CpuPlan:
+    cpus: List[int]
+    threads: int
+
+
+def available_cpus() -> List[int]:
+    # the cores this process may run on, not every core of the host
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_cpus(
+    demands: Dict[str, int],
+    cpus: Optional[List[int]] = None,
+    shared_cpus: int = DEFAULT_SHARED_CPUS,
+) -> Dict[str, CpuPlan]:
+    """
+    Plans the cores of tasks by the dedicated cores they ask for, 0 for a
+    task that shares the common cores. When there are not enough cores, the
+    dedicated tasks get a share of them in proportion, at least one core
+    each, and neighbours overlap.
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    if len(cpus) == 0:
+        raise ValueError("No cpu to plan.")
+
+    has_shared = any(want <= 0 for want in demands.values())
+    has_dedicated = any(want > 0 for want in demands.values())
+    # keep a core for the dedicated tasks
+    n_shared = 0
+    if has_shared:
+        n_shared = min(shared_cpus, len(cpus) - 1) if has_dedicated else len(cpus)
+        n_shared = max(n_shared, 1)
+    shared = cpus[:n_shared]
+    dedicated = cpus[n_shared:] if len(cpus) > n_shared else cpus
+
+    wanted = sum(want for want in demands.values() if want > 0)
+    scale = min(1.0, len(dedicated) / wanted) if wanted > 0 else 1.0
+
+    plans: Dict[str, CpuPlan] = {}
+    cursor = 0
+    for name, want in demands.items():
+        if want <= 0:
+            plans[name] = CpuPlan(cpus=list(shared), threads=1)
+            continue
+        count = max(1, int(want * scale))
+        picked = [dedicated[(cursor + i) % len(dedicated)] for i in range(count)]
+        cursor += count
+        plans[name] = CpuPlan(cpus=sorted(set(picked)), threads=count)
+    return plans
+
+
+def apply_cpu_plan(plan: CpuPlan):
+    threads = str(plan.threads)
+    for key in THREAD_ENV_VARS:
+        os.environ[key] = threads
+    os.environ[CPU_THREADS_ENV] = threads
+
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, plan.cpus)
+        except OSError as err:
+            logger.warning(f"Can not set cpu affinity {plan.cpus}: {err}")
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=plan.threads)
+
+
+def get_cpu_threads(default: int = 0) -> int:
+    # the thread budget of this worker, default without a plan
+    value = os.environ.get(CPU_THREADS_ENV)
+    return int(value) if value else default
@@ -1,11 +1,11 @@
 import logging
-from multiprocessing.managers import ValueProxy
 from typing import Any, Dict, Generator, Optional
 
 from halatrans.services.base_service import (CustomService,
                                              PublishSubscribeService,
                                              RequestResponseService,
                                              ServiceConfig)
+from halatrans.services.shutdown import ShutdownFlag
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -40,8 +40,6 @@ class ServiceTemplateC(CustomService):
         super().__init__(config)
 
     @staticmethod
-    def on_worker_process_custom(
-        stop_flag: ValueProxy[int], parameters: Dict[str, Any]
-    ):
+    def on_worker_process_custom(stop_flag: ShutdownFlag, parameters: Dict[str, Any]):
         # override this method
         pass
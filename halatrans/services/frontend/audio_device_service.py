@@ -20,6 +20,13 @@ class AudioDeviceService(RequestResponseService):
     def __init__(self, config: ServiceConfig):
         super().__init__(config)
 
+    @staticmethod
+    def get_request_type(parameters: Dict[str, Any], topic: str, chunk: bytes) -> str:
+        try:
+            return json.loads(chunk)["cmd"]
+        except Exception:
+            return "unknown"
+
     @staticmethod
     def on_worker_process_response(
         parameters: Dict[str, Any], topic: str, chunk: bytes
@@ -2,12 +2,13 @@ import logging
 # import signal
 from dataclasses import dataclass
 # from multiprocessing.managers import ValueProxy
-from typing import Any, Dict, Generator, Optional
+from typing import Any, Dict, Generator, List, Optional
 
 import sounddevice as sd
 
 from halatrans.services.base_service import (PublishSubscribeService,
                                              ServiceConfig)
+from halatrans.services.shm_ring_buffer import ShmRingWriter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,12 +20,29 @@ class AudioStreamServiceParameters:
     blocksize: int = 8000
     channels: int = 1
     device: Optional[int] = None
+    shm_name: Optional[str] = None  # also write blocks to a shared memory ring
+    shm_slots: int = 64
 
 
 class AudioStreamService(PublishSubscribeService):
     def __init__(self, config: ServiceConfig):
         super().__init__(config)
 
+    @staticmethod
+    def get_live_parameters() -> List[str]:
+        return ["blocksize"]
+
+    @staticmethod
+    def on_worker_process_shm_ring(
+        parameters: Dict[str, Any],
+    ) -> Optional[ShmRingWriter]:
+        config = AudioStreamServiceParameters(**parameters)
+        if config.shm_name is None:
+            return None
+        # int16 samples
+        slot_size = config.blocksize * config.channels * 2
+        return ShmRingWriter(config.shm_name, config.shm_slots, slot_size)
+
     @staticmethod
     def on_worker_process_publisher(
         parameters: Dict[str, Any],
@@ -40,7 +58,11 @@ class AudioStreamService(PublishSubscribeService):
                 dtype="int16",
             ) as stream:
                 while True:
-                    data, overflowed = stream.read(config.blocksize)
+                    blocksize = parameters["blocksize"]
+                    if config.shm_name and blocksize > config.blocksize:
+                        # a ring slot holds a block of the start blocksize
+                        blocksize = config.blocksize
+                    data, overflowed = stream.read(blocksize)
                     if overflowed:
                         logger.warn("Warning: Buffer overflow!")
 
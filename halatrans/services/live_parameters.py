@@ -0,0 +1,142 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional, get_args, get_type_hints
+
+import zmq
+
+from halatrans.services.context import create_context
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import create_pub_socket, create_sub_socket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Parameter updates of a running service, without restarting its workers.
+#
+# The manager binds a PUB socket at its control address and publishes
+# [control topic, json updates]. The control topic is the class name of the
+# service, every worker of it (e.g. all replicas) gets the update. A worker
+# calls LiveParameters.poll() between two messages, so a message is always
+# handled with one consistent set of parameters.
+#
+# Only the keys a service lists in get_live_parameters() can be updated,
+# anything else needs a restart. An update keeps the type of the current
+# value, only the Optional fields of the parameters dataclass of the service
+# (see BaseService.get_parameters_type()) can be set to None.
+
+CONTROL_TOPIC_PREFIX = "control."
+
+
+def control_topic(cls: type) -> str:
+    return CONTROL_TOPIC_PREFIX + cls.__name__
+
+
+def _check_type(key: str, current: Any, value: Any, hint: Any = None) -> Any:
+    # hint is the annotation of the field, e.g. Optional[str]
+    types = get_args(hint)
+    if value is None and type(None) in types:
+        return value
+    if current is None:
+        # the type of an Optional field set to None
+        others = [t for t in types if t is not type(None)]
+        if len(others) != 1 or not isinstance(others[0], type):
+            return value
+        current = others[0]()
+    if isinstance(current, bool) or isinstance(value, bool):
+        ok = type(current) is type(value)
+    elif isinstance(current, float):
+        ok = isinstance(value, (int, float))
+        value = float(value) if ok else value
+    else:
+        ok = isinstance(value, type(current))
+    if not ok:
+        raise ValueError(
+            f"Parameter {key} expects {type(current).__name__}, got {value!r}."
+        )
+    return value
+
+
+def check_parameter_updates(
+    live_keys: List[str],
+    parameters: Dict[str, Any],
+    updates: Dict[str, Any],
+    parameters_type: Optional[type] = None,
+) -> Dict[str, Any]:
+    """
+    Returns the updates with the types of the current parameters, raises
+    ValueError for unknown keys, keys that are not live and wrong types.
+    """
+    hints = get_type_hints(parameters_type) if parameters_type else {}
+    checked: Dict[str, Any] = {}
+    for key, value in updates.items():
+        if key not in parameters:
+            raise ValueError(f"Unknown parameter: {key}")
+        if key not in live_keys:
+            raise ValueError(f"Parameter {key} can not be updated while running.")
+        checked[key] = _check_type(key, parameters[key], value, hints.get(key))
+    return checked
+
+
+class ControlPublisher:
+    def __init__(self, addr: str):
+        self.ctx = create_context()
+        self.sock = create_pub_socket(self.ctx, addr)
+
+    def publish(self, cls: type, updates: Dict[str, Any]):
+        self.sock.send_multipart(
+            [
+                bytes(control_topic(cls), encoding="utf-8"),
+                bytes(json.dumps(updates), encoding="utf-8"),
+            ]
+        )
+
+    def close(self):
+        self.sock.close(linger=0)
+        self.ctx.term()
+
+
+class LiveParameters:
+    """
+    The parameters of one worker. parameters is a copy of what the worker
+    was launched with, poll() applies the pending updates to it in place.
+    Without a control address of the manager, nothing is ever updated.
+    """
+
+    def __init__(
+        self,
+        ctx: zmq.Context,
+        stop_flag: ShutdownFlag,
+        cls: type,
+        parameters: Dict[str, Any],
+    ):
+        self.name = cls.__name__
+        self.parameters = dict(parameters)
+        self.sock: Optional[zmq.Socket] = None
+        if stop_flag.control_addr:
+            self.sock = create_sub_socket(
+                ctx, stop_flag.control_addr, [control_topic(cls)]
+            )
+
+    def poll(self) -> bool:
+        if self.sock is None:
+            return False
+        updated = False
+        while True:
+            try:
+                _, chunk = self.sock.recv_multipart(zmq.DONTWAIT)
+            except zmq.Again:
+                break
+            try:
+                updates = json.loads(chunk)
+            except ValueError as err:
+                logger.error(f"Invalid parameter update of {self.name}: {err}")
+                continue
+            self.parameters.update(updates)
+            logger.info(f"Update parameters of {self.name}: {updates}")
+            updated = True
+        return updated
+
+    def close(self):
+        if self.sock:
+            self.sock.close(linger=0)
+            self.sock = None
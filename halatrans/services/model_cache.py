@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Models are loaded once per process and kept for the life of the process,
+# a warm worker (ServiceConfig.warm) serves the next start of its service
+# without loading them again.
+#
+# Environment:
+#   HALATRANS_MODEL_DIR   local model directory, a model is a sub directory
+#                         named after the model, e.g. vosk-model-en-us-0.42-gigaspeech
+
+DEFAULT_MODEL_DIR = os.path.join("~", ".cache", "halatrans", "models")
+
+__loaded_models__: Dict[str, Any] = {}
+__loaded_models_lock__ = threading.Lock()
+
+
+def get_model_dir() -> str:
+    return os.path.expanduser(os.environ.get("HALATRANS_MODEL_DIR", DEFAULT_MODEL_DIR))
+
+
+def resolve_model_path(name: str) -> Optional[str]:
+    path = os.path.join(get_model_dir(), name)
+    if os.path.isdir(path):
+        return path
+    logger.warning(f"Model {name} is not in {get_model_dir()}, load it by name.")
+    return None
+
+
+def is_model_loaded(key: str) -> bool:
+    return key in __loaded_models__
+
+
+def load_model(
+    key: str,
+    loader: Callable[[], Any],
+    warmup: Optional[Callable[[Any], None]] = None,
+) -> Any:
+    """
+    Returns the model of key, loaded by loader on the first call of the
+    process. warmup runs one inference right after loading, so that the
+    first real request does not pay for lazy initialization.
+    """
+    with __loaded_models_lock__:
+        if key in __loaded_models__:
+            logger.info(f"Model {key} is warm.")
+            return __loaded_models__[key]
+
+        load_start_ts = time.time()
+        model = loader()
+        warmup_start_ts = time.time()
+        if warmup:
+            warmup(model)
+        logger.info(
+            f"Model {key} loaded in {warmup_start_ts - load_start_ts:.2f}s, warm-up {time.time() - warmup_start_ts:.2f}s"
+        )
+        __loaded_models__[key] = model
+        return model
+
+
+def unload_model(key: str):
+    # the model is freed once its last user drops it
+    with __loaded_models_lock__:
+        if __loaded_models__.pop(key, None) is not None:
+            logger.info(f"Model {key} unloaded.")
+
+
+class HotSwapModel:
+    """
+    A model that is replaced while it serves. swap() loads and warms up the
+    replacement in a background thread next to the current model. get()
+    returns the current model and switches to the replacement once it is
+    warm, so the utterance in progress finishes with the old model and the
+    next one uses the new model. The old model is unloaded after the switch,
+    a failed load keeps it. A swap during a load is applied once the load
+    finishes, the latest one wins.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[str], Any],
+        warmup: Optional[Callable[[Any], None]] = None,
+        key_prefix: str = "",
+    ):
+        self.loader = loader
+        self.warmup = warmup
+        self.key_prefix = key_prefix
+        self.name = name
+        self.model = load_model(self.__key__(name), lambda: loader(name), warmup)
+        self.__lock__ = threading.Lock()
+        self.__loading__: Optional[str] = None
+        self.__pending__: Optional[str] = None
+        self.__ready__: Optional[Tuple[str, Any]] = None
+
+    def __key__(self, name: str) -> str:
+        return self.key_prefix + name
+
+    @property
+    def is_swapping(self) -> bool:
+        with self.__lock__:
+            return self.__loading__ is not None or self.__ready__ is not None
+
+    def swap(self, name: str) -> bool:
+        # False when the model is already current or on its way
+        with self.__lock__:
+            if self.__loading__ is not None:
+                if name == (self.__pending__ or self.__loading__):
+                    return False
+                # after the current load, none if it is the one wanted
+                self.__pending__ = None if name == self.__loading__ else name
+                logger.info(
+                    f"Model {self.__loading__} is still loading, swap to {name} after it."
+                )
+                return True
+            target = self.__ready__[0] if self.__ready__ else self.name
+            if name == target:
+                return False
+            self.__loading__ = name
+        self.__start_load__(name)
+        return True
+
+    def __start_load__(self, name: str):
+        logger.info(f"Swap model {self.name} to {name}, loading...")
+        threading.Thread(
+            target=self.__load__, args=(name,), name="model-swap", daemon=True
+        ).start()
+
+    def get(self) -> Any:
+        with self.__lock__:
+            ready, self.__ready__ = self.__ready__, None
+        if ready is None:
+            return self.model
+        old_name = self.name
+        self.name, self.model = ready
+        if old_name != self.name:
+            unload_model(self.__key__(old_name))
+        logger.info(f"Model swapped from {old_name} to {self.name}.")
+        return self.model
+
+    def __load__(self, name: str):
+        try:
+            model = load_model(
+                self.__key__(name), lambda: self.loader(name), self.warmup
+            )
+        except Exception as err:
+            logger.error(f"Load model {name} failed, keep {self.name}: {err}")
+            model = None
+        replaced: Optional[Tuple[str, Any]] = None
+        with self.__lock__:
+            self.__loading__ = None
+            if model is not None:
+                replaced, self.__ready__ = self.__ready__, (name, model)
+            pending, self.__pending__ = self.__pending__, None
+            if pending == self.name:
+                # swapped back to the current model, the replacement is unused
+                replaced, self.__ready__ = self.__ready__, None
+                pending = None
+            elif pending:
+                self.__loading__ = pending
+        # swapped again before the replacement was used
+        if replaced and replaced[0] != self.name:
+            unload_model(self.__key__(replaced[0]))
+        if pending:
+            self.__start_load__(pending)
@@ -1,47 +1,266 @@
 import concurrent
 import logging
 import multiprocessing
-from concurrent.futures import Future, ProcessPoolExecutor
-from multiprocessing.managers import ValueProxy
-from typing import Dict, Tuple
+import os
+import signal
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
 
 from halatrans.services.base_service import BaseService
+from halatrans.services.cpu_planner import CpuPlan
+from halatrans.services.shutdown import (ShutdownFlag, ShutdownFlagPool,
+                                         TaskHeartbeat)
 from halatrans.worker import worker
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 ServiceState = Dict[str, BaseService]
-ServiceTaskIdDict = Dict[str, str]
-TaskStateType = Tuple[Future, ValueProxy[int]]
+ServiceTaskIdDict = Dict[str, List[str]]
+TaskStateType = Tuple[Future, ShutdownFlag]
+
+# Every service task occupies a worker process for its whole life, this is
+# the limit of process tasks that run at the same time.
+DEFAULT_MAX_WORKERS = 32
+# a process task that did not stop this long after its stop flag is killed
+DEFAULT_STOP_TIMEOUT = 10.0  # seconds
+
+
+@dataclass
+class TaskLaunch:
+    # what a task was submitted with, to launch it again after a crash
+    service: BaseService
+    args: Tuple[Any, ...]
+    in_thread: bool
+    warm_key: Optional[str]
+    cpu_plan: Optional[CpuPlan] = None
 
 
 class ProcessTaskManager:
-    def __init__(self):
+    """
+    Runs every process task in its own single worker executor, a worker that
+    crashed or hangs is replaced without touching the other tasks.
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        mp_context: Optional[str] = None,
+        control_addr: Optional[str] = None,
+    ):
         self.counter = 0
+        self.max_workers = max_workers if max_workers else DEFAULT_MAX_WORKERS
         self.future_dict: Dict[str, TaskStateType] = {}
-        self.executor: ProcessPoolExecutor = ProcessPoolExecutor()
-        self.manager = multiprocessing.Manager()
+        self.task_launches: Dict[str, TaskLaunch] = {}
+        # the workers find the control channel of the manager by their flag
+        self.flag_pool = ShutdownFlagPool(control_addr=control_addr)
+        self.mp_context = multiprocessing.get_context(mp_context)
+        # task id -> worker of a task, shut down with the task
+        self.task_executors: Dict[str, ProcessPoolExecutor] = {}
+        # warm key -> single worker that always runs the tasks of the key, so
+        # the models it loaded are reused by the next task
+        self.warm_executors: Dict[str, ProcessPoolExecutor] = {}
+        # embedded services, created on first use
+        self.thread_executor: Optional[ThreadPoolExecutor] = None
 
     def gen_next_task_id(self) -> str:
         self.counter += 1
         task_id = "task-" + str(self.counter)
         return task_id
 
-    def submit(self, service: BaseService, *args) -> str:
-        task_id = self.gen_next_task_id()
-        future, stop_flag = worker.launch_process(
-            self.executor,
-            self.manager,
-            service.__class__,
+    def __get_thread_executor__(self) -> ThreadPoolExecutor:
+        if self.thread_executor is None:
+            self.thread_executor = ThreadPoolExecutor(
+                max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="service"
+            )
+        return self.thread_executor
+
+    def __create_process_executor__(self, mp_context: Any) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=mp_context,
+            initializer=self.flag_pool.get_initializer(),
+            initargs=self.flag_pool.get_initargs(),
+        )
+
+    def __get_warm_executor__(self, warm_key: str) -> ProcessPoolExecutor:
+        if warm_key not in self.warm_executors:
+            # a clean process from the fork server, not a fork of this one
+            start_method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else None
+            )
+            self.warm_executors[warm_key] = self.__create_process_executor__(
+                multiprocessing.get_context(start_method)
+            )
+        return self.warm_executors[warm_key]
+
+    def __get_process_executor__(
+        self, task_id: str, warm_key: Optional[str]
+    ) -> ProcessPoolExecutor:
+        if warm_key:
+            return self.__get_warm_executor__(warm_key)
+        if task_id not in self.task_executors:
+            if len(self.task_executors) >= self.max_workers:
+                raise ValueError(f"Too many process tasks, max: {self.max_workers}")
+            self.task_executors[task_id] = self.__create_process_executor__(
+                self.mp_context
+            )
+        return self.task_executors[task_id]
+
+    def __release_process_executor__(self, task_id: str, broken: bool = False):
+        launch = self.task_launches.get(task_id)
+        if launch and launch.warm_key:
+            if not broken:
+                return
+            executor = self.warm_executors.pop(launch.warm_key, None)
+        else:
+            executor = self.task_executors.pop(task_id, None)
+        if executor:
+            executor.shutdown(wait=False)
+
+    def __launch__(
+        self, task_id: str, launch: TaskLaunch, stop_flag: Optional[ShutdownFlag]
+    ) -> Tuple[Future, ShutdownFlag]:
+        if launch.in_thread:
+            return worker.launch_thread(
+                self.__get_thread_executor__(),
+                self.flag_pool,
+                launch.service.__class__,
+                task_id,
+                *launch.args,
+                stop_flag=stop_flag,
+            )
+        return worker.launch_process(
+            self.__get_process_executor__(task_id, launch.warm_key),
+            self.flag_pool,
+            launch.service.__class__,
             task_id,
-            *args,
+            *launch.args,
+            stop_flag=stop_flag,
+            cpu_plan=launch.cpu_plan,
         )
+
+    def submit(
+        self,
+        service: BaseService,
+        *args,
+        in_thread: bool = False,
+        warm_key: Optional[str] = None,
+        cpu_plan: Optional[CpuPlan] = None,
+    ) -> str:
+        task_id = self.gen_next_task_id()
+        # a thread runs on the cores of this process, it has no plan
+        launch = TaskLaunch(
+            service, args, in_thread, warm_key, None if in_thread else cpu_plan
+        )
+        future, stop_flag = self.__launch__(task_id, launch, None)
         self.future_dict[task_id] = (future, stop_flag)
-        service.on_worker_process_launched(stop_flag)
+        self.task_launches[task_id] = launch
+        # a helper of the manager process must not beat for the worker
+        service.on_worker_process_launched(stop_flag.observer())
         logger.info(f"submit task {task_id}")
         return task_id
 
+    def is_task_in_thread(self, task_id: str) -> bool:
+        launch = self.task_launches.get(task_id)
+        return launch is not None and launch.in_thread
+
+    def get_task_future(self, task_id: str) -> Optional[Future]:
+        if task_id not in self.future_dict:
+            return None
+        return self.future_dict[task_id][0]
+
+    def is_task_stopping(self, task_id: str) -> bool:
+        if task_id not in self.future_dict:
+            return True
+        return self.future_dict[task_id][1].is_set()
+
+    def is_task_ready(self, task_id: str) -> bool:
+        # the worker entered its message loop, its sockets are bound or
+        # connected and subscribed. A task that ended is left to the supervisor.
+        if task_id not in self.future_dict:
+            return True
+        future, stop_flag = self.future_dict[task_id]
+        return future.done() or self.flag_pool.get_heartbeat(stop_flag).iterations > 0
+
+    def get_task_heartbeat(self, task_id: str) -> Optional[TaskHeartbeat]:
+        if task_id not in self.future_dict:
+            return None
+        return self.flag_pool.get_heartbeat(self.future_dict[task_id][1])
+
+    def get_task_error(self, task_id: str) -> Optional[str]:
+        future = self.get_task_future(task_id)
+        if future is None or not future.done():
+            return None
+        if future.cancelled():
+            return "cancelled"
+        err = future.exception()
+        if err is not None:
+            return f"{type(err).__name__}: {err}"
+        return future.result()
+
+    def restart_task(self, task_id: str, timeout: float = 5.0) -> bool:
+        """
+        Launches a task again with its stop flag, the id stays the same. A
+        process task that still runs is killed first, a thread can not be.
+        """
+        if task_id not in self.future_dict:
+            return False
+        future, stop_flag = self.future_dict[task_id]
+        if not future.done():
+            if self.is_task_in_thread(task_id):
+                logger.error(f"Task {task_id} runs in a thread, can not restart it.")
+                return False
+            self.__kill_worker__(task_id, stop_flag)
+            concurrent.futures.wait([future], timeout=timeout)
+            if not future.done():
+                logger.error(f"Worker of task {task_id} did not exit.")
+                return False
+
+        if self.__is_broken__(future):
+            self.__release_process_executor__(task_id, broken=True)
+        self.flag_pool.reset_heartbeat(stop_flag)
+        launch = self.task_launches[task_id]
+        future, stop_flag = self.__launch__(task_id, launch, stop_flag)
+        self.future_dict[task_id] = (future, stop_flag)
+        logger.info(f"restart task {task_id}")
+        return True
+
+    def __kill_worker__(self, task_id: str, stop_flag: ShutdownFlag):
+        pid = self.flag_pool.get_heartbeat(stop_flag).pid
+        if pid <= 0:
+            return
+        logger.warning(f"Kill worker {pid} of task {task_id}")
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def __is_broken__(self, future: Future) -> bool:
+        return not future.cancelled() and isinstance(
+            future.exception(), BrokenProcessPool
+        )
+
+    def __finish_task__(self, task_id: str, future: Future, stop_flag: ShutdownFlag):
+        self.flag_pool.release(stop_flag)
+        self.__release_process_executor__(task_id, broken=self.__is_broken__(future))
+        self.task_launches.pop(task_id, None)
+
+    def wait_stopped(self, tasks: List[Tuple[str, Future, ShutdownFlag]]):
+        futures = [future for _, future, _ in tasks]
+        _, not_done = concurrent.futures.wait(futures, timeout=DEFAULT_STOP_TIMEOUT)
+        for task_id, future, stop_flag in tasks:
+            if future in not_done and not self.is_task_in_thread(task_id):
+                self.__kill_worker__(task_id, stop_flag)
+        # a thread that does not stop is waited for
+        concurrent.futures.wait(futures)
+        for task_id, future, stop_flag in tasks:
+            self.__finish_task__(task_id, future, stop_flag)
+
     def cancel_task(self, task_id: str):
         if task_id in self.future_dict:
             logger.info("Canceling task: {task_id}")
@@ -49,24 +268,43 @@ class ProcessTaskManager:
             if future:
                 logger.info("Set stop flag for task and wait for finish. {task_id}")
                 stop_flag.set(1)
-                concurrent.futures.wait([future])
+                self.wait_stopped([(task_id, future, stop_flag)])
                 logger.info("Task finish. {task_id}")
         else:
             logger.info(f"Task not exist. {task_id}")
 
-    def stop_all_tasks(self):
-        futures = []
-        for k, v in self.future_dict.items():
-            future, stop_flag = v
+    def stop_tasks(self, task_ids: List[str]):
+        # the tasks stop in parallel
+        self.wait_stopped(self.signal_stop_tasks(task_ids))
+
+    def signal_stop_tasks(
+        self, task_ids: List[str]
+    ) -> List[Tuple[str, Future, ShutdownFlag]]:
+        """
+        Sets the stop flags and forgets the tasks, without waiting for them.
+        The caller passes the result to wait_stopped(), e.g. after it released
+        a lock the workers do not need.
+        """
+        stopped: List[Tuple[str, Future, ShutdownFlag]] = []
+        for task_id in task_ids:
+            if task_id not in self.future_dict:
+                continue
+            future, stop_flag = self.future_dict.pop(task_id)
             if future:
                 stop_flag.set(1)
-                futures.append(future)
-        logger.info(f"Stop all tasks, task count: {len(futures)}")
-        self.future_dict = {}
-        concurrent.futures.wait(futures)
+                stopped.append((task_id, future, stop_flag))
+        return stopped
+
+    def stop_all_tasks(self):
+        logger.info(f"Stop all tasks, task count: {len(self.future_dict)}")
+        self.stop_tasks(list(self.future_dict.keys()))
 
     def terminate(self):
         self.stop_all_tasks()
-        self.executor.shutdown()
-        self.manager.shutdown()
+        if self.thread_executor:
+            self.thread_executor.shutdown()
+            self.thread_executor = None
+        for executor in self.warm_executors.values():
+            executor.shutdown()
+        self.warm_executors = {}
         logger.info("terminate finish.")
@@ -0,0 +1,315 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import zmq
+
+from halatrans.model.envelope import MessageKind, decode_envelope
+from halatrans.services.config import (CONST_ASSISTANT_PUB_TOPIC,
+                                       CONST_AUDIO_STREAM_PUB_TOPIC,
+                                       CONST_RTS2T_PUB_TOPIC,
+                                       CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
+                                       CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
+                                       CONST_TRANSLATION_PUB_TOPIC,
+                                       CONST_WHISPER_PUB_TOPIC)
+from halatrans.services.shm_ring_buffer import shm_notify_topic
+from halatrans.services.utils import (attach_socket, create_pub_socket,
+                                      create_sub_socket)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QOS_STATS_LOG_INTERVAL = 60.0  # seconds
+# how often the owner of a non-blocking publisher retries held back messages
+QOS_RETRY_INTERVAL_MS = 10
+
+
+@dataclass
+class TopicQos:
+    # A lossless send waits up to send_timeout for a slow subscriber before
+    # the message is dropped and counted. A lossy send never waits.
+    lossless: bool = True
+    hwm: int = 1000  # messages queued per peer
+    send_timeout: int = 1000  # ms
+    # lossy, a message that can not be sent is replaced by a newer one with
+    # the same key, only the latest is sent once the subscriber catches up
+    conflate: bool = False
+
+
+DEFAULT_TOPIC_QOS = TopicQos()
+
+TOPIC_QOS: Dict[str, TopicQos] = {
+    # bounded buffer, the audio callback must never block for long
+    CONST_AUDIO_STREAM_PUB_TOPIC: TopicQos(lossless=True, hwm=500, send_timeout=50),
+    shm_notify_topic(CONST_AUDIO_STREAM_PUB_TOPIC): TopicQos(
+        lossless=False, hwm=100, conflate=True
+    ),
+    # only the latest partial of an utterance matters
+    CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC: TopicQos(
+        lossless=False, hwm=100, conflate=True
+    ),
+    CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC: TopicQos(lossless=True, hwm=200),
+    CONST_WHISPER_PUB_TOPIC: TopicQos(lossless=True),
+    CONST_TRANSLATION_PUB_TOPIC: TopicQos(lossless=True),
+    CONST_ASSISTANT_PUB_TOPIC: TopicQos(lossless=True),
+    CONST_RTS2T_PUB_TOPIC: TopicQos(lossless=True),
+}
+
+
+def get_topic_qos(topic: str) -> TopicQos:
+    return TOPIC_QOS.get(topic, DEFAULT_TOPIC_QOS)
+
+
+def topics_hwm(topics: Sequence[str]) -> int:
+    # HWM is per socket, the most demanding topic wins
+    if len(topics) == 0:
+        return DEFAULT_TOPIC_QOS.hwm
+    return max(get_topic_qos(topic).hwm for topic in topics)
+
+
+def create_qos_sub_socket(ctx: zmq.Context, addr: str, topics: List[str]) -> zmq.Socket:
+    return create_sub_socket(ctx, addr, topics, hwm=topics_hwm(topics))
+
+
+def create_qos_pub_socket(
+    ctx: zmq.Context, addr: str, topics: Sequence[str]
+) -> zmq.Socket:
+    # plain PUB for contexts QosPublisher does not support, e.g. zmq.asyncio,
+    # only the high-water mark of the policies applies
+    return create_pub_socket(ctx, addr, hwm=topics_hwm(topics))
+
+
+class TopicQosStats:
+    def __init__(self):
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.conflated_count = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            "sent": self.sent_count,
+            "dropped": self.dropped_count,
+            "conflated": self.conflated_count,
+        }
+
+
+class QosPublisher:
+    """
+    Publisher that applies the TopicQos of every topic it sends.
+
+    It is an XPUB socket with XPUB_NODROP, so a full subscriber queue is
+    reported to the sender instead of the message being silently dropped,
+    and the policy decides: wait, drop or conflate. It has the
+    send_multipart()/close() interface of a socket. Pending conflated
+    messages go out with the next send or flush(), the owner calls flush()
+    when idle so the latest one is not held back.
+
+    A blocking publisher waits in send_multipart() for a lossless topic. A
+    non-blocking one, e.g. the broker loop that forwards every topic, queues
+    the message per topic instead and flush() sends it or drops it once the
+    send_timeout of the topic has passed, so a slow subscriber of one topic
+    never stalls the others.
+
+    key_fn gives the conflation key of a message sent without one, e.g. in
+    the broker that forwards the messages of other publishers.
+    """
+
+    def __init__(
+        self,
+        sock: zmq.Socket,
+        topics: Sequence[str],
+        key_fn: Optional[Callable[[List[Any]], Any]] = None,
+        blocking: bool = True,
+    ):
+        # sock is an XPUB socket, bound after the options are set
+        self.sock = sock
+        self.blocking = blocking
+        self.sock.setsockopt(zmq.XPUB_NODROP, 1)
+        self.sock.setsockopt(zmq.SNDHWM, topics_hwm(topics))
+        self.topics = [bytes(topic, encoding="utf-8") for topic in topics]
+        self.key_fn = key_fn
+        self.send_timeout = -1
+        self.policies: Dict[bytes, TopicQos] = {}
+        self.stats: Dict[bytes, TopicQosStats] = {}
+        # (topic, key) -> latest message that could not be sent yet
+        self.pending: "OrderedDict[Tuple[bytes, Any], List[Any]]" = OrderedDict()
+        # topic -> (deadline, message) of lossless messages, non-blocking only
+        self.backlog: Dict[bytes, Deque[Tuple[float, List[Any]]]] = {}
+        self.last_log_ts = time.time()
+
+    def __policy__(self, topic: bytes) -> TopicQos:
+        if topic not in self.policies:
+            self.policies[topic] = get_topic_qos(str(topic, encoding="utf-8"))
+            self.stats[topic] = TopicQosStats()
+        return self.policies[topic]
+
+    def has_pending(self) -> bool:
+        return len(self.pending) > 0 or len(self.backlog) > 0
+
+    def send_multipart(self, msg_parts: List[Any], copy: bool = True, key: Any = None):
+        if self.has_pending():
+            self.flush()
+
+        topic = bytes(msg_parts[0])
+        qos = self.__policy__(topic)
+        if qos.lossless and not self.blocking:
+            self.__queue_lossless__(topic, qos, msg_parts, copy)
+        else:
+            self.__send__(topic, qos, msg_parts, copy, key)
+
+        if time.time() - self.last_log_ts > QOS_STATS_LOG_INTERVAL:
+            self.last_log_ts = time.time()
+            self.log_stats()
+
+    def __send__(
+        self, topic: bytes, qos: TopicQos, msg_parts: List[Any], copy: bool, key: Any
+    ):
+        stats = self.stats[topic]
+        try:
+            if qos.lossless:
+                if self.send_timeout != qos.send_timeout:
+                    self.send_timeout = qos.send_timeout
+                    self.sock.setsockopt(zmq.SNDTIMEO, qos.send_timeout)
+                self.sock.send_multipart(msg_parts, copy=copy)
+            else:
+                self.sock.send_multipart(msg_parts, zmq.DONTWAIT, copy=copy)
+            stats.sent_count += 1
+        except zmq.Again:
+            if qos.conflate:
+                if key is None and self.key_fn:
+                    key = self.key_fn(msg_parts)
+                pending_key = (topic, key)
+                if pending_key in self.pending:
+                    stats.conflated_count += 1
+                    self.pending.pop(pending_key)
+                self.pending[pending_key] = msg_parts
+            else:
+                self.__drop__(topic)
+
+    def __queue_lossless__(
+        self, topic: bytes, qos: TopicQos, msg_parts: List[Any], copy: bool
+    ):
+        backlog = self.backlog.get(topic)
+        if backlog is None:
+            try:
+                self.sock.send_multipart(msg_parts, zmq.DONTWAIT, copy=copy)
+                self.stats[topic].sent_count += 1
+                return
+            except zmq.Again:
+                backlog = self.backlog[topic] = deque()
+        if len(backlog) >= qos.hwm:
+            self.__drop__(topic)
+            return
+        # behind the queued ones, the topic keeps its order
+        deadline = time.time() + qos.send_timeout / 1000
+        backlog.append((deadline, msg_parts))
+
+    def __drop__(self, topic: bytes):
+        stats = self.stats[topic]
+        stats.dropped_count += 1
+        if stats.dropped_count == 1:
+            logger.warning(f"Subscriber too slow, dropping {topic} messages.")
+
+    def __flush_backlog__(self):
+        now = time.time()
+        for topic in list(self.backlog.keys()):
+            backlog = self.backlog[topic]
+            while len(backlog) > 0:
+                deadline, msg_parts = backlog[0]
+                if deadline < now:
+                    backlog.popleft()
+                    self.__drop__(topic)
+                    continue
+                try:
+                    self.sock.send_multipart(msg_parts, zmq.DONTWAIT, copy=False)
+                except zmq.Again:
+                    break
+                backlog.popleft()
+                self.stats[topic].sent_count += 1
+            if len(backlog) == 0:
+                del self.backlog[topic]
+
+    def wait_subscribed(self, timeout: float) -> bool:
+        """
+        Waits until a subscription for one of the topics arrives, so that the
+        first messages are not sent before a subscriber has joined. XPUB hands
+        the subscriptions to the application as messages.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining_ms = int((deadline - time.time()) * 1000)
+            if remaining_ms <= 0 or self.sock.poll(remaining_ms) == 0:
+                return False
+            event = self.sock.recv()
+            # b"\x01" + prefix subscribes, b"\x00" + prefix unsubscribes
+            if len(event) > 0 and event[0] == 1:
+                prefix = event[1:]
+                if any(topic.startswith(prefix) for topic in self.topics):
+                    return True
+
+    def flush(self):
+        if len(self.backlog) > 0:
+            self.__flush_backlog__()
+        while len(self.pending) > 0:
+            pending_key, msg_parts = next(iter(self.pending.items()))
+            try:
+                self.sock.send_multipart(msg_parts, zmq.DONTWAIT, copy=False)
+            except zmq.Again:
+                break
+            self.pending.pop(pending_key)
+            self.stats[pending_key[0]].sent_count += 1
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        return {str(k, encoding="utf-8"): v.to_dict() for k, v in self.stats.items()}
+
+    def log_stats(self):
+        logger.info(f"Publisher QoS stats: {self.get_stats()}")
+
+    def close(self):
+        self.flush()
+        # pending conflated messages are lossy by definition
+        self.pending.clear()
+        for topic, backlog in self.backlog.items():
+            self.stats[topic].dropped_count += len(backlog)
+        self.backlog.clear()
+        self.log_stats()
+        self.sock.close(linger=0)
+
+
+def create_qos_publisher(
+    ctx: zmq.Context, addr: str, topics: Sequence[str]
+) -> QosPublisher:
+    publisher = QosPublisher(ctx.socket(zmq.XPUB), topics)
+    attach_socket(publisher.sock, addr, bind=True)
+    return publisher
+
+
+def conflate_messages(
+    chunks: List[bytes], key_fn: Callable[[bytes], Optional[Any]]
+) -> List[bytes]:
+    """
+    Keeps only the latest message per key of a received batch, in the order
+    of the kept messages. Messages without a key are all kept.
+    """
+    latest: Dict[Any, int] = {}
+    for idx, chunk in enumerate(chunks):
+        key = key_fn(chunk)
+        if key is not None:
+            latest[key] = idx
+    return [
+        chunk
+        for idx, chunk in enumerate(chunks)
+        if (key := key_fn(chunk)) is None or latest[key] == idx
+    ]
+
+
+def partial_msgid(chunk: bytes) -> Optional[str]:
+    try:
+        item = decode_envelope(chunk)
+    except ValueError:
+        return None
+    if item.kind != MessageKind.PARTIAL:
+        return None
+    return item.msgid
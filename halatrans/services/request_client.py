@@ -0,0 +1,154 @@
+import asyncio
+import itertools
+import logging
+from typing import Dict, List, Optional
+
+import zmq
+import zmq.asyncio
+
+from halatrans.services.context import create_async_context
+from halatrans.services.utils import async_wait_connectable, attach_socket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 2
+
+# A REP server echoes every frame before the empty delimiter, so a DEALER
+# can talk to it with [reqid, b"", topic, payload] and match the response by
+# reqid. Unlike REQ, a DEALER never gets stuck in the send/recv state machine
+# when a response is lost, and many requests can be in flight on one socket.
+
+
+class AsyncRequestClient:
+    """
+    Pooled asynchronous client of a RequestResponseService.
+
+    The sockets are created on first use in the running event loop and shared
+    by all requests, each socket has one reader task that resolves the
+    pending futures. A request that times out or is cancelled only drops its
+    future, a late response for it is discarded.
+    """
+
+    def __init__(self, addr: str, pool_size: int = DEFAULT_POOL_SIZE):
+        self.addr = addr
+        self.pool_size = pool_size
+        self.ctx: Optional[zmq.asyncio.Context] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.socks: List[zmq.asyncio.Socket] = []
+        self.readers: List[asyncio.Task] = []
+        self.pending: Dict[bytes, asyncio.Future] = {}
+        self.reqid_counter = itertools.count()
+        self.sock_counter = itertools.count()
+
+    async def __ensure_pool__(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop and len(self.socks) > 0:
+            return
+        await async_wait_connectable([self.addr])
+        if self.loop is loop and len(self.socks) > 0:
+            # created by a concurrent request while waiting
+            return
+        if self.loop is not None:
+            # sockets of zmq.asyncio are bound to the loop that used them first
+            self.close()
+
+        self.loop = loop
+        self.ctx = create_async_context()
+        for _ in range(self.pool_size):
+            sock = self.ctx.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            attach_socket(sock, self.addr, bind=False)
+            self.socks.append(sock)
+            self.readers.append(loop.create_task(self.__read_responses__(sock)))
+
+    async def __read_responses__(self, sock: zmq.asyncio.Socket):
+        while True:
+            try:
+                frames = await sock.recv_multipart()
+            except (asyncio.CancelledError, zmq.ContextTerminated):
+                break
+            except zmq.ZMQError as err:
+                logger.error(err)
+                break
+
+            if len(frames) != 4 or len(frames[1]) != 0:
+                logger.error(f"Invalid response, frames: {len(frames)}")
+                continue
+            reqid, _, topic, chunk = frames
+            future = self.pending.pop(reqid, None)
+            if future is None:
+                # timed out or cancelled
+                continue
+            if not future.done():
+                future.set_result((topic, chunk))
+
+    async def request(
+        self, bytes_topic: bytes, input: bytes, timeout: float = 0
+    ) -> Optional[bytes]:
+        await self.__ensure_pool__()
+
+        reqid = b"%d" % next(self.reqid_counter)
+        future = self.loop.create_future()
+        self.pending[reqid] = future
+        sock = self.socks[next(self.sock_counter) % len(self.socks)]
+        try:
+            await sock.send_multipart([reqid, b"", bytes_topic, input])
+            if timeout > 0:
+                recv_topic, chunk = await asyncio.wait_for(future, timeout)
+            else:
+                recv_topic, chunk = await future
+            if recv_topic != bytes_topic:
+                raise ValueError(
+                    f"Recv topic is not match, s: {bytes_topic}, r: {recv_topic}"
+                )
+            return chunk
+        except asyncio.TimeoutError:
+            logger.error(f"Request to {self.addr} timeout after {timeout}s.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error(err)
+        finally:
+            self.pending.pop(reqid, None)
+        return None
+
+    def close(self):
+        loop, ctx, socks, readers, pending = (
+            self.loop,
+            self.ctx,
+            self.socks,
+            self.readers,
+            self.pending,
+        )
+        self.loop, self.ctx, self.socks, self.readers, self.pending = (
+            None,
+            None,
+            [],
+            [],
+            {},
+        )
+
+        def close_pool():
+            usable = loop is not None and not loop.is_closed()
+            for future in pending.values():
+                if usable and not future.done():
+                    future.cancel()
+            for reader in readers:
+                if usable:
+                    reader.cancel()
+            for sock in socks:
+                sock.close(linger=0)
+            if ctx:
+                ctx.term()
+
+        if loop is not None and loop.is_running():
+            try:
+                in_loop = asyncio.get_running_loop() is loop
+            except RuntimeError:
+                in_loop = False
+            if not in_loop:
+                # e.g. from on_terminating, the pool belongs to the web loop
+                loop.call_soon_threadsafe(close_pool)
+                return
+        close_pool()
@@ -0,0 +1,92 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def split_envelope(frames: List[bytes]) -> Tuple[List[bytes], List[bytes]]:
+    """
+    Splits a ROUTER message into the routing envelope, including the empty
+    delimiter, and the body.
+
+    REQ peers send [identity, b"", ...], DEALER clients add their own frames
+    before the delimiter, e.g. [identity, reqid, b"", ...]. The envelope is
+    sent back untouched with the response.
+    """
+    for idx, frame in enumerate(frames):
+        if len(frame) == 0:
+            return frames[: idx + 1], frames[idx + 1 :]
+    raise ValueError(f"Request has no envelope delimiter, frames: {len(frames)}")
+
+
+def timed_call(fn: Callable[..., Any], *args) -> Tuple[Any, float, float]:
+    # Runs in the pool, returns (result, start time, service time). Module
+    # level so that the process pool can pickle it.
+    start_ts = time.time()
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, start_ts, time.perf_counter() - start
+
+
+@dataclass
+class RequestTypeStats:
+    count: int = 0
+    error_count: int = 0
+    wait_time_total: float = 0.0
+    service_time_total: float = 0.0
+    service_time_max: float = 0.0
+
+    def add(self, wait_time: float, service_time: float, is_error: bool):
+        self.count += 1
+        if is_error:
+            self.error_count += 1
+        self.wait_time_total += wait_time
+        self.service_time_total += service_time
+        self.service_time_max = max(self.service_time_max, service_time)
+
+    def to_dict(self) -> Dict[str, Any]:
+        count = max(self.count, 1)
+        return {
+            "count": self.count,
+            "errors": self.error_count,
+            "wait_ms_mean": self.wait_time_total / count * 1000,
+            "service_ms_mean": self.service_time_total / count * 1000,
+            "service_ms_max": self.service_time_max * 1000,
+        }
+
+
+class RequestRouterStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.types: Dict[str, RequestTypeStats] = {}
+
+    def on_enqueue(self):
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def on_done(
+        self,
+        request_type: str,
+        wait_time: float,
+        service_time: float,
+        is_error: bool = False,
+    ):
+        self.queue_depth -= 1
+        if request_type not in self.types:
+            self.types[request_type] = RequestTypeStats()
+        self.types[request_type].add(wait_time, service_time, is_error)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "types": {k: v.to_dict() for k, v in self.types.items()},
+        }
+
+    def log(self):
+        logger.info(f"[{self.name}] request stats: {self.to_dict()}")
@@ -1,9 +1,11 @@
 import logging
 from dataclasses import asdict
-from typing import Any, Callable, Dict, List, Optional, Tuple  # noqa: F401
+from typing import Dict, List
 
 from halatrans.services.backend.assistant_service import (
     AssistantService, AssistantServiceParameters)
+from halatrans.services.backend.broker_service import (BrokerService,
+                                                       BrokerServiceParameters)
 from halatrans.services.backend.rts2t_service import (RTS2TService,
                                                       RTS2TServiceParameters)
 from halatrans.services.backend.storage_service import (
@@ -14,21 +16,33 @@ from halatrans.services.backend.translation_service import (
     TranslationService, TranslationServiceParameters)
 from halatrans.services.backend.whisper_service import (
     WhisperService, WhisperServiceParameters)
+from halatrans.services.backend.whisper_stream_service import (
+    WhisperStreamService, WhisperStreamServiceParameters)
 from halatrans.services.base_service import BaseService, ServiceConfig
 from halatrans.services.base_service_manager import BaseServiceManager
 from halatrans.services.config import (CONST_ASSISTANT_PUB_ADDR,
                                        CONST_ASSISTANT_PUB_TOPIC,
                                        CONST_AUDIO_STREAM_PUB_ADDR,
                                        CONST_AUDIO_STREAM_PUB_TOPIC,
+                                       CONST_AUDIO_STREAM_SHM_NAME,
+                                       CONST_BACKEND_CONTROL_ADDR,
+                                       CONST_BROKER_SERVICE,
+                                       CONST_BUS_CAPTURE_ADDR,
+                                       CONST_BUS_PUB_ADDR, CONST_BUS_SUB_ADDR,
                                        CONST_RTS2T_PUB_ADDR,
                                        CONST_RTS2T_PUB_TOPIC,
+                                       CONST_TRANSCRIBE_CPU_THREADS,
                                        CONST_TRANSCRIBE_PUB_ADDR,
                                        CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
                                        CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
                                        CONST_TRANSLATION_PUB_ADDR,
                                        CONST_TRANSLATION_PUB_TOPIC,
+                                       CONST_WHISPER_CPU_THREADS,
+                                       CONST_WHISPER_MAX_BATCH,
+                                       CONST_WHISPER_MAX_REPLICAS,
                                        CONST_WHISPER_PUB_ADDR,
-                                       CONST_WHISPER_PUB_TOPIC)
+                                       CONST_WHISPER_PUB_TOPIC,
+                                       CONST_WHISPER_REPLICAS)
 from halatrans.services.process_task_manager import ServiceState
 
 logging.basicConfig(level=logging.INFO)
@@ -36,97 +50,194 @@ logger = logging.getLogger(__name__)
 
 
 class BackendServiceManager(BaseServiceManager):
-    def __init__(self):
-        super().__init__()
+    def __init__(
+        self,
+        use_broker: bool = True,
+        embedded: bool = False,
+        plan_cpus: bool = False,
+        whisper_streaming: bool = False,
+        transcribe_segmenter: str = "vosk",
+    ):
+        super().__init__(
+            embedded=embedded,
+            control_addr=CONST_BACKEND_CONTROL_ADDR,
+            plan_cpus=plan_cpus,
+        )
+        # publish and subscribe through the broker instead of a mesh of
+        # per-service PUB sockets
+        self.use_broker = use_broker
+        # whisper transcribes the audio stream itself, there is no vosk stage
+        self.whisper_streaming = whisper_streaming
+        # vosk | vad, see TranscribeService
+        self.transcribe_segmenter = transcribe_segmenter
 
-    def on_terminate(self):
-        # TODO: must control sub services shutdown order.
-        return super().on_terminate()
+    def __pub_addr__(self, addr: str) -> str:
+        return ">" + CONST_BUS_PUB_ADDR if self.use_broker else addr
+
+    def __sub_addr__(self, addr: str) -> str:
+        return CONST_BUS_SUB_ADDR if self.use_broker else addr
+
+    def __depends_on__(self, *services: str) -> List[str]:
+        # every message goes through the broker
+        return [CONST_BROKER_SERVICE, *services] if self.use_broker else list(services)
 
     def on_prepare_start(self) -> ServiceState:
-        service_state: Dict[str, BaseService] = {
-            "rts2t-main": RTS2TService(
+        service_state: Dict[str, BaseService] = {}
+        if self.use_broker:
+            service_state[CONST_BROKER_SERVICE] = BrokerService(
                 ServiceConfig(
+                    transport=True,
                     parameters=asdict(
-                        RTS2TServiceParameters(
-                            output_pub_addr=CONST_RTS2T_PUB_ADDR,
-                            output_pub_topic=CONST_RTS2T_PUB_TOPIC,
-                            transcribe_pub_addr=CONST_TRANSCRIBE_PUB_ADDR,
-                            transcribe_pub_partial_topic=CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
-                            whisper_pub_addr=CONST_WHISPER_PUB_ADDR,
-                            whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
-                            translation_pub_addr=CONST_TRANSLATION_PUB_ADDR,
-                            translation_pub_topic=CONST_TRANSLATION_PUB_TOPIC,
-                            assistant_pub_addr=CONST_ASSISTANT_PUB_ADDR,
-                            assistant_pub_topic=CONST_ASSISTANT_PUB_TOPIC,
+                        BrokerServiceParameters(
+                            xsub_addr=CONST_BUS_PUB_ADDR,
+                            xpub_addr=CONST_BUS_SUB_ADDR,
+                            capture_addr=CONST_BUS_CAPTURE_ADDR,
                         )
                     ),
                 )
-            ),
-            "rts2t-transcribe": TranscribeService(
+            )
+
+        pub_addr = self.__pub_addr__
+        sub_addr = self.__sub_addr__
+        depends_on = self.__depends_on__
+        # the stage that cuts the audio stream into utterances
+        transcribe = [] if self.whisper_streaming else ["rts2t-transcribe"]
+        service_state.update(
+            {
+                "rts2t-main": RTS2TService(
+                    ServiceConfig(
+                        depends_on=depends_on(
+                            *transcribe,
+                            "rts2t-whisper",
+                            "rts2t-translation",
+                            "rts2t-assistant",
+                        ),
+                        parameters=asdict(
+                            RTS2TServiceParameters(
+                                output_pub_addr=pub_addr(CONST_RTS2T_PUB_ADDR),
+                                output_sub_addr=sub_addr(CONST_RTS2T_PUB_ADDR),
+                                output_pub_topic=CONST_RTS2T_PUB_TOPIC,
+                                transcribe_pub_addr=sub_addr(CONST_TRANSCRIBE_PUB_ADDR),
+                                transcribe_pub_partial_topic=CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
+                                whisper_pub_addr=sub_addr(CONST_WHISPER_PUB_ADDR),
+                                whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
+                                translation_pub_addr=sub_addr(
+                                    CONST_TRANSLATION_PUB_ADDR
+                                ),
+                                translation_pub_topic=CONST_TRANSLATION_PUB_TOPIC,
+                                assistant_pub_addr=sub_addr(CONST_ASSISTANT_PUB_ADDR),
+                                assistant_pub_topic=CONST_ASSISTANT_PUB_TOPIC,
+                            )
+                        ),
+                    )
+                ),
+                "rts2t-transcribe": TranscribeService(
+                    ServiceConfig(
+                        isolated=True,
+                        warm=True,
+                        cpu_threads=CONST_TRANSCRIBE_CPU_THREADS,
+                        # the audio stream is started later by the frontend
+                        depends_on=depends_on(),
+                        parameters=asdict(
+                            TranscribeServiceParameters(
+                                audio_pub_addr=CONST_AUDIO_STREAM_PUB_ADDR,
+                                audio_pub_topic=CONST_AUDIO_STREAM_PUB_TOPIC,
+                                transcribe_pub_addr=pub_addr(CONST_TRANSCRIBE_PUB_ADDR),
+                                transcribe_pub_partial_topic=CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
+                                transcribe_pub_fulltext_topic=CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
+                                audio_shm_name=CONST_AUDIO_STREAM_SHM_NAME,
+                                segmenter=self.transcribe_segmenter,
+                            )
+                        ),
+                    )
+                ),
+                "rts2t-whisper": WhisperService(
+                    ServiceConfig(
+                        # utterances are decoded in parallel and published in order
+                        replicas=CONST_WHISPER_REPLICAS,
+                        max_replicas=CONST_WHISPER_MAX_REPLICAS,
+                        isolated=True,
+                        warm=True,
+                        cpu_threads=CONST_WHISPER_CPU_THREADS,
+                        options={"replica": {"max_batch": CONST_WHISPER_MAX_BATCH}},
+                        depends_on=depends_on("rts2t-transcribe"),
+                        parameters=asdict(
+                            WhisperServiceParameters(
+                                transcribe_pub_addr=sub_addr(CONST_TRANSCRIBE_PUB_ADDR),
+                                transcribe_pub_fulltext_topic=CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
+                                whisper_pub_addr=pub_addr(CONST_WHISPER_PUB_ADDR),
+                                whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
+                            )
+                        ),
+                    )
+                ),
+                "rts2t-translation": TranslationService(
+                    ServiceConfig(
+                        depends_on=depends_on(*transcribe, "rts2t-whisper"),
+                        parameters=asdict(
+                            TranslationServiceParameters(
+                                transcribe_pub_addr=sub_addr(CONST_TRANSCRIBE_PUB_ADDR),
+                                transcribe_pub_partial_topic=CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
+                                whisper_pub_addr=sub_addr(CONST_WHISPER_PUB_ADDR),
+                                whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
+                                translation_pub_addr=pub_addr(
+                                    CONST_TRANSLATION_PUB_ADDR
+                                ),
+                                translation_pub_topic=CONST_TRANSLATION_PUB_TOPIC,
+                            )
+                        ),
+                    )
+                ),
+                "rts2t-assistant": AssistantService(
+                    ServiceConfig(
+                        depends_on=depends_on("rts2t-whisper"),
+                        parameters=asdict(
+                            AssistantServiceParameters(
+                                whisper_pub_addr=sub_addr(CONST_WHISPER_PUB_ADDR),
+                                whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
+                                assistant_pub_addr=pub_addr(CONST_ASSISTANT_PUB_ADDR),
+                                assistant_pub_topic=CONST_ASSISTANT_PUB_TOPIC,
+                            )
+                        ),
+                    )
+                ),
+                "rts2t-storage": StorageService(
+                    ServiceConfig(
+                        depends_on=depends_on(*transcribe, "rts2t-translation"),
+                        parameters=asdict(
+                            StorageServiceParameters(
+                                transcribe_pub_addr=sub_addr(CONST_TRANSCRIBE_PUB_ADDR),
+                                transcribe_pub_fulltext_topic=CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
+                                translation_pub_addr=sub_addr(
+                                    CONST_TRANSLATION_PUB_ADDR
+                                ),
+                                translation_pub_topic=CONST_TRANSLATION_PUB_TOPIC,
+                            )
+                        ),
+                    )
+                ),
+            }
+        )
+        if self.whisper_streaming:
+            service_state.pop("rts2t-transcribe")
+            service_state["rts2t-whisper"] = WhisperStreamService(
                 ServiceConfig(
+                    isolated=True,
+                    warm=True,
+                    cpu_threads=CONST_WHISPER_CPU_THREADS,
+                    # the audio stream is started later by the frontend
+                    depends_on=depends_on(),
                     parameters=asdict(
-                        TranscribeServiceParameters(
+                        WhisperStreamServiceParameters(
                             audio_pub_addr=CONST_AUDIO_STREAM_PUB_ADDR,
                             audio_pub_topic=CONST_AUDIO_STREAM_PUB_TOPIC,
-                            transcribe_pub_addr=CONST_TRANSCRIBE_PUB_ADDR,
-                            transcribe_pub_partial_topic=CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
-                            transcribe_pub_fulltext_topic=CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
-                        )
-                    ),
-                )
-            ),
-            "rts2t-whisper": WhisperService(
-                ServiceConfig(
-                    parameters=asdict(
-                        WhisperServiceParameters(
-                            transcribe_pub_addr=CONST_TRANSCRIBE_PUB_ADDR,
-                            transcribe_pub_fulltext_topic=CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
-                            whisper_pub_addr=CONST_WHISPER_PUB_ADDR,
-                            whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
-                        )
-                    ),
-                )
-            ),
-            "rts2t-translation": TranslationService(
-                ServiceConfig(
-                    parameters=asdict(
-                        TranslationServiceParameters(
-                            transcribe_pub_addr=CONST_TRANSCRIBE_PUB_ADDR,
-                            transcribe_pub_partial_topic=CONST_TRANSCRIBE_PUB_PARTIAL_TOPIC,
-                            whisper_pub_addr=CONST_WHISPER_PUB_ADDR,
+                            whisper_pub_addr=pub_addr(CONST_WHISPER_PUB_ADDR),
                             whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
-                            translation_pub_addr=CONST_TRANSLATION_PUB_ADDR,
-                            translation_pub_topic=CONST_TRANSLATION_PUB_TOPIC,
-                        )
-                    ),
-                )
-            ),
-            "rts2t-assistant": AssistantService(
-                ServiceConfig(
-                    parameters=asdict(
-                        AssistantServiceParameters(
-                            whisper_pub_addr=CONST_WHISPER_PUB_ADDR,
-                            whisper_pub_topic=CONST_WHISPER_PUB_TOPIC,
-                            assistant_pub_addr=CONST_ASSISTANT_PUB_ADDR,
-                            assistant_pub_topic=CONST_ASSISTANT_PUB_TOPIC,
-                        )
-                    ),
-                )
-            ),
-            "rts2t-storage": StorageService(
-                ServiceConfig(
-                    parameters=asdict(
-                        StorageServiceParameters(
-                            transcribe_pub_addr=CONST_TRANSCRIBE_PUB_ADDR,
-                            transcribe_pub_fulltext_topic=CONST_TRANSCRIBE_PUB_FULLTEXT_TOPIC,
-                            translation_pub_addr=CONST_TRANSLATION_PUB_ADDR,
-                            translation_pub_topic=CONST_TRANSLATION_PUB_TOPIC,
+                            audio_shm_name=CONST_AUDIO_STREAM_SHM_NAME,
                         )
                     ),
                 )
-            ),
-        }
+            )
 
         return service_state
 
@@ -1,14 +1,18 @@
 import logging
-from dataclasses import asdict
+from dataclasses import asdict, replace
 from typing import Dict
 
-from halatrans.services.base_service import BaseService, ServiceConfig
+from halatrans.services.base_service import (BaseService,
+                                             RequestResponseWorkerOptions,
+                                             ServiceConfig)
 from halatrans.services.base_service_manager import BaseServiceManager
 from halatrans.services.config import (CONST_AUDIO_DEVICE_REP_ADDR,
                                        CONST_AUDIO_DEVICE_SERVICE,
                                        CONST_AUDIO_STREAM_PUB_ADDR,
                                        CONST_AUDIO_STREAM_PUB_TOPIC,
-                                       CONST_AUDIO_STREAM_SERVICE)
+                                       CONST_AUDIO_STREAM_SERVICE,
+                                       CONST_AUDIO_STREAM_SHM_NAME,
+                                       CONST_FRONTEND_CONTROL_ADDR)
 from halatrans.services.frontend.audio_device_service import (
     AudioDeviceService, AudioDeviceServiceParameters)
 from halatrans.services.frontend.audio_stream_service import (
@@ -20,8 +24,8 @@ logger = logging.getLogger(__name__)
 
 
 class FrontendServiceManager(BaseServiceManager):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, embedded: bool = False):
+        super().__init__(embedded=embedded, control_addr=CONST_FRONTEND_CONTROL_ADDR)
 
     def on_terminate(self):
         super().on_terminate()
@@ -34,6 +38,15 @@ class FrontendServiceManager(BaseServiceManager):
                     parameters=asdict(
                         AudioDeviceServiceParameters(),
                     ),
+                    # device enumeration is slow, serve requests concurrently.
+                    # PortAudio is not safe to initialize from several threads.
+                    # The pool forks, keep it out of an embedded process.
+                    isolated=True,
+                    options=asdict(
+                        RequestResponseWorkerOptions(
+                            router=True, pool="process", pool_size=2
+                        )
+                    ),
                 )
             ),
         }
@@ -51,6 +64,10 @@ class FrontendServiceManager(BaseServiceManager):
             logger.error("Audio-Stream service is already running.")
             return
 
+        if parameters.shm_name is None:
+            # local consumers read the audio from shared memory
+            parameters = replace(parameters, shm_name=CONST_AUDIO_STREAM_SHM_NAME)
+
         service = AudioStreamService(
             ServiceConfig(
                 addr=CONST_AUDIO_STREAM_PUB_ADDR,
@@ -0,0 +1,291 @@
+import logging
+import os
+import struct
+import time
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+from typing import List, Optional, Tuple
+
+import zmq
+
+from halatrans.services.utils import create_sub_socket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Single producer, multi consumer ring of fixed size slots in shared memory.
+#
+#   header: magic, slot_count, slot_size, generation, write_seq, owner pid
+#   slot:   seq, length, timestamp, data[slot_size]
+#
+# The producer fills a slot, stamps it with its seq, then bumps write_seq.
+# Every reader keeps its own cursor, so readers never block the producer or
+# each other. A reader that falls more than slot_count behind has been
+# overrun and skips ahead, a slot rewritten while being copied is dropped.
+
+SHM_RING_MAGIC = 0x48524E47  # "HRNG"
+SHM_RING_HEADER = struct.Struct("<IIIQQ")
+SHM_RING_HEADER_SIZE = 64
+SHM_RING_WRITE_SEQ_OFFSET = 20
+SHM_RING_OWNER = struct.Struct("<I")
+SHM_RING_OWNER_OFFSET = 28
+SHM_RING_SLOT_HEADER = struct.Struct("<QId")
+SHM_RING_SLOT_HEADER_SIZE = 24
+SHM_RING_SLOT_INVALID = 0xFFFFFFFFFFFFFFFF
+
+# generation, write_seq
+SHM_RING_NOTIFICATION = struct.Struct("<QQ")
+
+SEQ_STRUCT = struct.Struct("<Q")
+
+
+def shm_notify_topic(topic: str) -> str:
+    # Must not share a prefix with the data topic, SUB filters by prefix.
+    return f"shm-notify.{topic}"
+
+
+def _detach_resource_tracker(shm: shared_memory.SharedMemory):
+    # Only the creating process owns the segment. Without this the resource
+    # tracker of an attaching process unlinks it when that process exits.
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+
+def _is_process_alive(pid: int) -> bool:
+    if os.name != "posix":
+        # a segment only outlives the processes that have it open on posix
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _ring_owner(shm: shared_memory.SharedMemory) -> int:
+    # pid of the producer, 0 when the segment is no initialized ring
+    if shm.size < SHM_RING_HEADER_SIZE:
+        return 0
+    (magic,) = struct.unpack_from("<I", shm.buf, 0)
+    if magic != SHM_RING_MAGIC:
+        return 0
+    (pid,) = SHM_RING_OWNER.unpack_from(shm.buf, SHM_RING_OWNER_OFFSET)
+    return pid
+
+
+class ShmRingWriter:
+    def __init__(self, name: str, slot_count: int, slot_size: int):
+        self.name = name
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.generation = uuid.uuid4().int & 0xFFFFFFFFFFFFFFFF
+        self.write_seq = 0
+
+        size = SHM_RING_HEADER_SIZE + slot_count * (
+            SHM_RING_SLOT_HEADER_SIZE + slot_size
+        )
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=name)
+            owner = _ring_owner(stale)
+            # own pid: an earlier producer of this process did not close it
+            if owner not in (0, os.getpid()) and _is_process_alive(owner):
+                _detach_resource_tracker(stale)
+                stale.close()
+                raise ValueError(
+                    f"Shared memory {name} is in use by the producer {owner}."
+                )
+            # left behind by a producer that did not exit cleanly
+            logger.warning(f"Shared memory {name} exists, recreate it.")
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        SHM_RING_HEADER.pack_into(
+            self.shm.buf,
+            0,
+            SHM_RING_MAGIC,
+            slot_count,
+            slot_size,
+            self.generation,
+            0,
+        )
+        SHM_RING_OWNER.pack_into(self.shm.buf, SHM_RING_OWNER_OFFSET, os.getpid())
+        for idx in range(slot_count):
+            SEQ_STRUCT.pack_into(
+                self.shm.buf, self.__slot_offset__(idx), SHM_RING_SLOT_INVALID
+            )
+
+    def __slot_offset__(self, idx: int) -> int:
+        return SHM_RING_HEADER_SIZE + idx * (SHM_RING_SLOT_HEADER_SIZE + self.slot_size)
+
+    def write(self, data: bytes, ts: Optional[float] = None) -> int:
+        if len(data) > self.slot_size:
+            raise ValueError(
+                f"Data size {len(data)} exceeds ring slot size {self.slot_size}"
+            )
+        seq = self.write_seq
+        offset = self.__slot_offset__(seq % self.slot_count)
+        buf = self.shm.buf
+
+        # invalidate first, so a concurrent reader notices the rewrite
+        SEQ_STRUCT.pack_into(buf, offset, SHM_RING_SLOT_INVALID)
+        data_offset = offset + SHM_RING_SLOT_HEADER_SIZE
+        buf[data_offset : data_offset + len(data)] = data
+        SHM_RING_SLOT_HEADER.pack_into(
+            buf, offset, seq, len(data), time.time() if ts is None else ts
+        )
+
+        self.write_seq = seq + 1
+        SEQ_STRUCT.pack_into(buf, SHM_RING_WRITE_SEQ_OFFSET, self.write_seq)
+        return seq
+
+    def notification(self) -> bytes:
+        return SHM_RING_NOTIFICATION.pack(self.generation, self.write_seq)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class ShmRingReader:
+    def __init__(self, name: str, start_seq: Optional[int] = None):
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name=name)
+        _detach_resource_tracker(self.shm)
+
+        magic, slot_count, slot_size, generation, write_seq = (
+            SHM_RING_HEADER.unpack_from(self.shm.buf, 0)
+        )
+        if magic != SHM_RING_MAGIC:
+            self.shm.close()
+            raise ValueError(f"Shared memory {name} is not a ring buffer.")
+
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.generation = generation
+        # start from the live position unless told otherwise, history is
+        # not replayed
+        self.cursor = write_seq if start_seq is None else min(start_seq, write_seq)
+
+        self.read_count = 0
+        self.overrun_count = 0
+        self.lag = 0
+        self.max_lag = 0
+
+    def __slot_offset__(self, idx: int) -> int:
+        return SHM_RING_HEADER_SIZE + idx * (SHM_RING_SLOT_HEADER_SIZE + self.slot_size)
+
+    def read_available(self) -> List[bytes]:
+        buf = self.shm.buf
+        (write_seq,) = SEQ_STRUCT.unpack_from(buf, SHM_RING_WRITE_SEQ_OFFSET)
+
+        self.lag = write_seq - self.cursor
+        self.max_lag = max(self.max_lag, self.lag)
+        if self.lag > self.slot_count:
+            lost = self.lag - self.slot_count
+            self.overrun_count += lost
+            self.cursor = write_seq - self.slot_count
+            logger.warning(f"[{self.name}] reader overrun, skip {lost} slots.")
+
+        chunks: List[bytes] = []
+        while self.cursor < write_seq:
+            seq = self.cursor
+            self.cursor += 1
+
+            offset = self.__slot_offset__(seq % self.slot_count)
+            slot_seq, length, _ = SHM_RING_SLOT_HEADER.unpack_from(buf, offset)
+            if slot_seq != seq:
+                self.overrun_count += 1
+                continue
+            data_offset = offset + SHM_RING_SLOT_HEADER_SIZE
+            data = bytes(buf[data_offset : data_offset + length])
+            # the producer may have lapped us during the copy
+            (slot_seq,) = SEQ_STRUCT.unpack_from(buf, offset)
+            if slot_seq != seq:
+                self.overrun_count += 1
+                continue
+            chunks.append(data)
+
+        self.read_count += len(chunks)
+        return chunks
+
+    def stats(self) -> Tuple[int, int, int, int]:
+        return (self.read_count, self.overrun_count, self.lag, self.max_lag)
+
+    def close(self):
+        self.shm.close()
+
+
+class ShmRingSubscriber:
+    """
+    Consumer side of a publisher that writes its blocks into a shared memory
+    ring and only sends a small notification over PUB/SUB.
+
+    The ring is attached lazily on the first notification. When it cannot be
+    attached, e.g. the publisher runs on another host, the subscriber falls
+    back to the data topic over the regular PUB/SUB path.
+    """
+
+    STATS_LOG_INTERVAL = 120
+
+    def __init__(self, ctx: zmq.Context, addr: str, topic: str, shm_name: str):
+        self.shm_name = shm_name
+        self.bytes_topic = bytes(topic, encoding="utf-8")
+        self.notify_topic = bytes(shm_notify_topic(topic), encoding="utf-8")
+        self.notify_sub = create_sub_socket(ctx, addr, [shm_notify_topic(topic)])
+        self.data_sub = create_sub_socket(ctx, addr, [])
+        self.reader: Optional[ShmRingReader] = None
+        self.is_fallback = False
+
+    def get_sockets(self) -> List[zmq.Socket]:
+        return [self.notify_sub, self.data_sub]
+
+    def __attach__(self, generation: int, start_seq: int) -> bool:
+        if self.reader is not None:
+            if self.reader.generation == generation:
+                return True
+            # publisher restarted with a new ring
+            self.reader.close()
+            self.reader = None
+
+        try:
+            self.reader = ShmRingReader(self.shm_name, start_seq)
+            logger.info(f"Attach shared memory ring {self.shm_name}.")
+            return True
+        except (FileNotFoundError, ValueError) as err:
+            logger.info(f"Can not attach ring {self.shm_name}, use PUB/SUB. {err}")
+            self.data_sub.setsockopt(zmq.SUBSCRIBE, self.bytes_topic)
+            self.notify_sub.setsockopt(zmq.UNSUBSCRIBE, self.notify_topic)
+            self.is_fallback = True
+            return False
+
+    def read(self, sock: zmq.Socket, chunks: List[bytes]) -> List[bytes]:
+        if sock is self.data_sub:
+            return chunks
+        if self.is_fallback or len(chunks) == 0:
+            return []
+
+        generation, _ = SHM_RING_NOTIFICATION.unpack(chunks[-1])
+        # the first notification in the batch announces the oldest new block
+        _, write_seq = SHM_RING_NOTIFICATION.unpack(chunks[0])
+        if not self.__attach__(generation, write_seq - 1):
+            return []
+
+        blocks = self.reader.read_available()
+        if self.reader.read_count % self.STATS_LOG_INTERVAL < len(blocks):
+            read_count, overrun_count, lag, max_lag = self.reader.stats()
+            logger.info(
+                f"[{self.shm_name}] read: {read_count}, overrun: {overrun_count}, lag: {lag}, max lag: {max_lag}"
+            )
+        return blocks
+
+    def close(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        self.notify_sub.close()
+        self.data_sub.close()
@@ -0,0 +1,175 @@
+import ctypes
+import logging
+import os
+import time
+from dataclasses import dataclass
+from multiprocessing.sharedctypes import RawArray
+from typing import Any, List, Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SHUTDOWN_FLAG_SLOTS = 256
+
+# Heartbeat of a task, HEARTBEAT_FIELDS doubles per flag slot.
+HEARTBEAT_PID = 0
+HEARTBEAT_START_TS = 1  # worker start
+HEARTBEAT_BEAT_TS = 2  # last loop iteration
+HEARTBEAT_ITERATIONS = 3
+HEARTBEAT_MESSAGES = 4
+HEARTBEAT_MESSAGE_TS = 5  # last message processed
+# queue of a work queue dispatcher, see halatrans/services/autoscaler.py
+HEARTBEAT_BACKLOG = 6
+HEARTBEAT_IN_FLIGHT = 7
+HEARTBEAT_FIELDS = 8
+
+# Set in every worker process by the executor initializer.
+__worker_shutdown_flags__: Optional[Any] = None
+__worker_heartbeats__: Optional[Any] = None
+__worker_control_addr__: Optional[str] = None
+
+
+def init_worker_shutdown_flags(
+    flags: Any, heartbeats: Any = None, control_addr: Optional[str] = None
+):
+    global __worker_shutdown_flags__, __worker_heartbeats__, __worker_control_addr__
+    __worker_shutdown_flags__ = flags
+    __worker_heartbeats__ = heartbeats
+    __worker_control_addr__ = control_addr
+
+
+def resolve_worker_shutdown_flag(index: int) -> "ShutdownFlag":
+    if __worker_shutdown_flags__ is None:
+        raise ValueError("Worker shutdown flags are not initialized.")
+    return ShutdownFlag(
+        __worker_shutdown_flags__,
+        index,
+        __worker_heartbeats__,
+        __worker_control_addr__,
+    )
+
+
+@dataclass
+class TaskHeartbeat:
+    pid: int
+    start_ts: float
+    beat_ts: float
+    iterations: int
+    messages: int
+    message_ts: float
+    backlog: int = 0
+    in_flight: int = 0
+
+
+class ShutdownFlag:
+    """
+    Stop flag of one task, a slot in an array of shared memory.
+
+    get() and set() are plain memory accesses, there is no manager process
+    and no IPC round trip per check. It keeps the get()/set() interface of the
+    multiprocessing.Manager value it replaces, so existing services work as
+    they are. Pickling only carries the slot index, the worker process
+    resolves it against the array it received at start.
+
+    Every service loop checks get() once per iteration, so get() also writes
+    the heartbeat of the task. A flag without heartbeats only observes the
+    stop state, e.g. from a helper thread of the manager process.
+
+    control_addr is where the manager publishes parameter updates to its
+    workers, see halatrans/services/live_parameters.py.
+    """
+
+    def __init__(
+        self,
+        flags: Any,
+        index: int,
+        heartbeats: Optional[Any] = None,
+        control_addr: Optional[str] = None,
+    ):
+        self.flags = flags
+        self.index = index
+        self.heartbeats = heartbeats
+        self.control_addr = control_addr
+        self.base = index * HEARTBEAT_FIELDS
+
+    def get(self) -> int:
+        if self.heartbeats is not None:
+            self.heartbeats[self.base + HEARTBEAT_BEAT_TS] = time.time()
+            self.heartbeats[self.base + HEARTBEAT_ITERATIONS] += 1
+        return self.flags[self.index]
+
+    def set(self, value: int):
+        self.flags[self.index] = value
+
+    def is_set(self) -> bool:
+        return self.flags[self.index] != 0
+
+    def on_worker_start(self):
+        if self.heartbeats is not None:
+            ts = time.time()
+            self.heartbeats[self.base + HEARTBEAT_PID] = os.getpid()
+            self.heartbeats[self.base + HEARTBEAT_START_TS] = ts
+            self.heartbeats[self.base + HEARTBEAT_BEAT_TS] = ts
+
+    def on_message(self, count: int = 1):
+        if self.heartbeats is not None:
+            self.heartbeats[self.base + HEARTBEAT_MESSAGES] += count
+            self.heartbeats[self.base + HEARTBEAT_MESSAGE_TS] = time.time()
+
+    def on_queue(self, backlog: int, in_flight: int):
+        if self.heartbeats is not None:
+            self.heartbeats[self.base + HEARTBEAT_BACKLOG] = backlog
+            self.heartbeats[self.base + HEARTBEAT_IN_FLIGHT] = in_flight
+
+    def observer(self) -> "ShutdownFlag":
+        return ShutdownFlag(self.flags, self.index, control_addr=self.control_addr)
+
+    def __reduce__(self):
+        return (resolve_worker_shutdown_flag, (self.index,))
+
+
+class ShutdownFlagPool:
+    def __init__(
+        self, size: int = SHUTDOWN_FLAG_SLOTS, control_addr: Optional[str] = None
+    ):
+        # created before the worker processes, which inherit it
+        self.flags = RawArray(ctypes.c_int8, size)
+        self.heartbeats = RawArray(ctypes.c_double, size * HEARTBEAT_FIELDS)
+        self.control_addr = control_addr
+        self.free_slots: List[int] = list(range(size))
+
+    def get_initializer(self):
+        return init_worker_shutdown_flags
+
+    def get_initargs(self):
+        return (self.flags, self.heartbeats, self.control_addr)
+
+    def acquire(self) -> ShutdownFlag:
+        if len(self.free_slots) == 0:
+            raise ValueError("No free shutdown flag slot.")
+        index = self.free_slots.pop(0)
+        self.flags[index] = 0
+        flag = ShutdownFlag(self.flags, index, self.heartbeats, self.control_addr)
+        self.reset_heartbeat(flag)
+        return flag
+
+    def release(self, flag: ShutdownFlag):
+        if flag.index not in self.free_slots:
+            self.free_slots.append(flag.index)
+
+    def reset_heartbeat(self, flag: ShutdownFlag):
+        for field in range(HEARTBEAT_FIELDS):
+            self.heartbeats[flag.base + field] = 0
+
+    def get_heartbeat(self, flag: ShutdownFlag) -> TaskHeartbeat:
+        values = self.heartbeats[flag.base : flag.base + HEARTBEAT_FIELDS]
+        return TaskHeartbeat(
+            pid=int(values[HEARTBEAT_PID]),
+            start_ts=values[HEARTBEAT_START_TS],
+            beat_ts=values[HEARTBEAT_BEAT_TS],
+            iterations=int(values[HEARTBEAT_ITERATIONS]),
+            messages=int(values[HEARTBEAT_MESSAGES]),
+            message_ts=values[HEARTBEAT_MESSAGE_TS],
+            backlog=int(values[HEARTBEAT_BACKLOG]),
+            in_flight=int(values[HEARTBEAT_IN_FLIGHT]),
+        )
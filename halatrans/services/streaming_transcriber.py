@@ -0,0 +1,198 @@
+import logging
+import re
+from dataclasses import dataclass
+from typing import Any, List
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Streaming transcription with a whisper model that only decodes whole
+# buffers (after whisper_streaming, Machacek et al. 2023).
+#
+# The transcriber keeps a bounded window of the newest audio and decodes it
+# again every decode interval. Two consecutive decodes rarely agree on the
+# last words, but mostly do on the words before. LocalAgreement commits the
+# longest common prefix of the last two hypotheses (LocalAgreement-2). A word
+# that stays uncommitted longer than max_latency is committed anyway, so
+# text is final at most max_latency after it was spoken.
+#
+# The window starts at the end of the last committed word, the committed
+# text before it is the prompt of the decode.
+
+SAMPLE_RATE = 16000
+# words of a hypothesis that start this much before the end of the last
+# committed word repeat committed text
+COMMIT_TOLERANCE = 0.1  # seconds
+# longest run of committed words a hypothesis may start with again
+MAX_REPEATED_WORDS = 5
+# committed words kept for the prompt and the repetition check
+COMMITTED_TAIL = 50
+PROMPT_CHARS = 200
+# audio kept when a decode found no words, a word may start at the end
+SILENCE_KEEP = 1.0  # seconds
+
+
+@dataclass
+class Word:
+    start: float  # seconds of the stream
+    end: float
+    text: str
+
+
+def _normalize(text: str) -> str:
+    # agreement ignores case and punctuation, decodes often differ in them
+    return re.sub(r"[^\w']", "", text.lower())
+
+
+class LocalAgreement:
+    def __init__(self):
+        self.committed: List[Word] = []
+        self.hypothesis: List[Word] = []
+        self.last_end = 0.0
+
+    def insert(self, words: List[Word]) -> List[Word]:
+        # returns the words the new hypothesis agrees on with the last one
+        new = [w for w in words if w.start > self.last_end - COMMIT_TOLERANCE]
+        new = self.__drop_repeated__(new)
+        count = 0
+        for old, word in zip(self.hypothesis, new):
+            if _normalize(old.text) != _normalize(word.text):
+                break
+            count += 1
+        self.hypothesis = new[count:]
+        return self.__commit__(new[:count])
+
+    def force(self, before: float) -> List[Word]:
+        # commits the hypothesis words that end before the given stream time
+        count = 0
+        while count < len(self.hypothesis) and self.hypothesis[count].end <= before:
+            count += 1
+        forced = self.hypothesis[:count]
+        self.hypothesis = self.hypothesis[count:]
+        return self.__commit__(forced)
+
+    def flush(self) -> List[Word]:
+        forced = self.hypothesis
+        self.hypothesis = []
+        return self.__commit__(forced)
+
+    def prompt(self) -> str:
+        return " ".join(w.text for w in self.committed)[-PROMPT_CHARS:]
+
+    def __commit__(self, words: List[Word]) -> List[Word]:
+        if len(words) > 0:
+            self.committed = (self.committed + words)[-COMMITTED_TAIL:]
+            self.last_end = words[-1].end
+        return words
+
+    def __drop_repeated__(self, new: List[Word]) -> List[Word]:
+        # a hypothesis may start with the last committed words again when
+        # their timestamps moved a little
+        if len(new) == 0 or len(self.committed) == 0:
+            return new
+        if abs(new[0].start - self.last_end) >= 1.0:
+            return new
+        for n in range(min(MAX_REPEATED_WORDS, len(new), len(self.committed)), 0, -1):
+            tail = [_normalize(w.text) for w in self.committed[-n:]]
+            head = [_normalize(w.text) for w in new[:n]]
+            if tail == head:
+                return new[n:]
+        return new
+
+
+class StreamingTranscriber:
+    """
+    Turns a live audio stream into committed words. insert_audio() takes
+    float32 samples at 16 kHz, process() decodes the window and returns the
+    words committed by it, finish() commits the rest at the end of the
+    stream. The model is a faster whisper WhisperModel.
+    """
+
+    def __init__(self, max_window: float = 15.0, max_latency: float = 4.0):
+        self.max_window = max_window
+        self.max_latency = max_latency
+        self.agreement = LocalAgreement()
+        self.window = np.zeros(0, dtype=np.float32)
+        self.offset = 0.0  # stream time of the first sample of the window
+        self.pending: List[np.ndarray] = []
+        self.pending_samples = 0
+
+    @property
+    def stream_end(self) -> float:
+        samples = len(self.window) + self.pending_samples
+        return self.offset + samples / SAMPLE_RATE
+
+    @property
+    def pending_seconds(self) -> float:
+        # audio that arrived after the last decode
+        return self.pending_samples / SAMPLE_RATE
+
+    def insert_audio(self, audio: np.ndarray):
+        self.pending.append(audio)
+        self.pending_samples += len(audio)
+
+    def process(
+        self, model: Any, beam_size: int = 5, language: str = "en"
+    ) -> List[Word]:
+        if self.pending_samples > 0:
+            self.window = np.concatenate([self.window, *self.pending])
+            self.pending = []
+            self.pending_samples = 0
+        if len(self.window) == 0:
+            return []
+
+        words = self.__decode__(model, beam_size, language)
+        committed = self.agreement.insert(words)
+        committed += self.agreement.force(self.stream_end - self.max_latency)
+        committed += self.__trim__(has_words=len(words) > 0)
+        return committed
+
+    def finish(
+        self, model: Any, beam_size: int = 5, language: str = "en"
+    ) -> List[Word]:
+        committed = self.process(model, beam_size, language)
+        return committed + self.agreement.flush()
+
+    def __decode__(self, model: Any, beam_size: int, language: str) -> List[Word]:
+        segments, _ = model.transcribe(
+            self.window,
+            beam_size=beam_size,
+            language=language,
+            initial_prompt=self.agreement.prompt() or None,
+            condition_on_previous_text=False,
+            word_timestamps=True,
+            vad_filter=False,
+        )
+        words: List[Word] = []
+        for segment in segments:
+            for word in segment.words or []:
+                text = word.word.strip()
+                if len(text) > 0:
+                    words.append(
+                        Word(self.offset + word.start, self.offset + word.end, text)
+                    )
+        return words
+
+    def __trim__(self, has_words: bool) -> List[Word]:
+        window = len(self.window) / SAMPLE_RATE
+        cut = self.offset
+        if not has_words:
+            cut = self.offset + max(window - SILENCE_KEEP, 0.0)
+        elif window > self.max_window / 2:
+            # keep decodes short, the committed text is in the prompt
+            cut = max(self.agreement.last_end, self.offset)
+        # never more than the max window
+        cut = max(cut, self.offset + window - self.max_window)
+        samples = int((cut - self.offset) * SAMPLE_RATE)
+        if samples <= 0:
+            return []
+        self.window = self.window[samples:]
+        self.offset += samples / SAMPLE_RATE
+        # no later decode confirms the words in the cut audio
+        forced = self.agreement.force(self.offset)
+        self.agreement.hypothesis = [
+            w for w in self.agreement.hypothesis if w.start >= self.offset
+        ]
+        return forced
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from halatrans.services.process_task_manager import ProcessTaskManager
+from halatrans.services.shutdown import TaskHeartbeat
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SupervisorOptions:
+    check_interval: float = 1.0  # seconds
+    # no loop iteration for this long is a hung worker
+    hang_timeout: float = 60.0
+    # until the first loop iteration, models are loaded or downloaded
+    startup_timeout: float = 600.0
+    restart_backoff: float = 1.0
+    restart_backoff_max: float = 60.0
+    # a task that ran this long gets the initial backoff on its next restart
+    stable_uptime: float = 60.0
+
+
+@dataclass
+class TaskHealth:
+    service: str
+    task: str
+    task_id: str
+    state: str = "running"  # running | starting | hung | crashed | stopped
+    pid: int = 0
+    restarts: int = 0
+    launch_ts: float = field(default_factory=time.time)
+    uptime: float = 0.0
+    heartbeat_age: Optional[float] = None
+    loop_rate: float = 0.0  # iterations per second
+    messages: int = 0
+    last_message_age: Optional[float] = None
+    last_error: Optional[str] = None
+    next_restart_ts: Optional[float] = None
+    backoff: float = 0.0
+    last_iterations: int = 0
+    last_check_ts: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "service": self.service,
+            "task": self.task,
+            "taskId": self.task_id,
+            "state": self.state,
+            "pid": self.pid,
+            "restarts": self.restarts,
+            "uptime": round(self.uptime, 1),
+            "heartbeatAge": _round(self.heartbeat_age),
+            "loopRate": round(self.loop_rate, 1),
+            "messages": self.messages,
+            "lastMessageAge": _round(self.last_message_age),
+            "lastError": self.last_error,
+        }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 1)
+
+
+class ServiceSupervisor:
+    """
+    Watches the heartbeats of the tasks of a service manager from a thread of
+    the manager process. A task whose worker ended while it was not stopped,
+    or whose loop stopped iterating, is launched again with an exponential
+    backoff. Only the failed task is restarted.
+
+    Embedded services run as threads, a hung thread can not be stopped and is
+    only reported.
+    """
+
+    def __init__(
+        self,
+        task_manager: ProcessTaskManager,
+        lock: threading.RLock,
+        options: Optional[SupervisorOptions] = None,
+    ):
+        self.task_manager = task_manager
+        self.lock = lock
+        self.options = options if options else SupervisorOptions()
+        self.tasks: Dict[str, TaskHealth] = {}
+        self.__stop_event__ = threading.Event()
+        self.__thread__: Optional[threading.Thread] = None
+
+    def watch(self, service: str, task: str, task_id: str):
+        with self.lock:
+            self.tasks[task_id] = TaskHealth(
+                service=service, task=task, task_id=task_id
+            )
+
+    def unwatch(self, task_id: str):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+
+    def unwatch_all(self):
+        with self.lock:
+            self.tasks = {}
+
+    def start(self):
+        if self.__thread__ is not None:
+            return
+        self.__stop_event__.clear()
+        self.__thread__ = threading.Thread(
+            target=self.__run__, name="service-supervisor", daemon=True
+        )
+        self.__thread__.start()
+
+    def stop(self):
+        if self.__thread__ is None:
+            return
+        self.__stop_event__.set()
+        self.__thread__.join()
+        self.__thread__ = None
+
+    def get_health(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [health.to_dict() for health in self.tasks.values()]
+
+    def __run__(self):
+        logger.info("Service supervisor start.")
+        while not self.__stop_event__.wait(self.options.check_interval):
+            try:
+                with self.lock:
+                    for health in list(self.tasks.values()):
+                        self.__check__(health)
+            except Exception as err:
+                logger.error(err)
+        logger.info("Service supervisor end.")
+
+    def __check__(self, health: TaskHealth):
+        now = time.time()
+        if health.next_restart_ts is not None:
+            if now >= health.next_restart_ts:
+                self.__restart__(health, now)
+            return
+
+        future = self.task_manager.get_task_future(health.task_id)
+        heartbeat = self.task_manager.get_task_heartbeat(health.task_id)
+        if future is None or heartbeat is None:
+            health.state = "stopped"
+            return
+        if self.task_manager.is_task_stopping(health.task_id):
+            health.state = "stopped" if future.done() else "stopping"
+            return
+
+        self.__update__(health, heartbeat, now)
+
+        if future.done():
+            health.state = "crashed"
+            health.last_error = (
+                self.task_manager.get_task_error(health.task_id) or "worker exited"
+            )
+            logger.error(f"Task {health.task} crashed: {health.last_error}")
+            self.__schedule_restart__(health, now)
+            return
+
+        if heartbeat.start_ts == 0:
+            # the executor did not start the worker yet
+            state, timeout = "starting", self.options.startup_timeout
+            last_beat_ts = health.launch_ts
+        elif heartbeat.iterations == 0:
+            state, timeout = "starting", self.options.startup_timeout
+            last_beat_ts = heartbeat.beat_ts
+        else:
+            state, timeout = "running", self.options.hang_timeout
+            last_beat_ts = heartbeat.beat_ts
+        if now - last_beat_ts <= timeout:
+            health.state = state
+            return
+
+        if health.state != "hung":
+            logger.error(f"Task {health.task} hangs.")
+        health.state = "hung"
+        health.last_error = f"no heartbeat for {now - last_beat_ts:.0f}s"
+        if not self.task_manager.is_task_in_thread(health.task_id):
+            self.__schedule_restart__(health, now)
+
+    def __update__(self, health: TaskHealth, heartbeat: TaskHeartbeat, now: float):
+        health.pid = heartbeat.pid
+        if heartbeat.start_ts > 0:
+            health.uptime = now - heartbeat.start_ts
+        if heartbeat.beat_ts > 0:
+            health.heartbeat_age = now - heartbeat.beat_ts
+        if heartbeat.message_ts > 0:
+            health.last_message_age = now - heartbeat.message_ts
+        health.messages = heartbeat.messages
+        if health.last_check_ts > 0 and heartbeat.iterations >= health.last_iterations:
+            health.loop_rate = (heartbeat.iterations - health.last_iterations) / max(
+                now - health.last_check_ts, 1e-6
+            )
+        health.last_iterations = heartbeat.iterations
+        health.last_check_ts = now
+
+    def __schedule_restart__(self, health: TaskHealth, now: float):
+        if now - health.launch_ts >= self.options.stable_uptime:
+            health.backoff = 0.0
+        if health.backoff == 0.0:
+            health.backoff = self.options.restart_backoff
+        else:
+            health.backoff = min(health.backoff * 2, self.options.restart_backoff_max)
+        health.next_restart_ts = now + health.backoff
+        logger.info(f"Restart task {health.task} in {health.backoff:.1f}s")
+
+    def __restart__(self, health: TaskHealth, now: float):
+        if self.task_manager.is_task_stopping(health.task_id):
+            health.next_restart_ts = None
+            return
+        if not self.task_manager.restart_task(health.task_id):
+            # try again after the next backoff
+            self.__schedule_restart__(health, now)
+            return
+        health.next_restart_ts = None
+        health.restarts += 1
+        health.launch_ts = now
+        health.state = "starting"
+        health.last_iterations = 0
+        health.last_check_ts = 0.0
+        health.loop_rate = 0.0
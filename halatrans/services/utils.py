@@ -1,10 +1,19 @@
-from typing import Callable, List, Optional
+import asyncio
+from typing import Any, Callable, List, Optional
 
 import zmq
+import zmq.asyncio
+
+from halatrans.services.address_registry import (bind_service_socket,
+                                                 connect_service_socket,
+                                                 resolve_service_addr)
+
+BATCH_SIZE = 20
+# how often a polling loop checks its stop flag, also the heartbeat interval
+POLL_TIMEOUT_MS = 200
 
 
 def nonblock_recv_multipart(sock: zmq.Socket) -> List[bytes]:
-    BATCH_SIZE = 20
     chunks: List[bytes] = []
     while True:
         try:
@@ -17,15 +26,60 @@ def nonblock_recv_multipart(sock: zmq.Socket) -> List[bytes]:
     return chunks
 
 
-def create_pub_socket(ctx: zmq.Context, addr: str) -> zmq.Socket:
+def nonblock_recv_frames(sock: zmq.Socket) -> List[List[zmq.Frame]]:
+    # Like nonblock_recv_multipart, but keeps every frame after the topic and
+    # does not copy them, for multipart binary messages.
+    messages: List[List[zmq.Frame]] = []
+    while True:
+        try:
+            frames = sock.recv_multipart(zmq.DONTWAIT, copy=False)
+            messages.append(frames[1:])
+            if len(messages) > BATCH_SIZE:
+                break
+        except zmq.Again:
+            break
+    return messages
+
+
+def attach_socket(sock: zmq.Socket, addr: str, bind: bool) -> str:
+    # "@addr" always binds and ">addr" always connects, e.g. a publisher
+    # connects to the XSUB side of the broker instead of binding.
+    if addr.startswith("@"):
+        bind, addr = True, addr[1:]
+    elif addr.startswith(">"):
+        bind, addr = False, addr[1:]
+    if bind:
+        return bind_service_socket(sock, addr)
+    return connect_service_socket(sock, addr)
+
+
+async def async_wait_connectable(addrs: List[str]):
+    # Await this in an event loop before attach_socket connects to addrs,
+    # waiting for a binder with an ephemeral port would block the loop.
+    for addr in addrs:
+        if addr.startswith("@"):
+            continue
+        await resolve_service_addr(addr.lstrip(">"))
+
+
+def create_pub_socket(
+    ctx: zmq.Context, addr: str, hwm: Optional[int] = None
+) -> zmq.Socket:
     pub = ctx.socket(zmq.PUB)
-    pub.bind(addr)
+    if hwm is not None:
+        pub.setsockopt(zmq.SNDHWM, hwm)
+    attach_socket(pub, addr, bind=True)
     return pub
 
 
-def create_sub_socket(ctx: zmq.Context, addr: str, topics: List[str]) -> zmq.Socket:
+def create_sub_socket(
+    ctx: zmq.Context, addr: str, topics: List[str], hwm: Optional[int] = None
+) -> zmq.Socket:
     sub = ctx.socket(zmq.SUB)
-    sub.connect(addr)
+    if hwm is not None:
+        # must be set before connecting to take effect
+        sub.setsockopt(zmq.RCVHWM, hwm)
+    attach_socket(sub, addr, bind=False)
     for topic in topics:
         sub.setsockopt(zmq.SUBSCRIBE, bytes(topic, encoding="utf-8"))
     return sub
@@ -33,16 +87,22 @@ def create_sub_socket(ctx: zmq.Context, addr: str, topics: List[str]) -> zmq.Soc
 
 def create_req_socket(ctx: zmq.Context, addr: str) -> zmq.Socket:
     req = ctx.socket(zmq.REQ)
-    req.connect(addr)
+    attach_socket(req, addr, bind=False)
     return req
 
 
 def create_rep_socket(ctx: zmq.Context, addr: str) -> zmq.Socket:
     rep = ctx.socket(zmq.REP)
-    rep.bind(addr)
+    attach_socket(rep, addr, bind=True)
     return rep
 
 
+def create_router_socket(ctx: zmq.Context, addr: str) -> zmq.Socket:
+    router = ctx.socket(zmq.ROUTER)
+    attach_socket(router, addr, bind=True)
+    return router
+
+
 def handle_response_messages(
     sock: zmq.Socket,
     message_handler: Optional[Callable[[str, bytes], None]],
@@ -62,9 +122,12 @@ def handle_response_messages(
 
 def poll_messages(
     in_socks: List[zmq.Socket],
-    message_handler: Optional[Callable[[zmq.Socket, List[bytes]], None]],
+    message_handler: Optional[Callable[[zmq.Socket, List[Any]], None]],
     should_stop: Optional[Callable[[], bool]] = None,
+    frame_socks: Optional[List[zmq.Socket]] = None,
 ):
+    # Sockets in frame_socks carry multipart binary messages, the handler
+    # gets a list of zmq.Frame lists for them instead of a list of bytes.
     poller = zmq.Poller()
     for sub_sock in in_socks:
         poller.register(sub_sock, zmq.POLLIN)
@@ -74,12 +137,58 @@ def poll_messages(
             break
 
         try:
-            available_socks = dict(poller.poll(timeout=5000))
+            available_socks = dict(poller.poll(timeout=POLL_TIMEOUT_MS))
         except KeyboardInterrupt:
             break
 
         for sub_sock in in_socks:
             if sub_sock in available_socks:
-                chunks = nonblock_recv_multipart(sub_sock)
+                if frame_socks and sub_sock in frame_socks:
+                    chunks = nonblock_recv_frames(sub_sock)
+                else:
+                    chunks = nonblock_recv_multipart(sub_sock)
                 if message_handler:
                     message_handler(sub_sock, chunks)
+
+
+async def async_recv_batch(sock: zmq.asyncio.Socket, frames: bool = False) -> List[Any]:
+    # Waits for the first message, then drains what is already queued.
+    # With frames, every frame after the topic is kept, uncopied.
+    messages: List[Any] = []
+    while True:
+        parts = await sock.recv_multipart(copy=not frames)
+        messages.append(parts[1:] if frames else parts[1])
+        if len(messages) > BATCH_SIZE or not (sock.get(zmq.EVENTS) & zmq.POLLIN):
+            break
+    return messages
+
+
+async def async_poll_messages(
+    in_socks: List[zmq.asyncio.Socket],
+    message_handler: Optional[Callable[[zmq.Socket, List[Any]], Any]],
+    should_stop: Optional[Callable[[], bool]] = None,
+    frame_socks: Optional[List[zmq.Socket]] = None,
+    stop_check_interval: int = 200,
+):
+    # The asyncio counterpart of poll_messages. It wakes on socket readiness,
+    # the timeout only bounds how late a stop is noticed. The handler may be
+    # a coroutine function.
+    poller = zmq.asyncio.Poller()
+    for sub_sock in in_socks:
+        poller.register(sub_sock, zmq.POLLIN)
+
+    while True:
+        if should_stop and should_stop():
+            break
+
+        available_socks = dict(await poller.poll(timeout=stop_check_interval))
+
+        for sub_sock in in_socks:
+            if sub_sock in available_socks:
+                chunks = await async_recv_batch(
+                    sub_sock, frames=bool(frame_socks and sub_sock in frame_socks)
+                )
+                if message_handler:
+                    result = message_handler(sub_sock, chunks)
+                    if asyncio.iscoroutine(result):
+                        await result
@@ -0,0 +1,140 @@
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, List, Optional
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Cuts the audio stream into utterances by frame energy, a fraction of the
+# cost of a full vosk decode for finding where utterances start and end.
+#
+# The noise floor follows the energy of the quiet frames, quickly down and
+# slowly up. It starts at the floor of a quiet stream, so speech at the start
+# of the stream is not taken for noise. A frame is speech when it is
+# margin_db above the floor and louder than min_db. An utterance starts at
+# its first speech frame with pre_roll seconds of the audio before it, and
+# ends after end_silence seconds without speech or at max_utterance seconds.
+# Utterances with less than min_speech seconds of speech are dropped as
+# noise.
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+INT16_MAX_ABS_VALUE = 32768.0
+# share of the distance to a frame's energy the noise floor moves per frame
+NOISE_FALL_RATE = 0.5
+NOISE_RISE_RATE = 0.05
+NOISE_RISE_RATE_IN_SPEECH = 0.005
+
+
+@dataclass
+class Segment:
+    start: int  # samples since the start of the stream
+    end: int
+    audio: np.ndarray  # int16
+
+
+def frame_energies(pcm: np.ndarray, frame_size: int) -> np.ndarray:
+    # dBFS of every whole frame
+    count = len(pcm) // frame_size
+    frames = pcm[: count * frame_size].reshape(count, frame_size)
+    frames = frames.astype(np.float32) / INT16_MAX_ABS_VALUE
+    return 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+
+
+class VadSegmenter:
+    def __init__(
+        self,
+        sample_rate: int = SAMPLE_RATE,
+        margin_db: float = 10.0,
+        min_db: float = -50.0,
+        end_silence: float = 0.5,
+        min_speech: float = 0.2,
+        max_utterance: float = 25.0,
+        pre_roll: float = 0.3,
+    ):
+        self.frame_size = sample_rate * FRAME_MS // 1000
+        self.margin_db = margin_db
+        self.min_db = min_db
+        self.end_silence = end_silence
+        self.min_speech = min_speech
+        self.max_utterance = max_utterance
+        self.noise_db = min_db - margin_db
+        self.__rest__ = np.zeros(0, dtype=np.int16)
+        self.__pre_roll__: Deque[np.ndarray] = deque(
+            maxlen=self.__frames_of__(pre_roll)
+        )
+        self.__frames__: List[np.ndarray] = []
+        self.__speech_frames__ = 0
+        self.__silent_frames__ = 0
+        self.__start__ = 0
+        self.__position__ = 0
+
+    def __frames_of__(self, seconds: float) -> int:
+        return int(seconds * 1000) // FRAME_MS
+
+    @property
+    def in_speech(self) -> bool:
+        return len(self.__frames__) > 0
+
+    def accept(self, pcm: np.ndarray) -> List[Segment]:
+        # returns the utterances that ended in pcm, int16 samples
+        pcm = np.concatenate([self.__rest__, pcm])
+        count = len(pcm) // self.frame_size
+        self.__rest__ = pcm[count * self.frame_size :]
+
+        segments: List[Segment] = []
+        for idx, energy in enumerate(frame_energies(pcm, self.frame_size)):
+            frame = pcm[idx * self.frame_size : (idx + 1) * self.frame_size]
+            segment = self.__accept_frame__(frame, float(energy))
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> Optional[Segment]:
+        # the end of the stream ends the utterance
+        if not self.in_speech:
+            return None
+        return self.__cut__()
+
+    def __accept_frame__(self, frame: np.ndarray, energy: float) -> Optional[Segment]:
+        is_speech = energy > max(self.noise_db + self.margin_db, self.min_db)
+        if energy < self.noise_db:
+            rate = NOISE_FALL_RATE
+        elif is_speech:
+            rate = NOISE_RISE_RATE_IN_SPEECH
+        else:
+            rate = NOISE_RISE_RATE
+        self.noise_db += rate * (energy - self.noise_db)
+        self.__position__ += len(frame)
+
+        if not self.in_speech:
+            if not is_speech:
+                self.__pre_roll__.append(frame)
+                return None
+            self.__frames__ = list(self.__pre_roll__)
+            self.__pre_roll__.clear()
+            self.__start__ = self.__position__ - len(frame) * (len(self.__frames__) + 1)
+            self.__speech_frames__ = 0
+            self.__silent_frames__ = 0
+
+        self.__frames__.append(frame)
+        if is_speech:
+            self.__speech_frames__ += 1
+            self.__silent_frames__ = 0
+        else:
+            self.__silent_frames__ += 1
+        is_end = self.__silent_frames__ >= self.__frames_of__(self.end_silence)
+        is_too_long = len(self.__frames__) >= self.__frames_of__(self.max_utterance)
+        if is_end or is_too_long:
+            return self.__cut__()
+        return None
+
+    def __cut__(self) -> Optional[Segment]:
+        frames, self.__frames__ = self.__frames__, []
+        if self.__speech_frames__ < self.__frames_of__(self.min_speech):
+            return None
+        audio = np.concatenate(frames)
+        return Segment(self.__start__, self.__start__ + len(audio), audio)
@@ -0,0 +1,627 @@
+import collections
+import logging
+import struct
+import time
+from abc import abstractmethod
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, Type
+
+import zmq
+
+from halatrans.services.base_service import (BaseServiceImpl, ServiceConfig,
+                                             ServiceMode, ServiceT)
+from halatrans.services.context import create_context
+from halatrans.services.live_parameters import LiveParameters
+from halatrans.services.qos import create_qos_publisher, create_qos_sub_socket
+from halatrans.services.shutdown import ShutdownFlag
+from halatrans.services.utils import (attach_socket, nonblock_recv_frames,
+                                      poll_messages)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Replica protocol, replicas connect a DEALER to the ROUTER of the dispatcher:
+#
+#   replica -> dispatcher   [b"READY", credits]
+#                           [b"DONE", seq, output frame counts, *output frames]
+#                           [b"BYE"]
+#   dispatcher -> replica   [b"WORK", seq, *input frames]
+#                           [b"BYE"]
+#
+# A replica only gets work it asked for, so a slow replica never piles up a
+# queue while the others are idle. Every DONE returns one credit. Work goes
+# to the replica with the most free credits, so a replica only gets a batch
+# when the backlog is larger than the idle replicas.
+#
+# A stopped replica leaves with BYE, the dispatcher drops its credits and
+# answers BYE. The work sent before that answer is still done, so a replica
+# is removed without losing items, e.g. when the pool is scaled down.
+#
+# A replica announces itself with READY and no credits before it loads its
+# models. A replica restarted by the supervisor has the identity of the one
+# it replaces, the items that one still held are dispatched again.
+
+REPLICA_READY = b"READY"
+REPLICA_DONE = b"DONE"
+REPLICA_WORK = b"WORK"
+REPLICA_BYE = b"BYE"
+# how long a stopped replica waits for the BYE of the dispatcher
+REPLICA_BYE_TIMEOUT = 0.5  # seconds
+
+SEQ_STRUCT = struct.Struct("<Q")
+
+ReplicaRole = str  # single | dispatcher | replica
+OutputMessages = List[List[bytes]]
+
+
+@dataclass
+class WorkQueueEndpoints:
+    input_addr: str
+    input_topics: List[str]
+    output_addr: str
+    # topics published on output_addr, they select the output QoS
+    output_topics: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ReplicaOptions:
+    role: ReplicaRole = "single"
+    index: int = 0
+    addr: Optional[str] = None  # ROUTER of the dispatcher
+    prefetch: int = 1  # work items a replica holds at once
+    # items processed together by on_worker_process_batch, a worker waits
+    # batch_deadline for more items once it has one
+    max_batch: int = 1
+    batch_deadline: float = 0.05  # seconds
+    # how long the dispatcher waits for a lost item before it moves on
+    resequence_timeout: float = 30.0  # seconds
+    stats_interval: float = 60.0  # seconds
+
+
+def replica_options(options: Optional[Dict[str, Any]]) -> ReplicaOptions:
+    if options is None or "replica" not in options:
+        return ReplicaOptions()
+    return ReplicaOptions(**options["replica"])
+
+
+def _process_batch(
+    cls: Type["WorkQueueService"],
+    state: Any,
+    parameters: Dict[str, Any],
+    items: List[List[Any]],
+) -> List[OutputMessages]:
+    if len(items) > 1:
+        try:
+            return cls.on_worker_process_batch(state, parameters, items)
+        except Exception as err:
+            logger.error(f"Batch of {len(items)} items failed, retry one by one: {err}")
+    results: List[OutputMessages] = []
+    for frames in items:
+        try:
+            results.append(cls.on_worker_process_item(state, parameters, frames))
+        except Exception as err:
+            logger.error(err)
+            results.append([])
+    return results
+
+
+def encode_outputs(outputs: OutputMessages) -> List[bytes]:
+    counts = struct.pack(f"<{len(outputs)}I", *[len(m) for m in outputs])
+    frames: List[bytes] = [counts]
+    for message in outputs:
+        frames.extend(message)
+    return frames
+
+
+def decode_outputs(frames: List[bytes]) -> OutputMessages:
+    counts = struct.unpack(f"<{len(frames[0]) // 4}I", frames[0])
+    outputs: OutputMessages = []
+    offset = 1
+    for count in counts:
+        outputs.append(frames[offset : offset + count])
+        offset += count
+    return outputs
+
+
+class Resequencer:
+    """
+    Releases results in dispatch order. A missing result holds back the ones
+    after it until it arrives or resequence_timeout passes since dispatch.
+    """
+
+    def __init__(self, name: str, timeout: float):
+        self.name = name
+        self.timeout = timeout
+        self.next_seq = 0
+        self.dispatch_ts: Dict[int, float] = {}
+        self.results: Dict[int, OutputMessages] = {}
+        self.skipped_count = 0
+
+    def on_dispatch(self, seq: int):
+        self.dispatch_ts[seq] = time.time()
+
+    def on_result(self, seq: int, outputs: OutputMessages) -> OutputMessages:
+        if seq < self.next_seq:
+            # arrived after its timeout
+            logger.warning(f"[{self.name}] drop late result {seq}")
+            return []
+        self.results[seq] = outputs
+        return self.__release__()
+
+    def expire(self) -> OutputMessages:
+        now = time.time()
+        released: OutputMessages = []
+        while (
+            self.next_seq in self.dispatch_ts
+            and self.next_seq not in self.results
+            and now - self.dispatch_ts[self.next_seq] > self.timeout
+        ):
+            logger.warning(f"[{self.name}] skip lost item {self.next_seq}")
+            self.dispatch_ts.pop(self.next_seq)
+            self.next_seq += 1
+            self.skipped_count += 1
+            released.extend(self.__release__())
+        return released
+
+    def __release__(self) -> OutputMessages:
+        released: OutputMessages = []
+        while self.next_seq in self.results:
+            released.extend(self.results.pop(self.next_seq))
+            self.dispatch_ts.pop(self.next_seq, None)
+            self.next_seq += 1
+        return released
+
+    def pending(self) -> int:
+        return len(self.dispatch_ts)
+
+
+class WorkQueueStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.received_count = 0
+        self.completed_count = 0
+        self.backlog = 0
+        self.in_flight = 0
+        self.replica_completed: Dict[str, int] = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "received": self.received_count,
+            "completed": self.completed_count,
+            "backlog": self.backlog,
+            "in_flight": self.in_flight,
+            "replicas": dict(self.replica_completed),
+        }
+
+    def log(self):
+        logger.info(f"[{self.name}] work queue stats: {self.to_dict()}")
+
+
+class WorkQueueService(BaseServiceImpl):
+    """
+    A CustomService shaped as a work queue: every input message is processed
+    on its own and turns into zero or more output messages.
+
+    With ServiceConfig.replicas > 1 the manager launches a dispatcher and N
+    replicas of the service. The dispatcher owns the input subscription and
+    the output publisher, hands the inputs to idle replicas and publishes the
+    results in input order.
+    """
+
+    def __init__(self, config: ServiceConfig):
+        super().__init__(config)
+
+    def get_mode(self) -> ServiceMode:
+        return ServiceMode.CUSTOM
+
+    @staticmethod
+    @abstractmethod
+    def get_work_queue_endpoints(parameters: Dict[str, Any]) -> WorkQueueEndpoints:
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def on_worker_setup(parameters: Dict[str, Any]) -> Any:
+        # loads the models etc., returns the state passed to every item
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def on_worker_process_item(
+        state: Any, parameters: Dict[str, Any], frames: List[Any]
+    ) -> OutputMessages:
+        # frames of one input message without the topic, returns complete
+        # output messages, topic first
+        pass
+
+    @classmethod
+    def on_worker_process_batch(
+        cls, state: Any, parameters: Dict[str, Any], items: List[List[Any]]
+    ) -> List[OutputMessages]:
+        # override this method to process the items of a batch at once, e.g.
+        # with one batched model call, returns the outputs of every item
+        return [cls.on_worker_process_item(state, parameters, i) for i in items]
+
+    @staticmethod
+    def on_worker_parameters_updated(state: Any, parameters: Dict[str, Any]):
+        # override this method to act on live parameter updates before the
+        # next item, e.g. to start loading a new model
+        pass
+
+    @staticmethod
+    def create_input_monitor(
+        parameters: Dict[str, Any],
+    ) -> Optional[Callable[[List[Any]], None]]:
+        # override this method to look at every input on the subscriber side,
+        # before it is dispatched, e.g. to detect sequence gaps
+        return None
+
+    @staticmethod
+    async def on_worker_process_begin(
+        stop_flag: ShutdownFlag,
+        cls: Type[ServiceT],
+        addr: Optional[str],
+        topic: Optional[str],
+        parameters: Dict[str, Any],
+        options: Optional[Dict[str, Any]] = None,
+    ):
+        if not issubclass(cls, WorkQueueService):
+            raise ValueError(f"Class is not subclass of WorkQueueService, {cls}")
+
+        replica = replica_options(options)
+        logger.info(f"WORKQUEUE worker start... {cls.__name__} {replica}")
+        if replica.role == "single":
+            handler = WorkQueueService.__single_worker__
+        elif replica.role == "dispatcher":
+            handler = WorkQueueService.__dispatcher_worker__
+        elif replica.role == "replica":
+            handler = WorkQueueService.__replica_worker__
+        else:
+            raise ValueError(f"Unknown replica role: {replica.role}")
+        handler(stop_flag, cls, parameters, replica)
+        logger.info(f"WORKQUEUE worker end. {cls.__name__}")
+
+    @staticmethod
+    def __single_worker__(
+        stop_flag: ShutdownFlag,
+        cls: Type["WorkQueueService"],
+        parameters: Dict[str, Any],
+        replica: ReplicaOptions,
+    ):
+        endpoints = cls.get_work_queue_endpoints(parameters)
+        ctx = create_context()
+        # subscribed before the setup, the updates during it apply after it
+        live = LiveParameters(ctx, stop_flag, cls, parameters)
+        state = cls.on_worker_setup(parameters)
+        input_monitor = cls.create_input_monitor(parameters)
+
+        output_pub = create_qos_publisher(
+            ctx, endpoints.output_addr, endpoints.output_topics
+        )
+        input_sub = create_qos_sub_socket(
+            ctx, endpoints.input_addr, endpoints.input_topics
+        )
+
+        def update_parameters():
+            if not live.poll():
+                return
+            try:
+                cls.on_worker_parameters_updated(state, live.parameters)
+            except Exception as err:
+                logger.error(err)
+
+        def should_stop() -> bool:
+            update_parameters()
+            return stop_flag.get() != 0
+
+        def messages_handler(sock: zmq.Socket, messages: List[List[zmq.Frame]]):
+            # wait a little for a fuller batch
+            deadline = time.time() + replica.batch_deadline
+            while len(messages) < replica.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0 or input_sub.poll(int(remaining * 1000)) == 0:
+                    break
+                messages.extend(nonblock_recv_frames(input_sub))
+
+            stop_flag.on_message(len(messages))
+            if input_monitor:
+                for frames in messages:
+                    try:
+                        input_monitor(frames)
+                    except Exception as err:
+                        logger.error(err)
+            for start in range(0, len(messages), replica.max_batch):
+                update_parameters()
+                batch = messages[start : start + replica.max_batch]
+                for outputs in _process_batch(cls, state, live.parameters, batch):
+                    for message in outputs:
+                        output_pub.send_multipart(message)
+
+        try:
+            poll_messages(
+                [input_sub], messages_handler, should_stop, frame_socks=[input_sub]
+            )
+        except Exception as err:
+            logger.error(err)
+        finally:
+            live.close()
+            output_pub.close()
+            input_sub.close()
+            ctx.term()
+
+    @staticmethod
+    def __dispatcher_worker__(
+        stop_flag: ShutdownFlag,
+        cls: Type["WorkQueueService"],
+        parameters: Dict[str, Any],
+        replica: ReplicaOptions,
+    ):
+        endpoints = cls.get_work_queue_endpoints(parameters)
+
+        ctx = create_context()
+        output_pub = create_qos_publisher(
+            ctx, endpoints.output_addr, endpoints.output_topics
+        )
+        input_sub = create_qos_sub_socket(
+            ctx, endpoints.input_addr, endpoints.input_topics
+        )
+        router = ctx.socket(zmq.ROUTER)
+        # sending to a replica that went away raises instead of dropping
+        router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        # a restarted replica reuses its identity, it takes over the pipe the
+        # dead one may still hold instead of being refused
+        router.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        attach_socket(router, replica.addr, bind=True)
+
+        input_monitor = cls.create_input_monitor(parameters)
+        name = cls.__name__
+        stats = WorkQueueStats(name)
+        resequencer = Resequencer(name, replica.resequence_timeout)
+        backlog: Deque[List[zmq.Frame]] = collections.deque()
+        # replica identity -> free credits, in the order they were used
+        credits: "collections.OrderedDict[bytes, int]" = collections.OrderedDict()
+        # replicas that said BYE, their last DONEs return no credit
+        leaving: Set[bytes] = set()
+        dispatch_seq = 0
+        # replica identity -> seq -> input frames, until DONE
+        outstanding: Dict[bytes, Dict[int, List[zmq.Frame]]] = {}
+        # items of lost replicas, dispatched before the backlog
+        retries: Deque[Tuple[int, List[zmq.Frame]]] = collections.deque()
+
+        def publish(outputs: OutputMessages):
+            for message in outputs:
+                output_pub.send_multipart(message)
+
+        def dispatch():
+            nonlocal dispatch_seq
+            while (len(retries) > 0 or len(backlog) > 0) and len(credits) > 0:
+                # the least used first among the replicas with the most credits
+                identity = max(credits, key=credits.__getitem__)
+                if len(retries) > 0:
+                    seq, frames = retries[0]
+                else:
+                    seq, frames = dispatch_seq, backlog[0]
+                try:
+                    router.send_multipart(
+                        [identity, REPLICA_WORK, SEQ_STRUCT.pack(seq), *frames],
+                        copy=False,
+                    )
+                except zmq.ZMQError as err:
+                    if err.errno != zmq.EHOSTUNREACH:
+                        raise
+                    logger.warning(f"[{name}] replica {identity} is gone.")
+                    credits.pop(identity)
+                    continue
+                credits[identity] -= 1
+                if credits[identity] == 0:
+                    credits.pop(identity)
+                else:
+                    credits.move_to_end(identity)
+                if len(retries) > 0:
+                    retries.popleft()
+                else:
+                    backlog.popleft()
+                    dispatch_seq += 1
+                resequencer.on_dispatch(seq)
+                outstanding.setdefault(identity, {})[seq] = frames
+
+        def handle_replica_message(frames: List[bytes]):
+            identity, cmd = frames[0], frames[1]
+            if cmd == REPLICA_READY:
+                # a new replica may reuse the identity of a removed one
+                leaving.discard(identity)
+                lost = outstanding.pop(identity, {})
+                # the rest was skipped by the resequencer already
+                lost_seqs = [seq for seq in sorted(lost) if seq >= resequencer.next_seq]
+                if len(lost_seqs) > 0:
+                    logger.warning(
+                        f"[{name}] replica {identity} restarted, "
+                        f"dispatch its items {lost_seqs} again."
+                    )
+                    retries.extend((seq, lost[seq]) for seq in lost_seqs)
+                if int(frames[2]) > 0:
+                    credits[identity] = credits.get(identity, 0) + int(frames[2])
+            elif cmd == REPLICA_BYE:
+                leaving.add(identity)
+                credits.pop(identity, None)
+                try:
+                    router.send_multipart([identity, REPLICA_BYE])
+                except zmq.ZMQError:
+                    pass
+                logger.info(f"[{name}] replica {identity} left.")
+            elif cmd == REPLICA_DONE:
+                (seq,) = SEQ_STRUCT.unpack(frames[2])
+                outstanding.get(identity, {}).pop(seq, None)
+                if identity not in leaving:
+                    credits[identity] = credits.get(identity, 0) + 1
+                key = str(identity, encoding="utf-8")
+                stats.replica_completed[key] = stats.replica_completed.get(key, 0) + 1
+                stats.completed_count += 1
+                publish(resequencer.on_result(seq, decode_outputs(frames[3:])))
+            else:
+                logger.error(f"[{name}] unknown replica command {cmd}")
+
+        poller = zmq.Poller()
+        poller.register(input_sub, zmq.POLLIN)
+        poller.register(router, zmq.POLLIN)
+
+        last_stats_ts = time.time()
+        try:
+            while stop_flag.get() == 0:
+                events = dict(poller.poll(200))
+                if router in events:
+                    while True:
+                        try:
+                            frames = router.recv_multipart(zmq.DONTWAIT)
+                        except zmq.Again:
+                            break
+                        handle_replica_message(frames)
+                if input_sub in events:
+                    messages = nonblock_recv_frames(input_sub)
+                    stats.received_count += len(messages)
+                    stop_flag.on_message(len(messages))
+                    for frames in messages:
+                        try:
+                            if input_monitor:
+                                input_monitor(frames)
+                        except Exception as err:
+                            logger.error(err)
+                        backlog.append(frames)
+
+                dispatch()
+                publish(resequencer.expire())
+
+                stats.backlog = len(backlog)
+                stats.in_flight = resequencer.pending()
+                stop_flag.on_queue(stats.backlog, stats.in_flight)
+                if time.time() - last_stats_ts > replica.stats_interval:
+                    last_stats_ts = time.time()
+                    stats.log()
+        except Exception as err:
+            logger.error(err)
+        finally:
+            stats.log()
+            output_pub.close()
+            input_sub.close()
+            router.close(linger=0)
+            ctx.term()
+
+    @staticmethod
+    def __replica_worker__(
+        stop_flag: ShutdownFlag,
+        cls: Type["WorkQueueService"],
+        parameters: Dict[str, Any],
+        replica: ReplicaOptions,
+    ):
+        ctx = create_context()
+        dealer = ctx.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, bytes(f"replica-{replica.index}", "utf-8"))
+        attach_socket(dealer, replica.addr, bind=False)
+        # a restarted replica gets the work of the one it replaces dispatched
+        # again before it loads its models
+        dealer.send_multipart([REPLICA_READY, b"0"])
+        # subscribed before the setup, the updates during it apply after it
+        live = LiveParameters(ctx, stop_flag, cls, parameters)
+        state = cls.on_worker_setup(parameters)
+        # ask for work once the model is ready, a batch at least
+        credits = max(replica.prefetch, replica.max_batch)
+        dealer.send_multipart([REPLICA_READY, b"%d" % credits])
+
+        def update_parameters():
+            if not live.poll():
+                return
+            try:
+                cls.on_worker_parameters_updated(state, live.parameters)
+            except Exception as err:
+                logger.error(err)
+
+        def collect(frames: List[zmq.Frame]) -> List[List[zmq.Frame]]:
+            # more work that arrives within the batch deadline
+            batch = [frames]
+            deadline = time.time() + replica.batch_deadline
+            while len(batch) < replica.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0 or dealer.poll(int(remaining * 1000)) == 0:
+                    break
+                frames = dealer.recv_multipart(copy=False)
+                if frames[0].bytes == REPLICA_WORK:
+                    batch.append(frames)
+            return batch
+
+        def process(batch: List[List[zmq.Frame]]):
+            stop_flag.on_message(len(batch))
+            update_parameters()
+            items = [frames[2:] for frames in batch]
+            results = _process_batch(cls, state, live.parameters, items)
+            for frames, outputs in zip(batch, results):
+                # an empty result still returns the credit and the seq
+                dealer.send_multipart(
+                    [REPLICA_DONE, frames[1].bytes, *encode_outputs(outputs)]
+                )
+
+        try:
+            while stop_flag.get() == 0:
+                if dealer.poll(200) == 0:
+                    update_parameters()
+                    continue
+                frames = dealer.recv_multipart(copy=False)
+                if frames[0].bytes == REPLICA_WORK:
+                    process(collect(frames))
+
+            dealer.send_multipart([REPLICA_BYE])
+            deadline = time.time() + REPLICA_BYE_TIMEOUT
+            while time.time() < deadline:
+                if dealer.poll(50) == 0:
+                    continue
+                frames = dealer.recv_multipart(copy=False)
+                if frames[0].bytes == REPLICA_BYE:
+                    break
+                if frames[0].bytes == REPLICA_WORK:
+                    process([frames])
+                    deadline = time.time() + REPLICA_BYE_TIMEOUT
+        except Exception as err:
+            logger.error(err)
+        finally:
+            live.close()
+            # the last DONE is still on its way to the dispatcher
+            dealer.close(linger=int(REPLICA_BYE_TIMEOUT * 1000))
+            ctx.term()
+
+
+def replica_task_options(
+    options: Optional[Dict[str, Any]], replica: ReplicaOptions
+) -> Dict[str, Any]:
+    task_options = dict(options) if options else {}
+    task_options["replica"] = asdict(replica)
+    return task_options
+
+
+def replica_tasks(
+    service_name: str, replicas: int, options: Optional[Dict[str, Any]]
+) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Returns (task name, worker options) of the dispatcher and the replicas of
+    a work queue service.
+    """
+    base = replica_options(options)
+    base.addr = f"svc://{service_name}-replicas"
+    tasks = [
+        (service_name, replica_task_options(options, _with_role(base, "dispatcher")))
+    ]
+    for idx in range(replicas):
+        tasks.append(replica_task(service_name, idx, options))
+    return tasks
+
+
+def replica_task(
+    service_name: str, index: int, options: Optional[Dict[str, Any]]
+) -> Tuple[str, Dict[str, Any]]:
+    # a replica joins the pool of the dispatcher at any time
+    replica = _with_role(replica_options(options), "replica")
+    replica.addr = f"svc://{service_name}-replicas"
+    replica.index = index
+    return (f"{service_name}.{index}", replica_task_options(options, replica))
+
+
+def _with_role(replica: ReplicaOptions, role: ReplicaRole) -> ReplicaOptions:
+    return ReplicaOptions(**{**asdict(replica), "role": role})
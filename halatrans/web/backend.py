@@ -11,7 +11,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 
 from halatrans.config.config import Settings
-from halatrans.model.services import ServiceRequest
+from halatrans.model.envelope import decode_envelope, envelope_to_dict
+from halatrans.model.services import (ModelSwapRequest, ServiceConfigRequest,
+                                      ServiceRequest)
 from halatrans.services.backend.rts2t_service import RTS2TService
 from halatrans.services.service_backend_manager import BackendServiceManager
 
@@ -25,7 +27,12 @@ class GlobalInstance:
 
     async def startup(self, settings: Settings):
         logger.info("Global instance startup.")
-        self.backend_service_manager = BackendServiceManager()
+        self.backend_service_manager = BackendServiceManager(
+            embedded=settings.embedded,
+            plan_cpus=settings.cpu_plan,
+            whisper_streaming=settings.whisper_streaming,
+            transcribe_segmenter=settings.transcribe_segmenter,
+        )
         self.backend_service_manager.start()
         logger.info("start backend service manager.")
 
@@ -60,6 +67,7 @@ async def lifespan(app: FastAPI):
     finally:
         instance.terminate()
 
+
 settings = Settings()
 app = FastAPI(lifespan=lifespan)
 if settings.mode == "dev":
@@ -91,10 +99,12 @@ async def service_management_query(
         state = "Running" if mgr.is_running else ""
         content = {
             "runningState": state,
+            "ready": mgr.is_ready,
         }
     else:
         content = {
             "runningState": "",
+            "ready": False,
         }
     return JSONResponse(content, status_code=200)
 
@@ -106,13 +116,86 @@ async def service_management_ctrl(
 ):
     mgr = instance.get_backend_service_manager()
     if mgr:
-        msg = mgr.run_command(request.cmd)
+        # start returns once the services are ready, keep the loop serving
+        msg = await asyncio.to_thread(mgr.run_command, request.cmd)
     else:
         msg = {"message": "Service not started."}
     content = {"message": msg}
     return JSONResponse(content, status_code=200)
 
 
+@app.get("/api/service_health")
+async def service_health_query(
+    instance: GlobalInstance = Depends(get_global_instance),
+):
+    mgr = instance.get_backend_service_manager()
+    # the manager lock is held while tasks restart, keep the loop serving
+    content = {
+        "runningState": "Running" if mgr and mgr.is_running else "",
+        "tasks": await asyncio.to_thread(mgr.get_service_health) if mgr else [],
+    }
+    return JSONResponse(content, status_code=200)
+
+
+@app.get("/api/autoscale")
+async def autoscale_query(
+    instance: GlobalInstance = Depends(get_global_instance),
+):
+    mgr = instance.get_backend_service_manager()
+    if mgr:
+        content = await asyncio.to_thread(mgr.get_autoscale_metrics)
+    else:
+        content = {"services": [], "decisions": []}
+    return JSONResponse(content, status_code=200)
+
+
+@app.get("/api/service_config")
+async def service_config_query(
+    instance: GlobalInstance = Depends(get_global_instance),
+):
+    mgr = instance.get_backend_service_manager()
+    content = {
+        "services": await asyncio.to_thread(mgr.get_service_parameters) if mgr else {}
+    }
+    return JSONResponse(content, status_code=200)
+
+
+@app.post("/api/service_config")
+async def service_config_update(
+    request: ServiceConfigRequest,
+    instance: GlobalInstance = Depends(get_global_instance),
+):
+    mgr = instance.get_backend_service_manager()
+    if mgr is None:
+        return JSONResponse({"error": "Service not started."}, status_code=503)
+    try:
+        parameters = await asyncio.to_thread(
+            mgr.update_service_parameters, request.service, request.parameters
+        )
+    except ValueError as err:
+        return JSONResponse({"error": str(err)}, status_code=400)
+    content = {"service": request.service, "parameters": parameters}
+    return JSONResponse(content, status_code=200)
+
+
+@app.post("/api/model_swap")
+async def model_swap(
+    request: ModelSwapRequest,
+    instance: GlobalInstance = Depends(get_global_instance),
+):
+    mgr = instance.get_backend_service_manager()
+    if mgr is None:
+        return JSONResponse({"error": "Service not started."}, status_code=503)
+    try:
+        parameters = await asyncio.to_thread(
+            mgr.swap_service_model, request.service, request.model
+        )
+    except ValueError as err:
+        return JSONResponse({"error": str(err)}, status_code=400)
+    content = {"service": request.service, "parameters": parameters}
+    return JSONResponse(content, status_code=200)
+
+
 @app.get("/api/event_stream")
 async def event_stream(instance: GlobalInstance = Depends(get_global_instance)):
     async def poll_queue():
@@ -133,7 +216,7 @@ async def event_stream(instance: GlobalInstance = Depends(get_global_instance)):
                 try:
                     result_queue = service.get_output_msg_queue()
                     chunk = result_queue.get(block=False)
-                    item = json.loads(chunk)
+                    item = envelope_to_dict(decode_envelope(chunk))
                 except queue.Empty:
                     pass
             if item and "msg_type" in item:
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 from contextlib import asynccontextmanager
@@ -8,10 +9,10 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
 from halatrans.config.config import Settings
-from halatrans.model.services import AudioStreamControlRequest
-from halatrans.services.frontend.audio_stream_service import (
-    AudioStreamServiceParameters,
-)
+from halatrans.model.services import (AudioStreamControlRequest,
+                                      ServiceConfigRequest)
+from halatrans.services.frontend.audio_stream_service import \
+    AudioStreamServiceParameters
 from halatrans.services.service_frontend_manager import FrontendServiceManager
 
 logging.basicConfig(level=logging.INFO)
@@ -24,7 +25,9 @@ class GlobalInstance:
 
     async def startup(self, settings: Settings):
         logger.info("Global instance startup.")
-        self.frontend_service_manager = FrontendServiceManager()
+        self.frontend_service_manager = FrontendServiceManager(
+            embedded=settings.embedded
+        )
         self.frontend_service_manager.start()
         logger.info("start frontend service manager.")
 
@@ -94,7 +97,9 @@ async def devices_query(instance: GlobalInstance = Depends(get_global_instance))
         ),
         encoding="utf-8",
     )
-    resp = await audio_device.request(input)
+    resp = await audio_device.request(input, timeout=5.0)
+    if resp is None:
+        return JSONResponse({"error": "audio device service timeout"}, status_code=504)
     return JSONResponse(json.loads(str(resp, encoding="utf-8")), status_code=200)
 
 
@@ -116,3 +121,32 @@ async def start_record(
         logger.error(f"Unknow command: {req}")
 
     return JSONResponse(dict(req), status_code=200)
+
+
+@app.get("/api/service_config")
+async def service_config_query(
+    instance: GlobalInstance = Depends(get_global_instance),
+):
+    mgr = instance.get_frontend_service_manager()
+    content = {
+        "services": await asyncio.to_thread(mgr.get_service_parameters) if mgr else {}
+    }
+    return JSONResponse(content, status_code=200)
+
+
+@app.post("/api/service_config")
+async def service_config_update(
+    request: ServiceConfigRequest,
+    instance: GlobalInstance = Depends(get_global_instance),
+):
+    mgr = instance.get_frontend_service_manager()
+    if mgr is None:
+        return JSONResponse({"error": "Service not started."}, status_code=503)
+    try:
+        parameters = await asyncio.to_thread(
+            mgr.update_service_parameters, request.service, request.parameters
+        )
+    except ValueError as err:
+        return JSONResponse({"error": str(err)}, status_code=400)
+    content = {"service": request.service, "parameters": parameters}
+    return JSONResponse(content, status_code=200)
@@ -1,9 +1,10 @@
 import logging
-from concurrent.futures import Future, ProcessPoolExecutor
-from multiprocessing.managers import SyncManager, ValueProxy
-from typing import Tuple, Type, TypeVar
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple, Type, TypeVar
 
 from halatrans.services.base_service import BaseService
+from halatrans.services.cpu_planner import CpuPlan, apply_cpu_plan
+from halatrans.services.shutdown import ShutdownFlag, ShutdownFlagPool
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -11,23 +12,60 @@ logger = logging.getLogger(__name__)
 T = TypeVar("T", bound=BaseService)
 
 
-def process_worker(cls: Type[T], task_id: str, stop_flag: ValueProxy[int], *args):
+def process_worker(
+    cls: Type[T],
+    task_id: str,
+    stop_flag: ShutdownFlag,
+    *args,
+    cpu_plan: Optional[CpuPlan] = None,
+) -> Optional[str]:
+    # Returns the error the worker ended with, None when it ended cleanly.
     logger.info(f"[Task: {task_id}] Worker start, cls: {cls}")
     # logger.info(f"All parametes: {args}")
+    if cpu_plan:
+        # before the service loads its models and starts its thread pools
+        apply_cpu_plan(cpu_plan)
+        logger.info(f"[Task: {task_id}] {cpu_plan}")
+    stop_flag.on_worker_start()
+    error = None
     try:
         cls.process_worker(stop_flag, cls, *args)
     except Exception as err:
-        logger.error(err)
+        logger.exception(err)
+        error = f"{type(err).__name__}: {err}"
     logger.info(f"[Task: {task_id}] Worker end, {cls}")
+    return error
 
 
 def launch_process(
     executor: ProcessPoolExecutor,
-    manager: SyncManager,
+    flag_pool: ShutdownFlagPool,
+    cls: Type[T],
+    task_id: str,
+    *args,
+    stop_flag: Optional[ShutdownFlag] = None,
+    cpu_plan: Optional[CpuPlan] = None,
+) -> Tuple[Future, ShutdownFlag]:
+    # the executor must be created with the initializer of flag_pool. A
+    # restarted task passes the flag it already holds.
+    if stop_flag is None:
+        stop_flag = flag_pool.acquire()
+    future = executor.submit(
+        process_worker, cls, task_id, stop_flag, *args, cpu_plan=cpu_plan
+    )
+    return (future, stop_flag)
+
+
+def launch_thread(
+    executor: ThreadPoolExecutor,
+    flag_pool: ShutdownFlagPool,
     cls: Type[T],
     task_id: str,
     *args,
-) -> Tuple[Future, ValueProxy[int]]:
-    stop_flag = manager.Value("i", 0)
+    stop_flag: Optional[ShutdownFlag] = None,
+) -> Tuple[Future, ShutdownFlag]:
+    # the flag is shared memory of this process, it is used as is
+    if stop_flag is None:
+        stop_flag = flag_pool.acquire()
     future = executor.submit(process_worker, cls, task_id, stop_flag, *args)
     return (future, stop_flag)
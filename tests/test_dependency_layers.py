@@ -0,0 +1,151 @@
+import threading
+from typing import Any, List
+
+import pytest
+
+from halatrans.services.base_service import ServiceConfig
+from halatrans.services.base_service_manager import (BaseServiceManager,
+                                                     dependency_layers)
+
+
+class FakeService:
+    def __init__(self, *depends_on: str, **config: Any):
+        self.config = ServiceConfig(depends_on=list(depends_on), **config)
+
+    def get_config(self) -> ServiceConfig:
+        return self.config
+
+
+class FakeTaskManager:
+    def __init__(self):
+        self.stopped: List[List[str]] = []
+
+    def get_task_heartbeat(self, task_id: str):
+        return None
+
+    def stop_tasks(self, task_ids: List[str]):
+        self.stopped.append(task_ids)
+
+    def signal_stop_tasks(self, task_ids: List[str]) -> List[str]:
+        return task_ids
+
+    def wait_stopped(self, task_ids: List[str]):
+        self.stopped.append(task_ids)
+
+
+class FakeSupervisor:
+    def unwatch(self, task_id: str):
+        pass
+
+
+class FakeAutoscaler:
+    def set_replicas(self, service: str, replica_task_ids: List[str]):
+        pass
+
+
+def test_layers_follow_dependencies():
+    services = {
+        "main": FakeService("transcribe", "whisper", "translation"),
+        "translation": FakeService("transcribe", "whisper"),
+        "whisper": FakeService("transcribe"),
+        "transcribe": FakeService(),
+    }
+    assert dependency_layers(services) == [
+        ["transcribe"],
+        ["whisper"],
+        ["translation"],
+        ["main"],
+    ]
+
+
+def test_independent_services_share_a_layer():
+    services = {
+        "broker": FakeService(),
+        "transcribe": FakeService("broker"),
+        "storage": FakeService("broker"),
+        "main": FakeService("transcribe", "storage"),
+    }
+    layers = dependency_layers(services)
+    assert layers[0] == ["broker"]
+    assert sorted(layers[1]) == ["storage", "transcribe"]
+    assert layers[2] == ["main"]
+
+
+def test_empty_services():
+    assert dependency_layers({}) == []
+
+
+def test_dependency_cycle():
+    services = {
+        "source": FakeService(),
+        "a": FakeService("source", "b"),
+        "b": FakeService("a"),
+    }
+    with pytest.raises(ValueError, match="cycle"):
+        dependency_layers(services)
+
+
+def test_self_dependency_is_a_cycle():
+    with pytest.raises(ValueError, match="cycle"):
+        dependency_layers({"a": FakeService("a")})
+
+
+def test_unknown_dependency():
+    services = {"a": FakeService("missing")}
+    with pytest.raises(ValueError, match="unknown service missing"):
+        dependency_layers(services)
+
+
+def test_drain_stops_the_sources_first():
+    manager = BaseServiceManager()
+    task_manager = FakeTaskManager()
+    manager.__task_manager__ = task_manager
+    manager.__drain__(
+        [["transcribe"], ["whisper"], [], ["broker"]],
+        [["transcribe-0"], ["whisper-0", "whisper-1"], [], ["broker-0"]],
+    )
+    assert task_manager.stopped == [
+        ["transcribe-0"],
+        ["whisper-0", "whisper-1"],
+        ["broker-0"],
+    ]
+
+
+def test_scale_down_waits_without_the_lock():
+    manager = BaseServiceManager()
+    task_manager = FakeTaskManager()
+    manager.__task_manager__ = task_manager
+    manager.__supervisor__ = FakeSupervisor()
+    manager.__autoscaler__ = FakeAutoscaler()
+    manager.__is_scalable__ = lambda service: True
+    manager.__service_state__ = {"whisper": FakeService(replicas=1, max_replicas=3)}
+    manager.__service_task_id_dict__ = {
+        "whisper": ["whisper-d", "whisper-0", "whisper-1", "whisper-2"]
+    }
+
+    lock_free: List[bool] = []
+
+    def wait_stopped(task_ids: List[str]):
+        # another thread, e.g. the api, gets the lock while the replicas stop
+        def acquire():
+            if manager.__lock__.acquire(timeout=1):
+                lock_free.append(True)
+                manager.__lock__.release()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+        task_manager.stopped.append(task_ids)
+
+    task_manager.wait_stopped = wait_stopped
+    assert manager.scale_service("whisper", 1) == 1
+    assert task_manager.stopped == [["whisper-1", "whisper-2"]]
+    assert lock_free == [True]
+    assert manager.__service_task_id_dict__["whisper"] == ["whisper-d", "whisper-0"]
+
+
+def test_no_scaling_while_terminating():
+    manager = BaseServiceManager()
+    manager.is_terminating = True
+    with pytest.raises(ValueError, match="stopping"):
+        manager.scale_service("whisper", 2)
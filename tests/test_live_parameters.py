@@ -0,0 +1,56 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import pytest
+
+from halatrans.services.live_parameters import check_parameter_updates
+
+
+@dataclass
+class FakeParameters:
+    model: str = "tiny.en"
+    beam_size: int = 5
+    language: Optional[str] = "en"
+    interval: float = 1.0
+
+
+LIVE_KEYS = ["beam_size", "language", "interval"]
+
+
+def test_updates_keep_the_types():
+    parameters = {"model": "tiny.en", "beam_size": 5, "language": "en", "interval": 1.0}
+    updates = check_parameter_updates(
+        LIVE_KEYS, parameters, {"beam_size": 1, "interval": 2}, FakeParameters
+    )
+    assert updates == {"beam_size": 1, "interval": 2.0}
+    assert isinstance(updates["interval"], float)
+
+
+def test_optional_parameter_accepts_none():
+    parameters = {"model": "tiny.en", "beam_size": 5, "language": "en", "interval": 1.0}
+    updates = check_parameter_updates(
+        LIVE_KEYS, parameters, {"language": None}, FakeParameters
+    )
+    assert updates == {"language": None}
+    with pytest.raises(ValueError, match="beam_size expects int"):
+        check_parameter_updates(
+            LIVE_KEYS, parameters, {"beam_size": None}, FakeParameters
+        )
+
+
+def test_optional_parameter_set_to_none_keeps_its_type():
+    parameters = {"model": "tiny.en", "beam_size": 5, "language": None, "interval": 1.0}
+    updates = check_parameter_updates(
+        LIVE_KEYS, parameters, {"language": "de"}, FakeParameters
+    )
+    assert updates == {"language": "de"}
+    with pytest.raises(ValueError, match="language expects str"):
+        check_parameter_updates(LIVE_KEYS, parameters, {"language": 3}, FakeParameters)
+
+
+def test_unknown_and_restart_only_parameters():
+    parameters = {"model": "tiny.en", "beam_size": 5, "language": "en", "interval": 1.0}
+    with pytest.raises(ValueError, match="Unknown parameter"):
+        check_parameter_updates(LIVE_KEYS, parameters, {"missing": 1})
+    with pytest.raises(ValueError, match="can not be updated while running"):
+        check_parameter_updates(LIVE_KEYS, parameters, {"model": "base"})
@@ -0,0 +1,123 @@
+import json
+from typing import Any, Dict, List
+
+import pytest
+
+pytest.importorskip("vosk")
+
+from halatrans.model.envelope import decode_envelope  # noqa: E402
+from halatrans.services.audio_frame import AudioFrameHeader  # noqa: E402
+from halatrans.services.backend import transcribe_service  # noqa: E402
+from halatrans.services.shutdown import ShutdownFlagPool  # noqa: E402
+
+ENDPOINT = b"endpoint"
+
+
+class FakeLiveParameters:
+    def __init__(self, ctx, stop_flag, cls, parameters: Dict[str, Any]):
+        self.parameters = parameters
+
+    def poll(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+
+class FakeContext:
+    def term(self):
+        pass
+
+
+class FakeModels:
+    def __init__(self, name: str, loader, warmup=None):
+        self.model = object()
+
+    def get(self):
+        return self.model
+
+
+class FakeRecognizer:
+    def __init__(self, model, sample_rate: int):
+        pass
+
+    def AcceptWaveform(self, chunk: bytes) -> bool:
+        return chunk == ENDPOINT
+
+    def PartialResult(self) -> str:
+        return json.dumps({"partial": "hello world"})
+
+    def Reset(self):
+        pass
+
+
+class FakePublisher:
+    def __init__(self):
+        self.sent: List[List[bytes]] = []
+
+    def send_multipart(self, frames: List[Any], copy: bool = True, key=None):
+        self.sent.append([bytes(frame) for frame in frames])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeSocket:
+    def close(self):
+        pass
+
+
+def run_batch(monkeypatch, chunks: List[bytes]) -> FakePublisher:
+    publisher = FakePublisher()
+    monkeypatch.setattr(transcribe_service, "create_context", FakeContext)
+    monkeypatch.setattr(transcribe_service, "LiveParameters", FakeLiveParameters)
+    monkeypatch.setattr(transcribe_service, "HotSwapModel", FakeModels)
+    monkeypatch.setattr(transcribe_service, "is_model_loaded", lambda name: True)
+    monkeypatch.setattr(transcribe_service, "KaldiRecognizer", FakeRecognizer)
+    monkeypatch.setattr(
+        transcribe_service, "create_qos_publisher", lambda *args: publisher
+    )
+    monkeypatch.setattr(
+        transcribe_service, "create_qos_sub_socket", lambda *args: FakeSocket()
+    )
+
+    def poll_messages(socks, handler, should_stop):
+        handler(socks[0], chunks)
+
+    monkeypatch.setattr(transcribe_service, "poll_messages", poll_messages)
+    transcribe_service.TranscribeService.on_worker_process_custom(
+        ShutdownFlagPool().acquire(),
+        {
+            "audio_pub_addr": "svc://audio",
+            "audio_pub_topic": "audio",
+            "transcribe_pub_addr": "svc://transcribe",
+            "transcribe_pub_partial_topic": "partial",
+            "transcribe_pub_fulltext_topic": "fulltext",
+        },
+    )
+    return publisher
+
+
+def test_two_endpoints_in_one_batch(monkeypatch):
+    publisher = run_batch(
+        monkeypatch, [b"a", b"b", ENDPOINT, b"c", ENDPOINT, b"d", ENDPOINT]
+    )
+    fulltexts = [
+        AudioFrameHeader.decode(frames[1])
+        for frames in publisher.sent
+        if frames[0] == b"fulltext"
+    ]
+    assert [header.seq for header in fulltexts] == [0, 1, 2]
+    msgids = [header.msgid for header in fulltexts]
+    assert len(set(msgids)) == 3
+
+    partial_msgids = [
+        decode_envelope(frames[1]).msgid
+        for frames in publisher.sent
+        if frames[0] == b"partial"
+    ]
+    # every partial belongs to the utterance its endpoint publishes
+    assert partial_msgids == [msgids[0], msgids[0], msgids[1], msgids[2]]
@@ -0,0 +1,78 @@
+from typing import List
+
+import numpy as np
+
+from halatrans.services.vad_segmenter import SAMPLE_RATE, Segment, VadSegmenter
+
+BLOCK_SIZE = 8000  # samples per audio block, same as AudioStreamService
+
+
+def silence(seconds: float) -> np.ndarray:
+    # low noise, about -70 dBFS
+    rng = np.random.default_rng(0)
+    return rng.integers(-10, 10, int(seconds * SAMPLE_RATE), dtype=np.int16)
+
+
+def speech(seconds: float) -> np.ndarray:
+    # a loud tone, about -13 dBFS
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * 220 * t) * 10000).astype(np.int16)
+
+
+def feed(segmenter: VadSegmenter, pcm: np.ndarray) -> List[Segment]:
+    segments: List[Segment] = []
+    for start in range(0, len(pcm), BLOCK_SIZE):
+        segments.extend(segmenter.accept(pcm[start : start + BLOCK_SIZE]))
+    return segments
+
+
+def test_speech_onset_with_pre_roll():
+    segmenter = VadSegmenter(pre_roll=0.3, end_silence=0.5)
+    segments = feed(segmenter, np.concatenate([silence(1), speech(1), silence(1)]))
+    assert len(segments) == 1
+    segment = segments[0]
+    # the segment starts pre_roll before the speech, within a frame
+    assert abs(segment.start - 0.7 * SAMPLE_RATE) <= 480
+    assert abs(segment.end - 2.5 * SAMPLE_RATE) <= 480
+    assert len(segment.audio) == segment.end - segment.start
+    assert not segmenter.in_speech
+
+
+def test_utterance_ends_after_end_silence():
+    segmenter = VadSegmenter(end_silence=0.5)
+    assert (
+        feed(segmenter, np.concatenate([silence(0.5), speech(1), silence(0.3)])) == []
+    )
+    assert segmenter.in_speech
+    segments = feed(segmenter, silence(0.3))
+    assert len(segments) == 1
+    assert not segmenter.in_speech
+
+
+def test_long_speech_is_cut_at_max_utterance():
+    segmenter = VadSegmenter(max_utterance=2.0, pre_roll=0.0)
+    segments = feed(segmenter, speech(5))
+    # whole frames of 30 ms
+    assert [len(s.audio) for s in segments] == [66 * 480, 66 * 480]
+    assert segments[1].start == segments[0].end
+    tail = segmenter.flush()
+    assert tail is not None
+    assert tail.start == segments[1].end
+    # up to the last whole frame
+    assert tail.end == 5 * SAMPLE_RATE // 480 * 480
+
+
+def test_speech_at_the_start_of_the_stream():
+    segmenter = VadSegmenter()
+    segments = feed(segmenter, np.concatenate([speech(1), silence(1)]))
+    assert len(segments) == 1
+    assert segments[0].start == 0
+    # no speech of the start is lost
+    assert np.array_equal(segments[0].audio[:SAMPLE_RATE], speech(1))
+
+
+def test_short_noise_is_dropped():
+    segmenter = VadSegmenter(min_speech=0.2)
+    segments = feed(segmenter, np.concatenate([silence(1), speech(0.06), silence(1)]))
+    assert segments == []
+    assert segmenter.flush() is None